@@ -2,6 +2,45 @@
 READ_SAMPLE = False
 BEAUTY_SPEED = True
 
+# Replay a recording instead of reading the G4 (always the case if the G4Track.dll can not be loaded)
+SIMULATE_SENSOR = False
+SIMULATED_RECORDING = ''  # trial_N.xlsx or .npz, a synthetic movement is used if empty
+SIMULATED_RATE = 0  # frames per second, 0 to use the sample frequency of the settings
+SIMULATED_JITTER = 0.002  # standard deviation (s) of the moment a new frame becomes available
+SIMULATED_DROP_RATE = 0.0  # chance that a frame gets lost
+
+# Read every new frame (found with the frame counter) instead of a single frame every 1/fs, the reading thread wakes
+# up STREAM_WAKE_RATE times per second. Only used when the sensor keeps its frames (not on the G4, it is read every
+# 1/fs there)
+STREAM_READING = True
+STREAM_WAKE_RATE = 30
+# The connection with the sensor is lost if this many samples in a row are all zeros (warned once per trial)
+LOST_CONNECTION_SAMPLES = 10
+# Last part (s) of a wait in the reading loop that is spent spinning instead of sleeping (not needed on Linux)
+PACING_SPIN = 0.0015
+# Every trial is journaled to the disk while reading (for a crash of the app), room for this many minutes of frames
+JOURNAL_MINUTES = 10
+
+# Names of the sensors that are not on the hands (in the order they are found on the hubs), used with
+# RECORD_EXTRA_SENSORS. Sensors without a name here are called 'sensor_N'
+EXTRA_SENSOR_ROLES = ['trunk', 'box']
+
+# Memory (MB) for the plots and samples of all the trials, the trials that were not shown for the longest time are
+# freed first (and made again when they are shown)
+TAB_MEMORY_BUDGET_MB = 256
+
+# Read the Excels of a participant folder in separate processes (one for every core), otherwise in threads
+INGEST_PROCESSES = True
+
+# Number of trials that can wait to be saved in the background (a trial that is saved again only counts once), if
+# there are more the status bar shows how many trials are waiting
+SAVE_QUEUE_SIZE = 8
+
+# Resampling of a trial with gaps: only the neighborhood of every gap (SPLINE_GAP_MARGIN samples on both sides) is
+# fitted with a spline if these neighborhoods are at most this part of the trial, otherwise the whole trial
+SPLINE_SPARSE_GAPS = 0.05
+SPLINE_GAP_MARGIN = 16
+
 NAME_APP = 'Bimanual Hand Movement'
 
 # Lay-out of the PDF
@@ -30,3 +69,6 @@ BIMAN_PARAMS = ['Total time (s)', 'Temporal coupling (/)', 'Movement overlap  (/
 UNIMAN_PARAMS = ['Time box hand (s)', 'Time 1e phase BH (s)', 'Time 2e phase BH (s)', 'Time trigger hand (s)',
                  'Smoothness BH (/)', 'Smoothness TH (/)', 'Path length BH (cm)', 'Path 1e phase BH (cm)',
                  'Path 2e phase BH (cm)', 'Path length TH (cm)']
+# only exported when the orientation of the sensors is recorded
+WRIST_PARAMS = ['Wrist rotation range BH (deg)', 'Wrist rotation total BH (deg)', 'Wrist rotation range TH (deg)',
+                'Wrist rotation total TH (deg)']
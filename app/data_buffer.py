@@ -0,0 +1,390 @@
+import hashlib
+import os
+
+import numpy as np
+
+from constants import EXTRA_SENSOR_ROLES
+
+# Number of samples allocated when a new trial starts (~34 s at 120 Hz), grows by doubling afterwards
+INITIAL_CAPACITY = 4096
+# x, y, z and speed for every sensor
+VALUES_PER_SENSOR = 4
+# azimuth, elevation and roll (or a quaternion) for every sensor
+ORIENTATION_PER_SENSOR = 4
+# The first two sensors of a trial are always the hands, extra sensors come after them
+HAND_ROLES = ('left', 'right')
+
+
+def orientation_file(trial_file):
+    """
+    Name of the binary file next to a trial that holds the orientation of the sensors
+    :param trial_file: path of the trial_N.xlsx
+    """
+    return os.path.splitext(trial_file)[0] + '_orientation.npz'
+
+
+def save_orientation(trial_file, buffer):
+    """
+    Save the orientation of a trial next to the Excel (float32, not compressed to keep saving fast)
+    :param trial_file: path of the trial_N.xlsx
+    :param buffer: the data of the trial
+    :type buffer: TrialBuffer
+    """
+    np.savez(orientation_file(trial_file), time=buffer.xs, orientation=buffer.orientation)
+
+
+def load_orientation(trial_file, size):
+    """
+    Load the orientation saved next to a trial
+    :param trial_file: path of the trial_N.xlsx
+    :param size: number of samples of the trial
+    :return: array with shape (size, sensors, 4) or None if there is no (matching) orientation
+    """
+    file_name = orientation_file(trial_file)
+    if not os.path.exists(file_name):
+        return None
+
+    with np.load(file_name) as data:
+        orientation = data['orientation']
+    if len(orientation) != size:
+        return None
+    return orientation
+
+
+def extra_role(index):
+    """
+    Name of an extra sensor
+    :param index: position of the sensor after the hands
+    """
+    if index < len(EXTRA_SENSOR_ROLES):
+        return EXTRA_SENSOR_ROLES[index]
+    return f'sensor_{index + len(HAND_ROLES) + 1}'
+
+
+def extra_sensors_file(trial_file):
+    """
+    Name of the binary file next to a trial that holds the sensors that are not on the hands
+    :param trial_file: path of the trial_N.xlsx
+    """
+    return os.path.splitext(trial_file)[0] + '_sensors.npz'
+
+
+def save_extra_sensors(trial_file, buffer):
+    """
+    Save the extra sensors of a trial next to the Excel, the layout of the Excel stays the same
+    :param trial_file: path of the trial_N.xlsx
+    :param buffer: the data of the trial
+    :type buffer: TrialBuffer
+    """
+    np.savez(extra_sensors_file(trial_file), time=buffer.xs, roles=np.array(buffer.extra_roles),
+             data=buffer.extra_sensors())
+
+
+def load_extra_sensors(trial_file, size):
+    """
+    Load the extra sensors saved next to a trial
+    :param trial_file: path of the trial_N.xlsx
+    :param size: number of samples of the trial
+    :return: the roles and an array with shape (size, extra sensors, 4), or no roles and None if there are no
+        (matching) extra sensors
+    """
+    file_name = extra_sensors_file(trial_file)
+    if not os.path.exists(file_name):
+        return (), None
+
+    with np.load(file_name) as data:
+        roles = tuple(str(role) for role in data['roles'])
+        sensors = data['data']
+    if len(sensors) != size or len(roles) == 0:
+        return (), None
+    return roles, sensors
+
+
+class TrialBuffer:
+    """
+    Columnar storage of all the samples of a single trial. Every column (time, x/y/z/v left, x/y/z/v right) is stored
+    in one preallocated NumPy array that grows by doubling, so appending is amortized O(1) and all the consumers can
+    use views on the columns instead of rebuilding lists out of tuples.
+
+    Layout of the rows: [time, x_left, y_left, z_left, v_left, x_right, y_right, z_right, v_right, (x, y, z, v of
+    every extra sensor)]
+
+    The orientation of the sensors is optional and kept in a separate float32 block (4 rows for every sensor).
+    """
+    def __init__(self, capacity=INITIAL_CAPACITY, roles=HAND_ROLES, orientation=False):
+        """
+        :param capacity: number of samples to allocate in advance
+        :param roles: name of every sensor stored in the buffer, starting with the left and the right hand
+        :param orientation: also store the orientation of the sensors
+        """
+        self.roles = list(roles)
+        self.sensors = len(self.roles)
+        self._data = np.zeros((1 + VALUES_PER_SENSOR * self.sensors, max(1, capacity)), dtype=np.float64)
+        self._orientation = None
+        if orientation:
+            self._orientation = np.zeros((ORIENTATION_PER_SENSOR * self.sensors, max(1, capacity)),
+                                         dtype=np.float32)
+        self._size = 0
+        # changes with every change of the samples, see changed
+        self.version = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def xs(self):
+        """
+        View on the timestamps of the trial
+        """
+        return self._data[0, :self._size]
+
+    @property
+    def left(self):
+        """
+        View with shape (N, 4) on the coordinates and speed of the left hand
+        """
+        return self.sensor_by_role('left')
+
+    @property
+    def right(self):
+        """
+        View with shape (N, 4) on the coordinates and speed of the right hand
+        """
+        return self.sensor_by_role('right')
+
+    @property
+    def has_orientation(self):
+        return self._orientation is not None
+
+    @property
+    def orientation(self):
+        """
+        View with shape (N, sensors, 4) on the orientation of all sensors (None if it is not recorded)
+        """
+        if self._orientation is None:
+            return None
+        return self._orientation[:, :self._size].T.reshape(self._size, self.sensors, ORIENTATION_PER_SENSOR)
+
+    @property
+    def extra_roles(self):
+        """
+        Roles of the sensors that are not on the hands
+        """
+        return self.roles[len(HAND_ROLES):]
+
+    def sensor_by_role(self, role):
+        """
+        View with shape (N, 4) on the coordinates and speed of the sensor with the given role
+        :param role: 'left', 'right' or one of the extra roles
+        """
+        return self.sensor(self.roles.index(role))
+
+    def extra_sensors(self):
+        """
+        Copy of the data of the extra sensors
+        :return: array with shape (N, extra sensors, 4)
+        """
+        if not self.extra_roles:
+            return np.zeros((self._size, 0, VALUES_PER_SENSOR), dtype=self._data.dtype)
+        return np.stack([self.sensor_by_role(role) for role in self.extra_roles], axis=1)
+
+    def sensor(self, index):
+        """
+        View with shape (N, 4) on the coordinates and speed of a sensor
+        :param index: position of the sensor in the buffer
+        """
+        start = 1 + VALUES_PER_SENSOR * index
+        return self._data[start:start + VALUES_PER_SENSOR, :self._size].T
+
+    def column(self, index, value):
+        """
+        Contiguous view on a single column of a sensor
+        :param index: position of the sensor in the buffer
+        :param value: 0 for x, 1 for y, 2 for z and 3 for the speed
+        """
+        return self._data[1 + VALUES_PER_SENSOR * index + value, :self._size]
+
+    def _grow(self, needed):
+        capacity = self._data.shape[1]
+        while capacity < needed:
+            capacity *= 2
+
+        data = np.zeros((self._data.shape[0], capacity), dtype=self._data.dtype)
+        data[:, :self._size] = self._data[:, :self._size]
+        self._data = data
+
+        if self._orientation is not None:
+            orientation = np.zeros((self._orientation.shape[0], capacity), dtype=self._orientation.dtype)
+            orientation[:, :self._size] = self._orientation[:, :self._size]
+            self._orientation = orientation
+
+    def append(self, time, left, right):
+        """
+        Add a single sample at the end of the trial (used by the reading thread)
+        :param time: timestamp of the sample
+        :param left: x, y, z and speed of the left hand
+        :param right: x, y, z and speed of the right hand
+        """
+        if self._size == self._data.shape[1]:
+            self._grow(self._size + 1)
+
+        index = self._size
+        self._data[0, index] = time
+        self._data[1:5, index] = left
+        self._data[5:9, index] = right
+        self._data[9:, index] = 0
+        if self._orientation is not None:
+            self._orientation[:, index] = 0
+        self._size += 1
+        self.version += 1
+
+    def append_positions(self, time, positions, orientations=None):
+        """
+        Add a single sample with the coordinates of every sensor, the speed is calculated from the previous sample
+        (same as TrailTab.speed_calculation, 0 for the first two samples)
+        :param time: timestamp of the sample
+        :param positions: array-like with shape (sensors, 3) with the x, y and z of every sensor
+        :param orientations: array-like with shape (sensors, 4) with the orientation of every sensor (only stored if
+            the buffer keeps the orientation)
+        """
+        if self._size == self._data.shape[1]:
+            self._grow(self._size + 1)
+
+        index = self._size
+        self._data[0, index] = time
+        sample = self._data[1:, index].reshape(self.sensors, VALUES_PER_SENSOR)
+        sample[:, :3] = positions
+
+        if index > 1:
+            previous = self._data[1:, index - 1].reshape(self.sensors, VALUES_PER_SENSOR)
+            distance = np.sqrt(np.square(sample[:, :3] - previous[:, :3]).sum(axis=1))
+            sample[:, 3] = distance / (time - self._data[0, index - 1]) / 100
+        else:
+            sample[:, 3] = 0
+
+        if self._orientation is not None:
+            self._orientation[:, index] = 0 if orientations is None else np.ravel(orientations)
+        self._size += 1
+        self.version += 1
+
+    def pop(self):
+        """
+        Remove the last sample of the trial
+        :return: the time, left and right data of the removed sample
+        """
+        self._size -= 1
+        self.version += 1
+        index = self._size
+        return self._data[0, index], tuple(self._data[1:5, index]), tuple(self._data[5:9, index])
+
+    def set_data(self, xs, left, right, orientation=None, extra=None, extra_roles=()):
+        """
+        Replace all the samples of the trial
+        :param xs: the timestamps
+        :param left: array-like with shape (N, 4) of the left hand
+        :param right: array-like with shape (N, 4) of the right hand
+        :param orientation: array-like with shape (N, sensors, 4), without it the orientation is no longer stored
+        :param extra: array-like with shape (N, extra sensors, 4), without it only the hands are stored
+        :param extra_roles: roles of the extra sensors
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        size = len(xs)
+        self.clear(orientation is not None, HAND_ROLES + tuple(extra_roles) if extra is not None else HAND_ROLES)
+
+        if size > self._data.shape[1]:
+            self._grow(size)
+
+        self._data[0, :size] = xs
+        self._data[1:5, :size] = np.asarray(left, dtype=np.float64).T
+        self._data[5:9, :size] = np.asarray(right, dtype=np.float64).T
+        if extra is not None:
+            self._data[9:, :size] = np.asarray(extra, dtype=np.float64).reshape(size, -1).T
+        if orientation is not None:
+            self._orientation[:, :size] = np.asarray(orientation, dtype=np.float32).reshape(size, -1).T
+        self._size = size
+        self.version += 1
+
+    def crop(self, start, stop, rebase_time=False):
+        """
+        Only keep the samples between start and stop (not included)
+        :param start: index of the first sample to keep
+        :param stop: index after the last sample to keep
+        :param rebase_time: let the time start from 0 again
+        """
+        size = max(0, stop - start)
+        self._data[:, :size] = self._data[:, start:stop]
+        if self._orientation is not None:
+            self._orientation[:, :size] = self._orientation[:, start:stop]
+        if rebase_time and size > 0:
+            self._data[0, :size] -= self._data[0, 0]
+        self._size = size
+        self.version += 1
+
+    def swap_hands(self):
+        """
+        Switch the data of the left and the right hand
+        """
+        self._data[1:5, :self._size], self._data[5:9, :self._size] = \
+            self._data[5:9, :self._size].copy(), self._data[1:5, :self._size].copy()
+
+        if self._orientation is not None:
+            self._orientation[0:4, :self._size], self._orientation[4:8, :self._size] = \
+                self._orientation[4:8, :self._size].copy(), self._orientation[0:4, :self._size].copy()
+        self.version += 1
+
+    def changed(self):
+        """
+        Has to be called after the samples are changed through one of the views (left, right, column, ...), so the
+        results that are kept for the samples (see version) are made again
+        """
+        self.version += 1
+
+    def clear(self, orientation=None, roles=None):
+        """
+        Remove all the samples
+        :param orientation: start or stop storing the orientation (None to keep it as it is)
+        :param roles: change the sensors that are stored (None to keep them as they are)
+        """
+        self._size = 0
+        self.version += 1
+        if roles is not None and list(roles) != self.roles:
+            self.roles = list(roles)
+            self.sensors = len(self.roles)
+            self._data = np.zeros((1 + VALUES_PER_SENSOR * self.sensors, self._data.shape[1]), dtype=np.float64)
+            if self._orientation is not None:
+                self._orientation = np.zeros((ORIENTATION_PER_SENSOR * self.sensors, self._data.shape[1]),
+                                             dtype=np.float32)
+
+        if orientation is not None and orientation != self.has_orientation:
+            self._orientation = None
+            if orientation:
+                self._orientation = np.zeros((ORIENTATION_PER_SENSOR * self.sensors, self._data.shape[1]),
+                                             dtype=np.float32)
+
+    @property
+    def nbytes(self):
+        """
+        Memory (bytes) that is allocated for the samples
+        """
+        return self._data.nbytes + (self._orientation.nbytes if self._orientation is not None else 0)
+
+    def digest(self):
+        """
+        Hash of the samples, to check if the trial changed since it was loaded
+        """
+        digest = hashlib.blake2b(','.join(self.roles).encode('utf-8'), digest_size=16)
+        digest.update(np.ascontiguousarray(self._data[:, :self._size]).data)
+        if self._orientation is not None:
+            digest.update(np.ascontiguousarray(self._orientation[:, :self._size]).data)
+        return digest.hexdigest()
+
+    def copy(self):
+        """
+        Make an independent copy (used to hand the data to another thread)
+        """
+        buffer = TrialBuffer(self._size, self.roles, self.has_orientation)
+        buffer._data[:, :self._size] = self._data[:, :self._size]
+        if self._orientation is not None:
+            buffer._orientation[:, :self._size] = self._orientation[:, :self._size]
+        buffer._size = self._size
+        return buffer
@@ -0,0 +1,200 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from constants import BIMAN_PARAMS, UNIMAN_PARAMS
+from data_manifest import file_signature, same_file
+from data_study import model_fingerprint
+from logger import get_logbook
+
+"""
+Dataset of a whole study folder (Cohort_dataset), made by the comparison of the participants. It holds a row for every
+trial (participant, trial, score, case, events and the bimanual and unimanual parameters) and, if asked, the samples of
+every trial in long format, so the statistics can load the study at once instead of reading all the Excels.
+
+Every participant is one chunk (an uncompressed .npz), the index.json keeps the chunk of every participant together with
+the signature of the trial files it was made from. When the comparison is done again, only the chunks of the participants
+that are new or have changed files are written again.
+"""
+
+logger = get_logbook('data_dataset')
+
+DATASET_FOLDER = 'Cohort_dataset'
+INDEX_NAME = 'index.json'
+DATASET_VERSION = 1
+SAMPLE_COLUMNS = ['Time (s)', 'Left Sensor x (cm)', 'Left Sensor y (cm)', 'Left Sensor z (cm)', 'Left Sensor v (m/s)',
+                  'Right Sensor x (cm)', 'Right Sensor y (cm)', 'Right Sensor z (cm)', 'Right Sensor v (m/s)']
+
+
+def _save_npz(path, **arrays):
+    with open(path + '.tmp', 'wb') as file:
+        np.savez(file, **arrays)
+    os.replace(path + '.tmp', path)
+
+
+class CohortDataset:
+    """
+    The dataset of a study folder, see the top of this file
+    """
+    def __init__(self, folder, number_events, data=None):
+        """
+        Use CohortDataset.load
+        :param folder: the study folder (with a folder for every participant)
+        :param number_events: number of events of a trial
+        :param data: content of the index.json
+        """
+        self.folder = folder
+        self.number_events = number_events
+        self.data = data if data is not None else {
+            'version': DATASET_VERSION, 'number_events': number_events, 'scoring_model': model_fingerprint(),
+            'bimanual': list(BIMAN_PARAMS), 'unimanual': list(UNIMAN_PARAMS), 'participants': {}
+        }
+        self.seen = set()
+
+    @classmethod
+    def load(cls, folder, number_events):
+        """
+        Read the index of the dataset, an empty dataset if there is none or it was made with other settings
+        :param folder: the study folder
+        :param number_events: number of events of a trial
+        """
+        path = os.path.join(folder, DATASET_FOLDER, INDEX_NAME)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+            if data.get('version') == DATASET_VERSION and data.get('number_events') == number_events and \
+                    data.get('scoring_model') == model_fingerprint() and data.get('bimanual') == list(BIMAN_PARAMS) and data.get('unimanual') == list(UNIMAN_PARAMS):
+                return cls(folder, number_events, data)
+            logger.info(f"Dataset {path} was made with other settings, it is made again")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read dataset {path}: {e}")
+        return cls(folder, number_events)
+
+    @property
+    def path(self):
+        return os.path.join(self.folder, DATASET_FOLDER)
+
+    def is_current(self, name, trial_files, samples=False):
+        """
+        Check if the chunk of a participant can be used
+        :param name: name of the folder of the participant
+        :param trial_files: paths of the trial_N.xlsx of the participant
+        :param samples: the samples are needed as well
+        """
+        entry = self.data['participants'].get(name)
+        if entry is None or (samples and not entry['samples']):
+            return False
+        if not os.path.exists(os.path.join(self.path, entry['chunk'])):
+            return False
+        names = {os.path.basename(file) for file in trial_files}
+        if names != set(entry['files']):
+            return False
+        return all(same_file(file, entry['files'][os.path.basename(file)]) for file in trial_files)
+
+    def keep(self, name):
+        """
+        Keep the chunk of a participant as it is
+        :param name: name of the folder of the participant
+        """
+        self.seen.add(name)
+
+    def set_participant(self, name, part_code, trial_files, rows, samples=None):
+        """
+        Write the chunk of a participant
+        :param name: name of the folder of the participant
+        :param part_code: the participant code
+        :param trial_files: paths of the trial_N.xlsx the rows are made from
+        :param rows: a dict (trial, score, case, events, bimanual, unimanual) for every trial
+        :param samples: the samples of every trial (trial number: array with the columns of SAMPLE_COLUMNS), None to
+        leave them out
+        """
+        os.makedirs(self.path, exist_ok=True)
+
+        entry = self.data['participants'].get(name)
+        if entry is None:
+            number = max((int(e['chunk'].split('_')[1].split('.')[0]) for e in self.data['participants'].values()),
+                         default=0) + 1
+            entry = {'chunk': f"part_{number:05d}.npz"}
+
+        arrays = {
+            'participant': np.array([part_code] * len(rows), dtype=np.str_),
+            'trial': np.array([row['trial'] for row in rows], dtype=np.int32),
+            'score': np.array([row['score'] for row in rows], dtype=np.int32),
+            'case': np.array([row['case'] for row in rows], dtype=np.int32),
+            'events': np.array([row['events'] for row in rows], dtype=np.int64).reshape(-1, self.number_events),
+            'bimanual': np.array([row['bimanual'] for row in rows], dtype=np.float64).reshape(-1, len(BIMAN_PARAMS)),
+            'unimanual': np.array([row['unimanual'] for row in rows],
+                                  dtype=np.float64).reshape(-1, len(UNIMAN_PARAMS)),
+        }
+        if samples is not None:
+            arrays['sample_trial'] = np.concatenate(
+                [np.full(len(values), trial, dtype=np.int32) for trial, values in samples.items()]
+                or [np.zeros(0, dtype=np.int32)])
+            arrays['samples'] = np.concatenate(
+                [np.asarray(values, dtype=np.float64) for values in samples.values()]
+                or [np.zeros((0, len(SAMPLE_COLUMNS)))])
+
+        _save_npz(os.path.join(self.path, entry['chunk']), **arrays)
+
+        entry['part_code'] = part_code
+        entry['samples'] = samples is not None
+        entry['files'] = {os.path.basename(file): file_signature(file) for file in trial_files}
+        self.data['participants'][name] = entry
+        self.seen.add(name)
+
+    def save(self):
+        """
+        Remove the participants that are not in the study folder anymore and write the index
+        """
+        for name in list(self.data['participants']):
+            if name not in self.seen:
+                entry = self.data['participants'].pop(name)
+                try:
+                    os.remove(os.path.join(self.path, entry['chunk']))
+                except OSError:
+                    pass
+
+        os.makedirs(self.path, exist_ok=True)
+        index = os.path.join(self.path, INDEX_NAME)
+        with open(index + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(self.data, file, indent=1)
+        os.replace(index + '.tmp', index)
+
+
+def load_dataset(folder, samples=False):
+    """
+    Read the dataset of a study folder, for the statistics
+    :param folder: the study folder (or its Cohort_dataset folder)
+    :param samples: read the samples as well
+    :return: DataFrame with a row for every trial, and the DataFrame with the samples (long format) if samples is True
+    """
+    if os.path.basename(os.path.normpath(folder)) == DATASET_FOLDER:
+        folder = os.path.dirname(os.path.normpath(folder))
+    with open(os.path.join(folder, DATASET_FOLDER, INDEX_NAME), 'r', encoding='utf-8') as file:
+        index = json.load(file)
+
+    events = [f"Event {i + 1}" for i in range(index['number_events'])]
+    trial_frames, sample_frames = [], []
+    for entry in index['participants'].values():
+        with np.load(os.path.join(folder, DATASET_FOLDER, entry['chunk'])) as chunk:
+            frame = pd.DataFrame({'Participant': chunk['participant'], 'Trial': chunk['trial'],
+                                  'Score': chunk['score'], 'Case': chunk['case']})
+            frame[events] = chunk['events']
+            frame[index['bimanual']] = chunk['bimanual']
+            frame[index['unimanual']] = chunk['unimanual']
+            trial_frames.append(frame)
+
+            if samples and entry['samples']:
+                frame = pd.DataFrame(chunk['samples'], columns=SAMPLE_COLUMNS)
+                frame.insert(0, 'Trial', chunk['sample_trial'])
+                frame.insert(0, 'Participant', entry['part_code'])
+                sample_frames.append(frame)
+
+    trials = pd.concat(trial_frames, ignore_index=True) if trial_frames else pd.DataFrame()
+    if not samples:
+        return trials
+    return trials, pd.concat(sample_frames, ignore_index=True) if sample_frames else pd.DataFrame()
@@ -0,0 +1,164 @@
+import os
+
+import pikepdf
+
+import pandas as pd
+
+from data_trial_file import open_trial, binary_is_current
+
+"""
+Parsing of the files of a participant folder (trial Excels and the PDF), without touching the tabs, so the files can
+be read in a pool of threads or processes. The results are plain dicts that MainWindow puts in the tabs (bind_trial
+and bind_notes).
+"""
+
+
+def trial_index(trial_file):
+    """
+    :param trial_file: path of the trial_N.xlsx
+    :return: index of the trial (N - 1)
+    """
+    return int(os.fspath(trial_file).split('.')[-2].split('_')[-1]) - 1
+
+
+def blank_column(values):
+    """
+    :param values: the values of a column of a trial
+    :return: True if all the cells of the column are empty
+    """
+    column = pd.Series(values)
+    return bool(column.isnull().all() or column.astype(str).str.strip().eq("").all())
+
+
+def needs_excel(trial_file):
+    """
+    :param trial_file: path of the trial_N.xlsx
+    :return: True if the trial can only be read from the Excel (slow, better in a separate process)
+    """
+    return not binary_is_current(trial_file)
+
+
+def parse_trial(trial_file, number_events, manual_events):
+    """
+    Read a trial file
+    :param trial_file: path of the trial_N.xlsx
+    :param number_events: number of events of a trial
+    :param manual_events: use the manual events of the file (if there are any)
+    :return: dict with the kind of file ('empty': no columns, 'blank': no samples, 'short': not enough samples or
+    'data'), the first 9 columns (time and the samples of both hands), the score and the events
+    """
+    with open_trial(trial_file) as trial:
+        return _parse_columns(trial, trial_file, number_events, manual_events)
+
+
+def _parse_columns(trial, trial_file, number_events, manual_events):
+    """
+    parse_trial for an open trial (see data_trial_file.open_trial), only the columns that are needed are read
+    """
+    result = {'file': trial_file, 'index': trial_index(trial_file), 'kind': 'data'}
+    number_columns = len(trial.names)
+
+    if number_columns < 1:
+        result['kind'] = 'empty'
+        return result
+
+    first_col = trial.values(0)
+    if blank_column(first_col):
+        result['kind'] = 'blank'
+        return result
+
+    if len(first_col) <= 2:
+        result['kind'] = 'short'
+        return result
+
+    result['columns'] = [first_col] + [trial.values(i) for i in range(1, 9)]
+    result['original_data_file'] = number_columns > 8
+    score = trial.values(9)[0] if number_columns > 9 else None
+    result['score'] = int(score) if score is not None and not pd.isna(score) else None
+
+    # add manual sign
+    if number_columns < 11:
+        event_log = [0] * number_events
+    elif manual_events:
+        event_log = trial.values(12)[0:number_events].tolist()
+        if all(x == 0 for x in event_log):
+            event_log = trial.values(11)[0:number_events].tolist()
+    else:
+        event_log = trial.values(11)[0:number_events].tolist()
+
+    if event_log is None or len(event_log) == 0:
+        event_log = [0] * number_events
+    else:
+        event_log = [int(x) if x != 0 else 0 for x in event_log]
+    result['event_log'] = event_log
+
+    # old files without position events: they are estimated out of the samples
+    result['estimate_positions'] = number_columns < 13 or \
+        (manual_events and
+         (number_columns <= 14 and
+          not (pd.Series(trial.values(trial.names.index('Position events:'))).fillna(0) == 0).all()))
+    if not result['estimate_positions']:
+        result['event_position'] = trial.values(13)[0:number_events].tolist()
+
+    result['trial_time_start'] = trial.values(17)[0] if number_columns >= 18 else None
+    button_time = trial.values(18)[0] if number_columns >= 19 else None
+    result['button_time'] = float(button_time) if button_time is not None and not pd.isna(button_time) else None
+    return result
+
+
+def parse_notes(pdf_file):
+    """
+    Read the scores, notes and GoPro start of every trial out of the PDF of the app
+    :param pdf_file: path of the PDF
+    :return: dict with a dict (score, notes, trial_time_start) for every index of a trial in the PDF
+    """
+    pdf = pikepdf.Pdf.open(pdf_file)
+
+    trials = {}
+    trial = None
+    trial_number = 0
+    in_table = False
+    events_table = False
+    for page in pdf.pages:
+        pdf_content = page.get('/Contents').read_bytes().decode('utf-8')
+        text = pdf_content.split('\n')
+
+        for line in text:
+            if '(' not in line:
+                continue
+
+            rule_text = line.split('(', 1)[1]
+            rule_text = rule_text[::-1].split(')', 1)[1][::-1]
+
+            if ('Trial 1' in rule_text and trial_number == 0) or \
+                    (trial_number != 0 and 'Trial' in rule_text and
+                     int(rule_text.split()[1][:-1]) == trial_number + 1):
+                in_table = False
+                events_table = False
+                trial_number += 1
+
+                trial = trials.setdefault(trial_number - 1, {'score': None, 'notes': [], 'trial_time_start': None})
+                if 'score' in rule_text:
+                    trial['score'] = int(rule_text.split()[3])
+
+            elif trial_number == 0:
+                continue
+
+            elif rule_text == 'Table' or rule_text == 'Parameters':
+                in_table = True
+
+            elif rule_text == 'Events':
+                events_table = True
+                in_table = True
+
+            elif events_table and trial['trial_time_start'] is None and 'Starting the trial at:' in rule_text:
+                time = rule_text.split(':')[1:]
+                trial['trial_time_start'] = int(time[0]) * 60 + float(time[1])
+
+            elif rule_text == 'Average over all trials with score 3':
+                break
+
+            elif not in_table and rule_text != 'No Notes':
+                trial['notes'].append(rule_text)
+
+    return {'file': pdf_file, 'trials': trials}
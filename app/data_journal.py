@@ -0,0 +1,214 @@
+import glob
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from constants import NAME_APP, JOURNAL_MINUTES
+from data_buffer import TrialBuffer, save_orientation, save_extra_sensors
+from logger import get_logbook
+
+"""
+Append-only journal of the raw frames of a trial, so a trial survives a crash of the app. The journal is a file with
+a fixed header and preallocated, fixed-size records that is mapped in memory: appending a frame is a copy into memory
+(the OS writes it to the disk in the background), nothing waits for the disk. The journal is removed once the trial
+is saved, so the journals that are left when the app starts belong to trials that were never saved.
+"""
+
+logger = get_logbook('data_journal')
+
+MAGIC = b'G4JRNL01'
+# the records start at the next page, the header is the magic, the length of the metadata and the metadata (json)
+HEADER_SIZE = 4096
+JOURNAL_EXTENSION = '.g4j'
+
+
+def journal_dir():
+    """
+    Folder with the journals (next to the logs)
+    """
+    if getattr(sys, 'frozen', False):
+        return os.path.join(os.path.expanduser('~'), 'AppData', 'Roaming', NAME_APP, 'journal')
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'journal')
+
+
+def record_dtype(sensors):
+    """
+    Layout of a record, 'valid' is written last so a record that was cut off by a crash is not used
+    :param sensors: number of sensors in every frame
+    """
+    return np.dtype([('frame', '<i8'), ('time', '<f8'), ('dig_io', '<u4'), ('valid', '<u4'),
+                     ('pos', '<f4', (sensors, 3)), ('ori', '<f4', (sensors, 4))])
+
+
+class TrialJournal:
+    """
+    Journal of a single trial, see the top of this file
+    """
+    def __init__(self, path, metadata, records):
+        """
+        Use TrialJournal.create or TrialJournal.open
+        :param path: path of the journal
+        :param metadata: the metadata of the header
+        :param records: memory-mapped array with all the records
+        """
+        self.path = path
+        self.metadata = metadata
+        self.records = records
+        self.size = int(np.argmin(records['valid'])) if not records['valid'].all() else len(records)
+        self.full = False
+
+    @classmethod
+    def create(cls, fs, roles, **metadata):
+        """
+        Make a new journal with room for JOURNAL_MINUTES of frames
+        :param fs: sample frequency
+        :param roles: role of every sensor in the frames
+        :param metadata: information to rebuild the trial (participant, folder, trial number, ...)
+        """
+        os.makedirs(journal_dir(), exist_ok=True)
+        path = os.path.join(journal_dir(), f"{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}_"
+                                           f"{metadata.get('trial', 0)}{JOURNAL_EXTENSION}")
+        metadata.update({'fs': fs, 'roles': list(roles), 'created': time.time()})
+
+        header = json.dumps(metadata).encode('utf-8')
+        if len(header) > HEADER_SIZE - len(MAGIC) - 4:
+            raise ValueError("Metadata of the journal is too large")
+        capacity = int(fs * 60 * JOURNAL_MINUTES)
+        dtype = record_dtype(len(roles))
+
+        # write the whole file now, so appending never has to grow the file
+        with open(path, 'wb') as file:
+            file.write(MAGIC + np.uint32(len(header)).tobytes() + header)
+            file.write(bytes(HEADER_SIZE - file.tell()))
+            chunk = bytes(1 << 20)
+            remaining = capacity * dtype.itemsize
+            while remaining > 0:
+                file.write(chunk[:min(remaining, len(chunk))])
+                remaining -= len(chunk)
+
+        records = np.memmap(path, dtype=dtype, mode='r+', offset=HEADER_SIZE, shape=(capacity,))
+        return cls(path, metadata, records)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Open an existing journal (read-only)
+        :param path: path of the journal
+        """
+        with open(path, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a journal")
+            length = int(np.frombuffer(file.read(4), dtype=np.uint32)[0])
+            metadata = json.loads(file.read(length).decode('utf-8'))
+
+        records = np.memmap(path, dtype=record_dtype(len(metadata['roles'])), mode='r', offset=HEADER_SIZE)
+        return cls(path, metadata, records)
+
+    def append(self, frame, time_now, positions, orientations=None, dig_io=0):
+        """
+        Add a frame at the end of the journal
+        :param frame: frame number of the sensor
+        :param time_now: time (s) of the frame in the trial
+        :param positions: positions of the sensors with shape (sensors, 3)
+        :param orientations: orientations of the sensors with shape (sensors, 4)
+        :param dig_io: digital input of the frame
+        """
+        if self.size == len(self.records):
+            if not self.full:
+                self.full = True
+                logger.warning(f"Journal {self.path} is full, the rest of the trial is not journaled")
+            return
+
+        record = self.records[self.size]
+        record['frame'] = frame
+        record['time'] = time_now
+        record['dig_io'] = dig_io
+        record['pos'] = positions
+        if orientations is not None:
+            record['ori'] = orientations
+        record['valid'] = 1
+        self.size += 1
+
+    def close(self):
+        """
+        Write everything to the disk
+        """
+        if self.records is not None:
+            if self.records.mode == 'r+':
+                self.records.flush()
+            # the file is closed once the last reference to the mapping is gone
+            self.records = None
+
+    def discard(self):
+        """
+        The trial is saved: remove the journal
+        """
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            logger.warning(f"Failed to remove journal {self.path}: {e}")
+
+    def to_buffer(self):
+        """
+        Rebuild the trial out of the frames in the journal (the speed is calculated again)
+        :rtype: TrialBuffer
+        """
+        records = self.records[:self.size]
+        buffer = TrialBuffer(max(1, self.size), self.metadata['roles'], self.metadata.get('orientation', False))
+        for record in records:
+            buffer.append_positions(float(record['time']), record['pos'], record['ori'])
+        return buffer
+
+
+def find_journals():
+    """
+    :return: paths of the journals of trials that were never saved
+    """
+    return sorted(glob.glob(os.path.join(journal_dir(), '*' + JOURNAL_EXTENSION)))
+
+
+def save_trial_excel(trial_file, buffer):
+    """
+    Save the samples of a trial with the same columns as the export of the app (without events and score)
+    :param trial_file: path of the trial_N.xlsx
+    :param buffer: the data of the trial
+    :type buffer: TrialBuffer
+    """
+    data = {"Time (s)": buffer.xs}
+    for name, sensor in (("Left", buffer.left), ("Right", buffer.right)):
+        data[f"{name} Sensor x (cm)"] = sensor[:, 0]
+        data[f"{name} Sensor y (cm)"] = sensor[:, 1]
+        data[f"{name} Sensor z (cm)"] = sensor[:, 2]
+        data[f"{name} Sensor v (m/s)"] = sensor[:, 3]
+    pd.DataFrame(data).to_excel(trial_file, index=False)
+
+    if buffer.has_orientation:
+        save_orientation(trial_file, buffer)
+    if buffer.extra_roles:
+        save_extra_sensors(trial_file, buffer)
+
+
+def recover_journal(path):
+    """
+    Save the trial of a journal as an Excel in the folder of the participant and remove the journal
+    :param path: path of the journal
+    :return: path of the Excel
+    """
+    journal = TrialJournal.open(path)
+    metadata = journal.metadata
+    folder = metadata.get('folder') or os.path.join(metadata.get('save_dir', journal_dir()),
+                                                    f"{metadata.get('participant', 'unknown')}_recovered")
+    os.makedirs(folder, exist_ok=True)
+
+    trial_file = os.path.join(folder, f"trial_{metadata.get('trial', 0) + 1}.xlsx")
+    if os.path.exists(trial_file):
+        trial_file = os.path.join(folder, f"trial_{metadata.get('trial', 0) + 1}_recovered.xlsx")
+
+    save_trial_excel(trial_file, journal.to_buffer())
+    journal.discard()
+    return trial_file
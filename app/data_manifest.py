@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from logger import get_logbook
+
+"""
+Manifest of a participant folder (manifest.json): everything that is needed to rebuild the trials in the app (score,
+events, notes, parameters, ...) without parsing the PDF and the Excels again. It is written on every export, together
+with the size, modification time and hash of the files it belongs to. When one of the files changed after the export,
+the manifest is not used and the folder is read the old way.
+
+The manifest is written from more than one thread (the background saving, the export and the PDF). Every writer only
+keeps its own changes (start from ParticipantManifest(folder)), save merges them into the manifest on the disk.
+"""
+
+logger = get_logbook('data_manifest')
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+# only one thread at a time reads, merges and writes a manifest
+_save_lock = threading.Lock()
+
+
+def _json_value(value):
+    if isinstance(value, (np.integer, np.floating, np.bool_)):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} can not be saved in the manifest")
+
+
+def file_hash(path):
+    """
+    :param path: path of the file
+    :return: hash of the content of the file
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_signature(path):
+    """
+    :param path: path of the file
+    :return: size, modification time and hash of the file
+    """
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': file_hash(path)}
+
+
+def same_file(path, signature):
+    """
+    Check if a file is still the file of the signature, the hash is only calculated if the size is the same but the
+    modification time is not (a copy of the folder)
+    :param path: path of the file
+    :param signature: the signature from file_signature
+    """
+    if not signature or not os.path.exists(path):
+        return False
+    stat = os.stat(path)
+    if stat.st_size != signature.get('size'):
+        return False
+    if stat.st_mtime_ns == signature.get('mtime_ns'):
+        return True
+    return file_hash(path) == signature.get('hash')
+
+
+class ParticipantManifest:
+    """
+    The manifest of a single participant folder, see the top of this file
+    """
+    def __init__(self, folder, data=None):
+        """
+        Use ParticipantManifest.load
+        :param folder: the participant folder
+        :param data: content of the manifest.json
+        """
+        self.folder = folder
+        self.data = data if data is not None else {'version': MANIFEST_VERSION, 'trials': {}, 'pdf': None}
+
+    @classmethod
+    def load(cls, folder):
+        """
+        Read the manifest of the folder, an empty manifest if there is none (or it can not be read)
+        :param folder: the participant folder
+        """
+        path = os.path.join(folder, MANIFEST_NAME)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+            if data.get('version') == MANIFEST_VERSION:
+                return cls(folder, data)
+            logger.info(f"Manifest {path} has an older version, it is not used")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read manifest {path}: {e}")
+        return cls(folder)
+
+    @property
+    def path(self):
+        return os.path.join(self.folder, MANIFEST_NAME)
+
+    def set_trial(self, index, trial_file, state):
+        """
+        Save the state of a trial that is just exported
+        :param index: index of the trial
+        :param trial_file: path of the trial_N.xlsx that belongs to the state
+        :param state: everything that is needed to rebuild the tab (score, events, notes, ...)
+        :type state: dict
+        """
+        entry = dict(state)
+        entry['file'] = os.path.basename(trial_file)
+        entry['signature'] = file_signature(trial_file)
+        self.data['trials'][str(index)] = entry
+
+    def set_pdf(self, pdf_file):
+        """
+        :param pdf_file: path of the PDF that is just exported
+        """
+        self.data['pdf'] = {'file': os.path.basename(pdf_file), 'signature': file_signature(pdf_file)}
+
+    def trial(self, trial_file):
+        """
+        :param trial_file: path of the trial_N.xlsx
+        :return: the saved state of the trial, None if it is not in the manifest
+        """
+        name = os.path.basename(trial_file)
+        for entry in self.data['trials'].values():
+            if entry['file'] == name:
+                return entry
+        return None
+
+    def is_current(self, trial_files, pdf_files):
+        """
+        Check if the manifest belongs to the files in the folder: every trial has to be in the manifest and none of
+        the files can be changed after the export
+        :param trial_files: paths of the trial_N.xlsx in the folder
+        :param pdf_files: paths of the PDFs in the folder
+        """
+        if not trial_files:
+            return False
+
+        for trial_file in trial_files:
+            entry = self.trial(trial_file)
+            if entry is None or not same_file(trial_file, entry['signature']):
+                return False
+
+        # the notes and scores of a PDF that is not from the last export can be different
+        pdf = self.data.get('pdf')
+        for pdf_file in pdf_files:
+            if pdf is None or os.path.basename(pdf_file) != pdf['file'] or not same_file(pdf_file, pdf['signature']):
+                return False
+        return True
+
+    def save(self):
+        """
+        Merge the changes into the manifest of the folder (the one on the disk can be changed by another thread in the
+        meantime) and write it
+        """
+        with _save_lock:
+            current = ParticipantManifest.load(self.folder)
+            current.data['trials'].update(self.data['trials'])
+            if self.data.get('pdf') is not None:
+                current.data['pdf'] = self.data['pdf']
+            self.data = current.data
+
+            self.data['saved'] = time.time()
+            try:
+                with open(self.path + '.tmp', 'w', encoding='utf-8') as file:
+                    json.dump(self.data, file, default=_json_value, indent=1)
+                os.replace(self.path + '.tmp', self.path)
+            except OSError as e:
+                logger.warning(f"Failed to write manifest {self.path}: {e}")
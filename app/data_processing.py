@@ -1,12 +1,15 @@
 # import logging
+import os
 
 import numpy as np
 from scipy.interpolate import CubicSpline
-from scipy.signal import argrelextrema
+from scipy.signal import argrelextrema, butter, sosfiltfilt
 
+from constants import SPLINE_SPARSE_GAPS, SPLINE_GAP_MARGIN
 from logger import get_logbook
 from widget_settings import manage_settings
-from sensor_G4Track import *
+from sensor_backend import get_frame_data, get_active_hubs, get_station_map, frame_reference_orientation, \
+    frame_reference_orientation_reset, frame_reference_translation, frame_reference_translation_reset
 import time
 from scipy.spatial.transform import Rotation as R
 
@@ -18,6 +21,8 @@ model_dir = os.path.join(file_directory, 'scoring_model.keras')
 model = keras.models.load_model(model_dir)
 # Load the logger
 logger = get_logbook('data_processing')
+# The Butterworth filters (second-order sections) that are already designed, for every (fs, fc, order)
+_butter_filters = {}
 
 
 class Calibration:
@@ -306,6 +311,49 @@ class Calibration:
         return all(abs(xyz) < THRESHOLD_CALIBRATION for xyz in diff)
 
 
+def butter_filter(fs, fc, order):
+    """
+    The low-pass Butterworth filter as second-order sections, only designed once for every setting
+    :param fs: sample frequency
+    :param fc: cut-off frequency
+    :param order: order of the filter
+    """
+    key = (fs, fc, order)
+    if key not in _butter_filters:
+        _butter_filters[key] = butter(N=order, Wn=fc / (0.5 * fs), btype='low', output='sos', analog=False)
+    return _butter_filters[key]
+
+
+def filter_hands(xs, log_left, log_right, speed_filter=None):
+    """
+    Zero-phase Butterworth filter on the speed (and first the coordinates, the speed is then calculated again out of
+    the filtered coordinates), all the channels of both hands at once
+    :param xs: the timestamps of the trial
+    :param log_left: the coordinates and speed left with shape (N, 4)
+    :param log_right: the coordinates and speed right with shape (N, 4)
+    :param speed_filter: only filter the speed, None to use the setting SPEED_FILTER
+    :return: the filtered coordinates and speed of both hands, with shape (N, 4)
+    """
+    fs = manage_settings.get("Sensors", "fs")
+    fc = manage_settings.get("Sensors", "fc")
+    ORDER_FILTER = manage_settings.get("Data-processing", "ORDER_FILTER")
+    if speed_filter is None:
+        speed_filter = manage_settings.get("Data-processing", "SPEED_FILTER")
+
+    sos = butter_filter(fs, fc, ORDER_FILTER)
+    hands = np.stack([np.asarray(log_left, dtype=np.float64), np.asarray(log_right, dtype=np.float64)], axis=1)
+
+    if not speed_filter:
+        coor = sosfiltfilt(sos, hands[:, :, :3].reshape(len(hands), 6), axis=0).reshape(-1, 2, 3)
+        hands[:, :, :3] = coor
+        hands[0, :, 3] = 0
+        time = np.diff(np.asarray(xs, dtype=np.float64))[:, None]
+        hands[1:, :, 3] = np.sqrt(np.square(np.diff(coor, axis=0)).sum(axis=2)) / time / 100
+
+    hands[:, :, 3] = sosfiltfilt(sos, hands[:, :, 3], axis=0)
+    return hands[:, 0], hands[:, 1]
+
+
 def check_interpolation_needed(xs, tol=1e-5):
     """
     Check the data and look if there are gaps between the time larger than tol
@@ -321,43 +369,140 @@ def check_interpolation_needed(xs, tol=1e-5):
     return consistent
 
 
-def interpolate(xs, log_left, log_right):
+def _resample_gaps(times, coor, new_time, tol):
     """
-    Add extra samples so the fs-rate is guaranteed. Using a spline interpolation to match the smoothness of the
-    functions.
+    Resample with a spline around the gaps only: the new timestamps that have a sample (within tol) keep that sample,
+    the others are taken from a spline through the samples around them
+    :param times: the timestamps of the trial
+    :param coor: the coordinates of both hands with shape (N, 6)
+    :param new_time: the new timestamps (at a rate of fs, starting at the first timestamp)
+    :param tol: accepted difference between a timestamp and a new timestamp
+    :return: the coordinates at the new timestamps, None if there are too many gaps for this
+    """
+    fs = manage_settings.get("Sensors", "fs")
+
+    steps = np.rint((times - times[0]) * fs).astype(np.int64)
+    on_grid = (np.abs(times - (times[0] + steps / fs)) < tol) & (steps < len(new_time))
+    # two samples at the same new timestamp: both are left to the spline
+    same = np.flatnonzero(np.diff(steps) == 0)
+    on_grid[same] = False
+    on_grid[same + 1] = False
+
+    source = np.full(len(new_time), -1, dtype=np.int64)
+    source[steps[on_grid]] = np.flatnonzero(on_grid)
+    missing = np.flatnonzero(source < 0)
+    # gaps that are close to each other share their spline
+    breaks = np.flatnonzero(np.diff(missing) > 2 * SPLINE_GAP_MARGIN)
+    if len(missing) + (len(breaks) + 1) * 2 * SPLINE_GAP_MARGIN > SPLINE_SPARSE_GAPS * len(new_time):
+        return None
+
+    new_coor = np.empty((len(new_time), coor.shape[1]), dtype=np.float64)
+    found = source >= 0
+    new_coor[found] = coor[source[found]]
+    if len(missing) == 0:
+        return new_coor
+
+    for first, last in zip(np.r_[0, breaks + 1], np.r_[breaks, len(missing) - 1]):
+        points = missing[first:last + 1]
+        start = max(np.searchsorted(times, new_time[points[0]], 'right') - 1 - SPLINE_GAP_MARGIN, 0)
+        stop = min(np.searchsorted(times, new_time[points[-1]], 'left') + 1 + SPLINE_GAP_MARGIN, len(times))
+        new_coor[points] = CubicSpline(times[start:stop], coor[start:stop], axis=0)(new_time[points])
+    return new_coor
+
+
+def interpolate(xs, log_left, log_right, tol=1e-5):
+    """
+    Add extra samples so the fs-rate is guaranteed. Using a spline interpolation (all the coordinates at once) to match
+    the smoothness of the functions. If there are only a few gaps, only the samples around them are used for the spline.
     :param xs: list of all the timestamps of the trial
     :param log_left: list of all the coordinates and speed left of the trial
     :param log_right: list of all the coordinates and speed right of the trial
-    :return: the new timestamps (at a rate of fs) and the new coordinates !!!only coordinates, not speed
+    :param tol: accepted difference between the timestamps and the rate of fs
+    :return: the new timestamps (at a rate of fs) and the new coordinates and speed of both hands, with shape (N, 4)
     """
-    if check_interpolation_needed(xs):
+    if check_interpolation_needed(xs, tol):
         return [], [], []
     fs = manage_settings.get("Sensors", "fs")
 
-    times = np.array(xs)
-    data_left = np.array(log_left)
-    coor_left = data_left[:, :3]
-    data_right = np.array(log_right)
-    coor_right = data_right[:, :3]
+    times = np.asarray(xs, dtype=np.float64)
+    coor = np.concatenate([np.asarray(log_left, dtype=np.float64)[:, :3],
+                           np.asarray(log_right, dtype=np.float64)[:, :3]], axis=1)
 
     times_interp = np.arange(xs[0], xs[-1], 1/fs)
-    new_log_left = []
-    for dim_i in range(coor_left.shape[1]):
-        interpol_spline = CubicSpline(times, coor_left[:, dim_i])
-        interpol_coor = interpol_spline(times_interp)
-        new_log_left.append(interpol_coor)
-    new_log_left = np.stack(new_log_left, axis=1)
-
-    new_log_right = []
-    for dim_i in range(coor_right.shape[1]):
-        interpol_spline = CubicSpline(times, coor_right[:, dim_i])
-        interpol_coor = interpol_spline(times_interp)
-        new_log_right.append(interpol_coor)
-    new_log_right = np.stack(new_log_right, axis=1)
+    new_coor = _resample_gaps(times, coor, times_interp, tol)
+    if new_coor is None:
+        new_coor = CubicSpline(times, coor, axis=0)(times_interp)
 
+    speed = np.zeros((len(times_interp), 2), dtype=np.float64)
+    speed[1:] = np.sqrt(np.square(np.diff(new_coor.reshape(-1, 2, 3), axis=0) * fs).sum(axis=2)) / 100
+
+    new_log_left = np.column_stack([new_coor[:, :3], speed[:, 0]])
+    new_log_right = np.column_stack([new_coor[:, 3:], speed[:, 1]])
     return times_interp, new_log_left, new_log_right
 
 
+def interpolate_orientation(xs, orientation, new_time):
+    """
+    Resample the orientation of the sensors to new timestamps (linear, the Euler angles are unwrapped first)
+    :param xs: list of all the timestamps of the trial
+    :param orientation: orientation of all sensors with shape (N, sensors, 4)
+    :param new_time: the new timestamps
+    :return: the orientation at the new timestamps
+    """
+    flat = np.unwrap(np.asarray(orientation, dtype=np.float64).reshape(len(xs), -1), period=360, axis=0)
+    new_orientation = np.empty((len(new_time), flat.shape[1]), dtype=np.float32)
+    for column in range(flat.shape[1]):
+        new_orientation[:, column] = (np.interp(new_time, xs, flat[:, column]) + 180) % 360 - 180
+    return new_orientation.reshape((len(new_time),) + np.shape(orientation)[1:])
+
+
+def interpolate_sensors(xs, sensors, new_time):
+    """
+    Resample the extra sensors to new timestamps with the same spline interpolation as the hands
+    :param xs: list of all the timestamps of the trial
+    :param sensors: coordinates and speed of the extra sensors with shape (N, sensors, 4)
+    :param new_time: the new timestamps
+    :return: the coordinates and speed (calculated again) at the new timestamps
+    """
+    fs = manage_settings.get("Sensors", "fs")
+
+    sensors = np.asarray(sensors, dtype=np.float64)
+    new_sensors = np.zeros((len(new_time),) + sensors.shape[1:], dtype=np.float64)
+    new_sensors[:, :, :3] = CubicSpline(np.asarray(xs), sensors[:, :, :3], axis=0)(new_time)
+    new_sensors[1:, :, 3] = np.sqrt(np.square(np.diff(new_sensors[:, :, :3], axis=0) * fs).sum(axis=2)) / 100
+    return new_sensors
+
+
+def calculate_wrist_rotation(orientation, start, stop):
+    """
+    Rotation of the wrist (roll of the sensor) between two events
+    :param orientation: orientation of one sensor with shape (N, 4), Euler angles in degrees (azimuth, elevation, roll)
+    :param start: index of the first event
+    :param stop: index of the last event
+    :return: the range of the roll and the total rotation of the roll, both in degrees
+    :rtype: (float, float)
+    """
+    roll = np.unwrap(np.asarray(orientation[start:stop + 1, 2], dtype=np.float64), period=360)
+    if len(roll) == 0:
+        return 0.0, 0.0
+    return float(roll.max() - roll.min()), float(np.sum(np.abs(np.diff(roll))))
+
+
+def calculate_wrist_parameters(orientation, events, box_sensor):
+    """
+    Rotation of the wrist of the box hand (e1 to e3) and of the trigger hand (e4 to e6)
+    :param orientation: orientation of all sensors with shape (N, sensors, 4)
+    :param events: index of the first 6 events
+    :param box_sensor: index of the sensor on the box hand (the trigger hand is the other hand)
+    :return: range and total rotation of the box hand, range and total rotation of the trigger hand
+    :rtype: list
+    """
+    e1, e2, e3, e4, e5, e6 = events[0:6]
+    box_range, box_total = calculate_wrist_rotation(orientation[:, box_sensor], e1, e3)
+    trigger_range, trigger_total = calculate_wrist_rotation(orientation[:, 1 - box_sensor], e4, e6)
+    return [box_range, box_total, trigger_range, trigger_total]
+
+
 def predict_score(pos_left, pos_right):
     """
     Predict the score using a neural network
@@ -384,30 +529,53 @@ def predict_score(pos_left, pos_right):
     return round(prediction[0][0]) if prediction[0][0] < 2.46 else 3
 
 
-def calculate_boxhand(pos_left, pos_right, score=-1):
+def _boxhand_settings():
     """
-    Calculate the case of the movement
-    :param pos_left: list of coordinates of the left hand
-    :param pos_right: list of coordinates of the right hand
-    :param score: Score according to neural net, -1 if not used
-    :returns:
-        0 if the left hand is the box hand,
-        1 if the right hand is the box hand
-        2 if both hands are used simultaneous, but right pressed
-        3 if both hands are used simultaneous, but left pressed
-        4 if the left hand is not used
-        5 if the right hand is not used
-        6 if the hands switched, but right pressed
-        7 if the hands switched, but left pressed
+    :return: the settings used by calculate_boxhand
     """
-    MAX_HEIGHT_NEEDED = manage_settings.get("Data-processing", "MAX_HEIGHT_NEEDED")
-    POSITION_BUTTON = manage_settings.get("Calibration", "POSITION_BUTTON")
-    MAX_LENGTH_NEEDED = manage_settings.get("Data-processing", "MAX_LENGTH_NEEDED")
-    MIN_HEIGHT_NEEDED = manage_settings.get("Data-processing", "MIN_HEIGHT_NEEDED")
-    MIN_LENGTH_NEEDED = manage_settings.get("Data-processing", "MIN_LENGTH_NEEDED")
-    THRESHOLD_BOTH_HANDS = manage_settings.get("Data-processing", "THRESHOLD_BOTH_HANDS")
-    HEIGHT_BOX = manage_settings.get("Data-processing", "HEIGHT_BOX")
-    THRESHOLD_CHANGED_HANDS_MEAS = manage_settings.get("Data-processing", "THRESHOLD_CHANGED_HANDS_MEAS")
+    return {key: manage_settings.get(category, key) for category, key in (
+        ("Data-processing", "MAX_HEIGHT_NEEDED"), ("Calibration", "POSITION_BUTTON"),
+        ("Data-processing", "MAX_LENGTH_NEEDED"), ("Data-processing", "MIN_HEIGHT_NEEDED"),
+        ("Data-processing", "MIN_LENGTH_NEEDED"), ("Data-processing", "THRESHOLD_BOTH_HANDS"),
+        ("Data-processing", "HEIGHT_BOX"), ("Data-processing", "THRESHOLD_CHANGED_HANDS_MEAS"))}
+
+
+def _sequential_sum(start, steps):
+    """
+    Add the steps one after the other to start (np.cumsum does not use pairwise summation like np.sum), so the result
+    is exactly the same as adding them in a loop
+    """
+    steps = np.ravel(steps)
+    if len(steps) == 0:
+        return start
+    return np.cumsum(np.concatenate((np.asarray([start], dtype=steps.dtype), steps)))[-1]
+
+
+def _boxhand_counter(hand, start, counter, increment, settings):
+    """
+    Count the samples of a hand that stay near the start (-1) and the samples that go far from it (+increment)
+    :param hand: the samples that are counted, in the order they are counted (N, >=3)
+    :param start: first sample of the hand
+    :param counter: value to start counting from
+    """
+    low = (hand[:, 2] < settings["MAX_HEIGHT_NEEDED"] + start[2]) & \
+        (hand[:, 1] < settings["MAX_LENGTH_NEEDED"] + start[1])
+    high = (hand[:, 2] > settings["MIN_HEIGHT_NEEDED"] + start[2]) & \
+        (hand[:, 1] > settings["MIN_LENGTH_NEEDED"] + start[1])
+
+    steps = np.zeros((len(hand), 2))
+    steps[low, 0] = -1
+    steps[high, 1] = increment
+    return _sequential_sum(counter, steps)
+
+
+def _boxhand_case(pos_left, pos_right, score, settings):
+    """
+    calculate_boxhand for a single trial, with the settings already read
+    :param pos_left: the samples of the left hand (N, 4)
+    :param pos_right: the samples of the right hand (N, 4)
+    """
+    POSITION_BUTTON = settings["POSITION_BUTTON"]
 
     mse_left = 0
     mse_right = 0
@@ -419,6 +587,7 @@ def calculate_boxhand(pos_left, pos_right, score=-1):
             mse_left += (pos_left[-1][i] - POSITION_BUTTON[i]) ** 2 / 3
             mse_right += (pos_right[-1][i] - POSITION_BUTTON[i]) ** 2 / 3
 
+    length = len(pos_left)
     match score:
         case 3:
             if mse_left >= mse_right:
@@ -431,101 +600,96 @@ def calculate_boxhand(pos_left, pos_right, score=-1):
             else:
                 return 3
         case 1:
-            counter_left = 0
-            counter_right = 0
-            start_left = pos_left[0]
-            start_right = pos_right[0]
-
-            range_list = range(-1, -len(pos_left), -1) if len(pos_left) < 50 else range(-1, -50, -1)
-
-            for i in range_list:
-                if pos_left[i][2] < MAX_HEIGHT_NEEDED + start_left[2] and pos_left[i][1] < MAX_LENGTH_NEEDED + \
-                        start_left[1]:
-                    counter_left -= 1
-                if pos_right[i][2] < MAX_HEIGHT_NEEDED + start_right[2] and \
-                        pos_right[i][1] < MAX_LENGTH_NEEDED + start_right[1]:
-                    counter_right -= 1
-
-                if pos_left[i][2] > MIN_HEIGHT_NEEDED + start_left[2] and pos_left[i][1] > MIN_LENGTH_NEEDED + \
-                        start_left[1]:
-                    counter_left += 1 * len(pos_left) / 6
-                if pos_right[i][2] > MIN_HEIGHT_NEEDED + start_right[2] and pos_right[i][1] > MIN_LENGTH_NEEDED + \
-                        start_right[
-                            1]:
-                    counter_right += 1 * len(pos_left) / 6
+            # the last 49 samples (all but the first for a short trial), from the end to the start
+            counted = slice(None, 0 if length <= 50 else -50, -1)
+            counter_left = _boxhand_counter(pos_left[counted], pos_left[0], 0, 1 * length / 6, settings)
+            counter_right = _boxhand_counter(pos_right[counted], pos_right[0], 0, 1 * length / 6, settings)
 
             if counter_right < counter_left:
                 return 5
             else:
                 return 4
         case -1:
-            start_left = pos_left[0]
-            start_right = pos_right[0]
-
-            counter_left = 7 * len(pos_left) / 8
-            counter_right = 7 * len(pos_right) / 8
-            for i in range(-1, -len(pos_left), -1):
-                if pos_left[i][2] < MAX_HEIGHT_NEEDED + start_left[2] and pos_left[i][1] < MAX_LENGTH_NEEDED + \
-                        start_left[1]:
-                    counter_left -= 1
-                if pos_right[i][2] < MAX_HEIGHT_NEEDED + start_right[2] and \
-                        pos_right[i][1] < MAX_LENGTH_NEEDED + start_right[1]:
-                    counter_right -= 1
-
-                if pos_left[i][2] > MIN_HEIGHT_NEEDED + start_left[2] and pos_left[i][1] > MIN_LENGTH_NEEDED + \
-                        start_left[1]:
-                    counter_left += 1 * len(pos_left) / 6
-                if pos_right[i][2] > MIN_HEIGHT_NEEDED + start_right[2] and pos_right[i][1] > MIN_LENGTH_NEEDED + \
-                        start_right[
-                            1]:
-                    counter_right += 1 * len(pos_left) / 6
+            # all the samples but the first, from the end to the start
+            counted = slice(None, 0, -1)
+            counter_left = _boxhand_counter(pos_left[counted], pos_left[0], 7 * length / 8, 1 * length / 6, settings)
+            counter_right = _boxhand_counter(pos_right[counted], pos_right[0], 7 * len(pos_right) / 8,
+                                             1 * length / 6, settings)
 
             if counter_left <= 0:
                 return 4
             if counter_right <= 0:
                 return 5
 
-            mse_both_hands = 0
-            counter_change = 0
-            for time in range(-1, -len(pos_left), -1):
-                for pos in range(1, 3):
-                    mse_both_hands += (pos_left[time][pos] - pos_right[time][pos]) ** 2 / (2 * len(pos_left))
-
-                if pos_left[time][2] >= HEIGHT_BOX and pos_right[time][2] >= HEIGHT_BOX and \
-                        pos_left[time][1] > MIN_LENGTH_NEEDED + start_left[1] and \
-                        pos_right[time][1] > MIN_LENGTH_NEEDED + start_right[1]:
-                    counter_change += 1
-
-            print(mse_both_hands)
+            left, right = pos_left[counted], pos_right[counted]
+            mse_both_hands = _sequential_sum(0, (left[:, 1:3] - right[:, 1:3]) ** 2 / (2 * length))
+            counter_change = np.count_nonzero(
+                (left[:, 2] >= settings["HEIGHT_BOX"]) & (right[:, 2] >= settings["HEIGHT_BOX"]) &
+                (left[:, 1] > settings["MIN_LENGTH_NEEDED"] + pos_left[0][1]) &
+                (right[:, 1] > settings["MIN_LENGTH_NEEDED"] + pos_right[0][1]))
 
             if mse_left >= mse_right:
-                if mse_both_hands < THRESHOLD_BOTH_HANDS:
+                if mse_both_hands < settings["THRESHOLD_BOTH_HANDS"]:
                     return 2
-                elif counter_change > THRESHOLD_CHANGED_HANDS_MEAS:
+                elif counter_change > settings["THRESHOLD_CHANGED_HANDS_MEAS"]:
                     return 6
                 return 0
             else:
-                if mse_both_hands < THRESHOLD_BOTH_HANDS:
+                if mse_both_hands < settings["THRESHOLD_BOTH_HANDS"]:
                     return 3
-                elif counter_change > THRESHOLD_CHANGED_HANDS_MEAS:
+                elif counter_change > settings["THRESHOLD_CHANGED_HANDS_MEAS"]:
                     return 7
                 return 1
 
 
-def calculate_events(pos_left, pos_right, case, score):
+def calculate_boxhand(pos_left, pos_right, score=-1):
     """
-    Calculate the events (5 in total + 1 at the end calculate_e6)
-    :param pos_left: list of coordinates of the left hand
-    :param pos_right: list of coordinates of the right hand
-    :param case: case as estimated in calculate_boxhand
-    :param score: score of the movement (currently not used)
-    :return: list of the events
+    Calculate the case of the movement
+    :param pos_left: list of coordinates of the left hand (or array (N, 4))
+    :param pos_right: list of coordinates of the right hand (or array (N, 4))
+    :param score: Score according to neural net, -1 if not used
+    :returns:
+        0 if the left hand is the box hand,
+        1 if the right hand is the box hand
+        2 if both hands are used simultaneous, but right pressed
+        3 if both hands are used simultaneous, but left pressed
+        4 if the left hand is not used
+        5 if the right hand is not used
+        6 if the hands switched, but right pressed
+        7 if the hands switched, but left pressed
     """
-    MAX_HEIGHT_NEEDED = manage_settings.get("Data-processing", "MAX_HEIGHT_NEEDED")
-    MAX_LENGTH_NEEDED = manage_settings.get("Data-processing", "MAX_LENGTH_NEEDED")
-    SPEED_THRESHOLD = manage_settings.get("Data-processing", "SPEED_THRESHOLD")
-    # USE_NEURAL_NET = manage_settings.get("General", "USE_NEURAL_NET")
-    fs = manage_settings.get("Sensors", "fs")
+    return _boxhand_case(np.asarray(pos_left, dtype=np.float64), np.asarray(pos_right, dtype=np.float64), score,
+                         _boxhand_settings())
+
+
+def _events_settings():
+    """
+    :return: the settings used by calculate_events
+    """
+    return {key: manage_settings.get(category, key) for category, key in (
+        ("Data-processing", "MAX_HEIGHT_NEEDED"), ("Data-processing", "MAX_LENGTH_NEEDED"),
+        ("Data-processing", "SPEED_THRESHOLD"), ("Sensors", "fs"))}
+
+
+def _move_back(speed, start, threshold):
+    """
+    Go back from start as long as the speed before it is above the threshold, the same as
+    while start > 1 and speed[start - 1] >= threshold: start -= 1
+    """
+    if start <= 1:
+        return start
+    # a NaN also stops, like in the loop
+    below = np.flatnonzero(~(speed[1:start] >= threshold))
+    return int(below[-1]) + 2 if len(below) else 1
+
+
+def _trial_events(pos_left, pos_right, case, settings):
+    """
+    calculate_events for a single trial, with the settings already read
+    :param pos_left: the samples of the left hand (N, 4)
+    :param pos_right: the samples of the right hand (N, 4)
+    """
+    SPEED_THRESHOLD = settings["SPEED_THRESHOLD"]
 
     if case == 0 or case == 2 or case == 7:
         trigger_hand, box_hand = pos_right, pos_left
@@ -541,50 +705,36 @@ def calculate_events(pos_left, pos_right, case, score):
     e6 = len(pos_left) - 1
 
     try:
-        v_th = np.array([pos[3] for pos in trigger_hand])
-        v_bh = np.array([pos[3] for pos in box_hand])
+        v_th = trigger_hand[:, 3]
+        v_bh = box_hand[:, 3]
 
-        a_bh = np.array(np.diff(v_bh) * fs)
+        a_bh = np.diff(v_bh) * settings["fs"]
 
-        # calculating e1
-        e1 = np.argmax(v_bh > SPEED_THRESHOLD)
-        while e1 > 1 and a_bh[e1] >= 0:
-            e1 -= 1
-        print("e1", e1)
+        # calculating e1: back from the first sample above the threshold to the last sample that slows down
+        e1 = int(np.argmax(v_bh > SPEED_THRESHOLD))
+        if e1 > 1 and a_bh[e1] >= 0:
+            slowing = np.flatnonzero(~(a_bh[2:e1] >= 0))
+            e1 = int(slowing[-1]) + 2 if len(slowing) else 1
 
         # calculating e2 --> change maybe
         piek_1 = np.argmax(v_bh[e1:e1 + 51]) + e1 - 1
-        print("piek_1 ", piek_1)
         piek_2 = np.argmax(v_bh[piek_1 + 51:piek_1 + 1001]) + piek_1 + 50 - 1
-        print("piek_2 ", piek_2)
-        e2 = np.argmin(v_bh[piek_1:piek_2]) + piek_1 - 1
-        print("e2 ", e2)
+        e2 = int(np.argmin(v_bh[piek_1:piek_2]) + piek_1 - 1)
 
         # calculating e3
-        z_bh = np.array([pos[2] for pos in box_hand])
-        e3 = np.argmax(z_bh[1:e6])
-        print("e3", e3)
+        z_bh = box_hand[:, 2]
+        e3 = int(np.argmax(z_bh[1:e6]))
 
-        # calculating e4 and e5
+        # calculating e4 and e5: e4 is the last sample before the trigger hand leaves its start
         start_trigger = pos_left[0]
+        at_start = (trigger_hand[:, 2] < settings["MAX_HEIGHT_NEEDED"] + start_trigger[2]) & \
+            (trigger_hand[:, 1] < settings["MAX_LENGTH_NEEDED"] + start_trigger[1])
+        if at_start.all():
+            raise IndexError("the trigger hand never leaves its start")
+        e4 = max(int(np.argmin(at_start)) - 1, 0)
 
-        e4 = 0
-        i = -1
-        higher_value = False
-        while not higher_value:
-            i += 1
-            if trigger_hand[i][2] < MAX_HEIGHT_NEEDED + start_trigger[2] and \
-                    trigger_hand[i][1] < MAX_LENGTH_NEEDED + start_trigger[1]:
-                e4 = i
-            else:
-                higher_value = True
-
-        while e4 > 1 and v_th[e4 - 1] >= SPEED_THRESHOLD:
-            e4 -= 1
-
-        e5 = len(pos_left) - 1
-        while e5 > 1 and v_th[e5 - 1] >= SPEED_THRESHOLD:
-            e5 -= 1
+        e4 = _move_back(v_th, e4, SPEED_THRESHOLD)
+        e5 = _move_back(v_th, len(pos_left) - 1, SPEED_THRESHOLD)
 
         if abs(e5 - e1) < 60:
             e5 = e4
@@ -595,6 +745,19 @@ def calculate_events(pos_left, pos_right, case, score):
         return 0, 0, 0, 0, 0
 
 
+def calculate_events(pos_left, pos_right, case, score):
+    """
+    Calculate the events (5 in total + 1 at the end calculate_e6)
+    :param pos_left: list of coordinates of the left hand (or array (N, 4))
+    :param pos_right: list of coordinates of the right hand (or array (N, 4))
+    :param case: case as estimated in calculate_boxhand
+    :param score: score of the movement (currently not used)
+    :return: list of the events
+    """
+    return _trial_events(np.asarray(pos_left, dtype=np.float64), np.asarray(pos_right, dtype=np.float64), case,
+                         _events_settings())
+
+
 def calculate_position_events(case_status):
     """
     Function to return the original position of the events
@@ -615,128 +778,164 @@ def calculate_position_events(case_status):
         return ['Right'] * NUMBER_EVENTS
 
 
-def calculate_e6(xs):
+def calculate_e6(xs, button_time=None):
     """
     Calculate the last event
     :param xs: the timestamps
+    :param button_time: time (s) of the button press in the trial, the last sample is used if it is not known
     :return: e6
     """
-    return len(xs) - 1
+    if button_time is None or len(xs) == 0:
+        return len(xs) - 1
+    index = int(np.searchsorted(xs, button_time))
+    if 0 < index < len(xs) and button_time - xs[index - 1] < xs[index] - button_time:
+        index -= 1
+    return min(index, len(xs) - 1)
 
 
-def calculate_extra_parameters(events, trigger_hand, box_hand):
+class ParameterEngine:
     """
-    Get all the parameters (both unimanual as bimanual)
-    :param events: all the events calculated in calculate_events and calculate_e6
-    :param trigger_hand: coordinates of the trigger hand
-    :param box_hand: coordinates of the box hand
-    :return: 4 bimanual and 10 unimanual parameters
+    Everything of a trial that the parameters need, calculated once: the cumulative path length of both hands and the
+    local extrema of their speed. The parameters of any set of events then only need a few lookups, so they can be
+    calculated again every time an event is moved.
     """
-    fs = manage_settings.get("Sensors", "fs")
-    ORDER_EXTREMA = manage_settings.get("Data-processing", "ORDER_EXTREMA")
-
-    e1, e2, e3, e4, e5, e6 = events
-    bx = np.array([pos[0] for pos in box_hand])
-    by = np.array([pos[1] for pos in box_hand])
-    bz = np.array([pos[2] for pos in box_hand])
-    bv = np.array([pos[3] for pos in box_hand])
-
-    tx = np.array([pos[0] for pos in trigger_hand])
-    ty = np.array([pos[1] for pos in trigger_hand])
-    tz = np.array([pos[2] for pos in trigger_hand])
-    tv = np.array([pos[3] for pos in trigger_hand])
-
-    # we berekenen 4 bimanuele parameters en 10 unimanuele parameters
-
-    # total time = trigger press - start first movement
-    tt = (e6 - min(e1, e4)) / fs
-
-    # temp coupling = start trigger hand - start second phase of box opening hand ??
-    temp_coupling = ((e4 - e2) / fs) / tt
-
-    # movement overlap = end lid opening - start trigger hand
-    mov_overlap = ((e3 - e4) / fs) / tt
-
-    # goal synchronization = trigger press - end lid opening
-    goal_sync = ((e6 - e3) / fs) / tt
-
-    # unimanuele parameters
-    # time box hand = end lid opening - start box hand
-    t_bh = ((e3 - e1) / fs) / tt
-
-    # time 1st phase of box hand = start opening box - start of box hand
-    t_bh_p1 = ((e2 - e1) / fs) / tt
-
-    # time 2nd phase of box hand = end of box hand - start opening box
-    t_bh_p2 = ((e3 - e2) / fs) / tt
-
-    # time trigger hand = trigger press - start trigger hand
-    # rekening houden met e4 en e5
-    t_th = ((e6 - e4) / fs) / tt
-
-    # if start / endpoint is also a max => not taken into account. if need => first local max of b then sum in range e1: e3
-    subset = bv[e1:e3 + 1]
-
-    max_bh = argrelextrema(subset, np.greater)[0]
-    min_bh = argrelextrema(subset, np.less)[0]
+    HANDS = ('left', 'right')
 
-    # Count the number of local extrema
-    smooth_bh = len(max_bh) + len(min_bh)
+    def __init__(self, pos_left, pos_right):
+        """
+        :param pos_left: coordinates and speed of the left hand (list or array (N, 4))
+        :param pos_right: coordinates and speed of the right hand (list or array (N, 4))
+        """
+        self.hands = {'left': np.asarray(pos_left, dtype=np.float64), 'right': np.asarray(pos_right, dtype=np.float64)}
+        self.steps = {}
+        self.path = {}
+        self.bad_steps = {}
+        for name, hand in self.hands.items():
+            steps = np.diff(hand[:, :3], axis=0) if len(hand) > 1 else np.zeros((0, 3))
+            steps = np.sqrt((steps[:, 0] ** 2) + (steps[:, 1] ** 2) + (steps[:, 2] ** 2))
+            finite = np.isfinite(steps)
+            self.steps[name] = steps
+            self.path[name] = np.concatenate(([0.0], np.cumsum(np.where(finite, steps, 0.0))))
+            self.bad_steps[name] = np.concatenate(([0], np.cumsum(~finite)))
+        self.extrema = {}
+
+    def path_length(self, hand, start, stop):
+        """
+        Path length of a hand over the samples [start:stop]
+        :param hand: 'left' or 'right'
+        """
+        start, stop, _ = slice(start, stop).indices(len(self.hands[hand]))
+        if stop - start < 2:
+            return 0.0
+        # a NaN (or inf) in the range: the same result as adding the steps
+        if self.bad_steps[hand][stop - 1] != self.bad_steps[hand][start]:
+            return np.sum(self.steps[hand][start:stop - 1])
+        return self.path[hand][stop - 1] - self.path[hand][start]
+
+    def _extrema(self, hand, order):
+        """
+        :return: the number of local maxima and minima of the speed before every sample
+        """
+        if (hand, order) not in self.extrema:
+            speed = self.hands[hand][:, 3]
+            counts = []
+            for comparator in (np.greater, np.less):
+                mask = np.zeros(len(speed) + 1, dtype=np.int64)
+                mask[argrelextrema(speed, comparator, order=order)[0] + 1] = 1
+                counts.append(np.cumsum(mask))
+            self.extrema[(hand, order)] = counts
+        return self.extrema[(hand, order)]
+
+    def count_extrema(self, hand, start, stop, order=1):
+        """
+        Number of local extrema of the speed of a hand, the same as argrelextrema on speed[start:stop] (the first and
+        last samples are never an extremum, the samples close to them are only compared with the samples in the range)
+        :param hand: 'left' or 'right'
+        :param order: number of samples on each side to compare with
+        """
+        speed = self.hands[hand][:, 3]
+        start, stop, _ = slice(start, stop).indices(len(speed))
+        if stop <= start:
+            return 0
+
+        count = 0
+        inner_start, inner_stop = start + order, stop - order
+        if inner_stop > inner_start:
+            for counts in self._extrema(hand, order):
+                count += int(counts[inner_stop] - counts[inner_start])
+
+        # the samples close to the ends of the range are compared with the ends instead of the samples outside
+        edges = list(range(start, min(inner_start, stop))) + list(range(max(inner_stop, inner_start), stop))
+        for i in edges:
+            for comparator in (np.greater, np.less):
+                if all(comparator(speed[i], speed[min(i + shift, stop - 1)]) and
+                       comparator(speed[i], speed[max(i - shift, start)]) for shift in range(1, order + 1)):
+                    count += 1
+        return count
+
+    def parameters(self, events, box_hand='left'):
+        """
+        Get all the parameters (both unimanual as bimanual)
+        :param events: all the events calculated in calculate_events and calculate_e6
+        :param box_hand: 'left' or 'right', the other hand is the trigger hand
+        :return: 4 bimanual and 10 unimanual parameters
+        """
+        fs = manage_settings.get("Sensors", "fs")
+        ORDER_EXTREMA = manage_settings.get("Data-processing", "ORDER_EXTREMA")
 
-    subset_t = tv[e4:e6 + 1]
+        trigger_hand = self.HANDS[1 - self.HANDS.index(box_hand)]
+        e1, e2, e3, e4, e5, e6 = events
 
-    max_th = argrelextrema(subset_t, np.greater, order=ORDER_EXTREMA)[0]
-    min_th = argrelextrema(subset_t, np.less, order=ORDER_EXTREMA)[0]
+        # we berekenen 4 bimanuele parameters en 10 unimanuele parameters
 
-    # Count the number of local extrema
-    smooth_th = len(max_th) + len(min_th)
+        # total time = trigger press - start first movement
+        tt = (e6 - min(e1, e4)) / fs
 
-    # path-length of box hand (d=distance)
-    dbx = bx[e1:e3 + 1]
-    dby = by[e1:e3 + 1]
-    dbz = bz[e1:e3 + 1]
+        # temp coupling = start trigger hand - start second phase of box opening hand ??
+        temp_coupling = ((e4 - e2) / fs) / tt
 
-    dbx = np.diff(dbx)
-    dby = np.diff(dby)
-    dbz = np.diff(dbz)
+        # movement overlap = end lid opening - start trigger hand
+        mov_overlap = ((e3 - e4) / fs) / tt
 
-    d_bh = np.sqrt((dbx ** 2) + (dby ** 2) + (dbz ** 2))
-    d_bh = np.sum(d_bh)
+        # goal synchronization = trigger press - end lid opening
+        goal_sync = ((e6 - e3) / fs) / tt
 
-    # path-length of box hand - eerste fase tot aan de doos
-    dbx_p1 = bx[e1:e2 + 1]
-    dby_p1 = by[e1:e2 + 1]
-    dbz_p1 = bz[e1:e2 + 1]
+        # unimanuele parameters
+        # time box hand = end lid opening - start box hand
+        t_bh = ((e3 - e1) / fs) / tt
 
-    dbx_p1 = np.diff(dbx_p1)
-    dby_p1 = np.diff(dby_p1)
-    dbz_p1 = np.diff(dbz_p1)
+        # time 1st phase of box hand = start opening box - start of box hand
+        t_bh_p1 = ((e2 - e1) / fs) / tt
 
-    d_bh_p1 = np.sqrt((dbx_p1 ** 2) + (dby_p1 ** 2) + (dbz_p1 ** 2))
-    d_bh_p1 = np.sum(d_bh_p1)
+        # time 2nd phase of box hand = end of box hand - start opening box
+        t_bh_p2 = ((e3 - e2) / fs) / tt
 
-    # path-length of box hand - tweede fase deksel van de doos op hoogste punt
-    dbx_p2 = bx[e2:e3 + 1]
-    dby_p2 = by[e2:e3 + 1]
-    dbz_p2 = bz[e2:e3 + 1]
+        # time trigger hand = trigger press - start trigger hand
+        # rekening houden met e4 en e5
+        t_th = ((e6 - e4) / fs) / tt
 
-    dbx_p2 = np.diff(dbx_p2)
-    dby_p2 = np.diff(dby_p2)
-    dbz_p2 = np.diff(dbz_p2)
+        # if start / endpoint is also a max => not taken into account
+        smooth_bh = self.count_extrema(box_hand, e1, e3 + 1)
+        smooth_th = self.count_extrema(trigger_hand, e4, e6 + 1, ORDER_EXTREMA)
 
-    d_bh_p2 = np.sqrt((dbx_p2 ** 2) + (dby_p2 ** 2) + (dbz_p2 ** 2))
-    d_bh_p2 = sum(d_bh_p2)
+        # path-length of box hand (d=distance), the first phase (to the box) and the second phase (lid at the highest
+        # point), and of the trigger hand
+        d_bh = self.path_length(box_hand, e1, e3 + 1)
+        d_bh_p1 = self.path_length(box_hand, e1, e2 + 1)
+        d_bh_p2 = self.path_length(box_hand, e2, e3 + 1)
+        d_th = self.path_length(trigger_hand, e4, e6 + 1)
 
-    # path-length of trigger hand of triggerhand, not yet activated as e5 still needs to be calculated ??? -> check na wat dit betekent
-    dtx = tx[e4:e6 + 1]
-    dty = ty[e4:e6 + 1]
-    dtz = tz[e4:e6 + 1]
+        return [tt, temp_coupling, mov_overlap, goal_sync], \
+            [t_bh, t_bh_p1, t_bh_p2, t_th, smooth_bh, smooth_th, d_bh, d_bh_p1, d_bh_p2, d_th]
 
-    dtx = np.diff(dtx)
-    dty = np.diff(dty)
-    dtz = np.diff(dtz)
-    d_th = np.sqrt((dtx ** 2) + (dty ** 2) + (dtz ** 2))
-    d_th = np.sum(d_th)
 
-    return [tt, temp_coupling, mov_overlap, goal_sync], \
-        [t_bh, t_bh_p1, t_bh_p2, t_th, smooth_bh, smooth_th, d_bh, d_bh_p1, d_bh_p2, d_th]
+def calculate_extra_parameters(events, trigger_hand, box_hand):
+    """
+    Get all the parameters (both unimanual as bimanual), use a ParameterEngine to calculate them more than once for
+    the same trial
+    :param events: all the events calculated in calculate_events and calculate_e6
+    :param trigger_hand: coordinates of the trigger hand
+    :param box_hand: coordinates of the box hand
+    :return: 4 bimanual and 10 unimanual parameters
+    """
+    return ParameterEngine(box_hand, trigger_hand).parameters(events, 'left')
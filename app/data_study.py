@@ -0,0 +1,438 @@
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+from constants import BIMAN_PARAMS, UNIMAN_PARAMS
+from data_ingest import parse_trial, trial_index
+from data_manifest import ParticipantManifest, file_signature, same_file
+from logger import get_logbook
+from widget_settings import manage_settings
+
+"""
+Database of a study folder (study.sqlite, a folder with a folder for every participant). It keeps the participants,
+their trials with the score, case, events and parameters, and the trial file every trial comes from (size, modification
+time and hash). The exports are added with ingest: only the files that are new or changed are read, out of the
+manifest of the participant if it belongs to the file, otherwise out of the file itself.
+
+The comparison of the participants adds its own results (score of the neural net, case, events and parameters), so a
+trial is only calculated again if its file changed. query_trials selects trials over the whole study, e.g. all the
+trials with score 3 and the left hand as box hand: query_trials(score=3, case_status=0).
+
+The results of the comparison depend on NUMBER_EVENTS and the scoring model as well: they are kept in the meta table,
+when the number of events changed all the files are read again, when the model changed all the trials are compared
+again.
+"""
+
+logger = get_logbook('data_study')
+
+STUDY_DB_NAME = 'study.sqlite'
+# the neural net of data_processing.predict_score
+SCORING_MODEL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scoring_model.keras')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS participants (
+    id INTEGER PRIMARY KEY,
+    folder TEXT NOT NULL UNIQUE,
+    code TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    participant_id INTEGER NOT NULL REFERENCES participants (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    source TEXT NOT NULL,
+    ingested REAL NOT NULL,
+    UNIQUE (participant_id, name)
+);
+CREATE TABLE IF NOT EXISTS trials (
+    id INTEGER PRIMARY KEY,
+    participant_id INTEGER NOT NULL REFERENCES participants (id) ON DELETE CASCADE,
+    file_id INTEGER NOT NULL UNIQUE REFERENCES files (id) ON DELETE CASCADE,
+    number INTEGER NOT NULL,
+    samples INTEGER,
+    score INTEGER,
+    predicted_score INTEGER,
+    case_status INTEGER
+);
+CREATE TABLE IF NOT EXISTS events (
+    trial_id INTEGER NOT NULL REFERENCES trials (id) ON DELETE CASCADE,
+    number INTEGER NOT NULL,
+    sample INTEGER NOT NULL,
+    position TEXT,
+    PRIMARY KEY (trial_id, number)
+);
+CREATE TABLE IF NOT EXISTS parameters (
+    trial_id INTEGER NOT NULL REFERENCES trials (id) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (trial_id, kind, number)
+);
+CREATE INDEX IF NOT EXISTS trials_participant ON trials (participant_id, number);
+CREATE INDEX IF NOT EXISTS trials_score ON trials (score, case_status);
+CREATE INDEX IF NOT EXISTS trials_predicted_score ON trials (predicted_score, case_status);
+CREATE INDEX IF NOT EXISTS parameters_name ON parameters (name, value);
+"""
+
+PARAMETERS = {'bimanual': BIMAN_PARAMS, 'unimanual': UNIMAN_PARAMS}
+
+
+def participant_code(folder_name):
+    """
+    :param folder_name: name of the folder of a participant
+    :return: the participant code, without the '(...)' that is added to the folder
+    """
+    if '(' in folder_name and ')' in folder_name:
+        return folder_name.split('(')[0]
+    return folder_name
+
+
+def model_fingerprint():
+    """
+    :return: size and modification time of the scoring model, changes when the model is trained again
+    """
+    try:
+        stat = os.stat(SCORING_MODEL)
+    except OSError:
+        return ''
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def _number(value):
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class StudyDatabase:
+    """
+    The database of a single study folder, see the top of this file
+    """
+    def __init__(self, folder):
+        """
+        Use StudyDatabase.open
+        :param folder: the study folder
+        """
+        self.folder = folder
+        self.connection = sqlite3.connect(os.path.join(folder, STUDY_DB_NAME))
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+        self.number_events = manage_settings.get("Events", "NUMBER_EVENTS")
+        self._check_settings()
+
+    @classmethod
+    def open(cls, folder):
+        """
+        Open (or make) the database of a study folder
+        :param folder: the study folder
+        """
+        return cls(folder)
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def commit(self):
+        self.connection.commit()
+
+    def _check_settings(self):
+        """
+        Remove what depends on NUMBER_EVENTS or the scoring model if they changed since the last time
+        """
+        meta = {row['key']: row['value'] for row in self.connection.execute("SELECT key, value FROM meta")}
+        settings = {'number_events': str(self.number_events), 'scoring_model': model_fingerprint()}
+
+        if meta.get('number_events', settings['number_events']) != settings['number_events']:
+            logger.info(f"NUMBER_EVENTS changed, all the files of {self.folder} are read again")
+            self.connection.execute("DELETE FROM files")
+        elif meta.get('scoring_model', settings['scoring_model']) != settings['scoring_model']:
+            logger.info(f"The scoring model changed, all the trials of {self.folder} are compared again")
+            self.connection.execute("UPDATE trials SET predicted_score = NULL")
+
+        self.connection.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", settings.items())
+        self.connection.commit()
+
+    def _participant_id(self, folder_name):
+        row = self.connection.execute("SELECT id FROM participants WHERE folder = ?", (folder_name,)).fetchone()
+        if row is not None:
+            return row['id']
+        return self.connection.execute("INSERT INTO participants (folder, code) VALUES (?, ?)",
+                                       (folder_name, participant_code(folder_name))).lastrowid
+
+    def _file(self, trial_file):
+        """
+        :param trial_file: path of the trial_N.xlsx
+        :return: the file out of the database and True if it is still the same file, (None, False) if it is not in it
+        """
+        trial_file = Path(trial_file)
+        row = self.connection.execute(
+            "SELECT files.* FROM files JOIN participants ON participants.id = files.participant_id "
+            "WHERE participants.folder = ? AND files.name = ?", (trial_file.parent.name, trial_file.name)).fetchone()
+        if row is None:
+            return None, False
+        if not same_file(trial_file, dict(row)):
+            return row, False
+
+        # only the modification time is changed (e.g. a copy), no need to calculate the hash again next time
+        mtime_ns = os.stat(trial_file).st_mtime_ns
+        if mtime_ns != row['mtime_ns']:
+            self.connection.execute("UPDATE files SET mtime_ns = ? WHERE id = ?", (mtime_ns, row['id']))
+        return row, True
+
+    def is_current(self, trial_file):
+        """
+        :param trial_file: path of the trial_N.xlsx
+        :return: True if the file is in the database and did not change since
+        """
+        return self._file(trial_file)[1]
+
+    def _set_file(self, trial_file, source):
+        """
+        Add a file (again), everything that was read out of the old file is removed
+        :return: id of the participant and id of the file
+        """
+        trial_file = Path(trial_file)
+        participant_id = self._participant_id(trial_file.parent.name)
+        self.connection.execute("DELETE FROM files WHERE participant_id = ? AND name = ?",
+                                (participant_id, trial_file.name))
+        signature = file_signature(trial_file)
+        file_id = self.connection.execute(
+            "INSERT INTO files (participant_id, name, size, mtime_ns, hash, source, ingested) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (participant_id, trial_file.name, signature['size'], signature['mtime_ns'], signature['hash'], source,
+             time.time())).lastrowid
+        return participant_id, file_id
+
+    def _set_events(self, trial_id, events, positions=None):
+        self.connection.execute("DELETE FROM events WHERE trial_id = ?", (trial_id,))
+        positions = list(positions or [])
+        self.connection.executemany(
+            "INSERT INTO events (trial_id, number, sample, position) VALUES (?, ?, ?, ?)",
+            [(trial_id, i + 1, int(sample or 0), positions[i] if i < len(positions) and isinstance(positions[i], str) else None)
+             for i, sample in enumerate(events)])
+
+    def _set_parameters(self, trial_id, bimanual, unimanual):
+        self.connection.execute("DELETE FROM parameters WHERE trial_id = ?", (trial_id,))
+        rows = []
+        for kind, values in (('bimanual', bimanual), ('unimanual', unimanual)):
+            for i, value in enumerate(values or []):
+                rows.append((trial_id, kind, i, PARAMETERS[kind][i], float(value) if value is not None else None))
+        self.connection.executemany(
+            "INSERT INTO parameters (trial_id, kind, number, name, value) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def _ingest_manifest(self, trial_file, manifest=None):
+        """
+        Add a trial file out of the manifest of the participant (no need to read the file)
+        :return: False if the manifest does not belong to the file
+        """
+        if manifest is None:
+            manifest = ParticipantManifest.load(os.path.dirname(trial_file))
+        entry = manifest.trial(trial_file)
+        if entry is None or not same_file(trial_file, entry.get('signature')):
+            return False
+
+        participant_id, file_id = self._set_file(trial_file, 'manifest')
+        events = entry['manual_events'] if any(entry['manual_events']) else entry['automatic_events']
+        trial_id = self.connection.execute(
+            "INSERT INTO trials (participant_id, file_id, number, samples, score, case_status) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (participant_id, file_id, trial_index(trial_file) + 1, entry.get('samples'),
+             _number(entry.get('score')), _number(entry.get('case_status')))).lastrowid
+        self._set_events(trial_id, events, entry.get('position_events'))
+        parameters = entry.get('parameters') or {}
+        self._set_parameters(trial_id, parameters.get('bimanual'), parameters.get('unimanual'))
+        return True
+
+    def ingest_file(self, trial_file, manifest=None):
+        """
+        Add a trial file to the database, if it is new or changed
+        :param trial_file: path of the trial_N.xlsx
+        :param manifest: the manifest of the participant folder, None to read it
+        :type manifest: ParticipantManifest
+        :return: True if the file was read
+        """
+        if self.is_current(trial_file):
+            return False
+
+        if self._ingest_manifest(trial_file, manifest):
+            return True
+
+        result = parse_trial(trial_file, self.number_events, True)
+        participant_id, file_id = self._set_file(trial_file, 'excel')
+        if result['kind'] == 'data':
+            trial_id = self.connection.execute(
+                "INSERT INTO trials (participant_id, file_id, number, samples, score) VALUES (?, ?, ?, ?, ?)",
+                (participant_id, file_id, result['index'] + 1, len(result['columns'][0]),
+                 _number(result['score']))).lastrowid
+            self._set_events(trial_id, result['event_log'], result.get('event_position'))
+        return True
+
+    def ingest(self):
+        """
+        Add all the participant folders of the study folder, only the files that are new or changed are read. The
+        participants and files that are not in the study folder anymore are removed.
+        """
+        folders = set()
+        for folder in sorted(Path(self.folder).iterdir()):
+            trial_files = sorted(folder.glob("trial_*.xlsx")) if folder.is_dir() else []
+            if not trial_files:
+                continue
+
+            folders.add(folder.name)
+            manifest = ParticipantManifest.load(folder)
+            for trial_file in trial_files:
+                try:
+                    self.ingest_file(trial_file, manifest)
+                except Exception as e:
+                    logger.error(f"Failed to add {trial_file} to the study: {e}", exc_info=True)
+            self.remove_missing(folder.name, trial_files)
+            self.connection.commit()
+
+        self.remove_participants(folders)
+        self.connection.commit()
+
+    def remove_participants(self, folders):
+        """
+        Remove the participants that are not in the study folder anymore
+        :param folders: names of the folders of the participants that are still there
+        """
+        for row in self.connection.execute("SELECT folder FROM participants").fetchall():
+            if row['folder'] not in folders:
+                self.connection.execute("DELETE FROM participants WHERE folder = ?", (row['folder'],))
+
+    def remove_missing(self, folder_name, trial_files):
+        """
+        Remove the files of a participant that are not in the folder anymore
+        :param folder_name: name of the folder of the participant
+        :param trial_files: paths of the trial_N.xlsx that are still there
+        """
+        names = {Path(trial_file).name for trial_file in trial_files}
+        for row in self.connection.execute(
+                "SELECT files.id, files.name FROM files JOIN participants ON participants.id = files.participant_id "
+                "WHERE participants.folder = ?", (folder_name,)).fetchall():
+            if row['name'] not in names:
+                self.connection.execute("DELETE FROM files WHERE id = ?", (row['id'],))
+
+    def analysis(self, trial_file):
+        """
+        The result of the comparison of the participants for a trial
+        :param trial_file: path of the trial_N.xlsx
+        :return: True if the result can be used (the file did not change since), and the result (trial, score, case,
+        events, bimanual, unimanual) or None if the file has no trial
+        """
+        file, current = self._file(trial_file)
+        if not current:
+            return False, None
+
+        trial = self.connection.execute("SELECT * FROM trials WHERE file_id = ?", (file['id'],)).fetchone()
+        if trial is None:
+            return True, None
+        if trial['predicted_score'] is None:
+            return False, None
+
+        found = self._details([trial['id']])[trial['id']]
+        return True, {"trial": trial['number'], "score": trial['predicted_score'], "case": trial['case_status'],
+                      "events": found['events'], "bimanual": found['bimanual'], "unimanual": found['unimanual']}
+
+    def set_analysis(self, trial_file, row):
+        """
+        Save the result of the comparison of the participants for a trial
+        :param trial_file: path of the trial_N.xlsx
+        :param row: the result (trial, score, case, events, bimanual, unimanual and file_score: the score in the file),
+        None if the file has no trial
+        """
+        file, current = self._file(trial_file)
+        if not current:
+            # the file is already read by the comparison, it is not read again
+            if not self._ingest_manifest(trial_file):
+                self._set_file(trial_file, 'compare')
+            file, _ = self._file(trial_file)
+        if row is None:
+            return
+
+        trial = self.connection.execute("SELECT id FROM trials WHERE file_id = ?", (file['id'],)).fetchone()
+        if trial is None:
+            trial_id = self.connection.execute(
+                "INSERT INTO trials (participant_id, file_id, number, samples, score) VALUES (?, ?, ?, ?, ?)",
+                (file['participant_id'], file['id'], row['trial'], row.get('samples'),
+                 _number(row.get('file_score')))).lastrowid
+        else:
+            trial_id = trial['id']
+
+        self.connection.execute("UPDATE trials SET predicted_score = ?, case_status = ? WHERE id = ?",
+                                (_number(row['score']), _number(row['case']), trial_id))
+        positions = [event['position'] for event in self.connection.execute(
+            "SELECT position FROM events WHERE trial_id = ? ORDER BY number", (trial_id,))]
+        self._set_events(trial_id, row['events'], positions)
+        self._set_parameters(trial_id, row['bimanual'], row['unimanual'])
+
+    def _details(self, trial_ids):
+        """
+        :return: the events, positions and parameters of every trial
+        """
+        details = {trial_id: {'events': [], 'positions': [], 'bimanual': [], 'unimanual': []}
+                   for trial_id in trial_ids}
+        for start in range(0, len(trial_ids), 500):
+            chunk = trial_ids[start:start + 500]
+            marks = ', '.join('?' * len(chunk))
+            for row in self.connection.execute(
+                    f"SELECT * FROM events WHERE trial_id IN ({marks}) ORDER BY trial_id, number", chunk):
+                details[row['trial_id']]['events'].append(row['sample'])
+                details[row['trial_id']]['positions'].append(row['position'])
+            for row in self.connection.execute(
+                    f"SELECT * FROM parameters WHERE trial_id IN ({marks}) ORDER BY trial_id, kind, number", chunk):
+                details[row['trial_id']][row['kind']].append(row['value'])
+        return details
+
+    def query_trials(self, score=None, predicted_score=None, case_status=None, participant=None, scored=False):
+        """
+        Select trials over the whole study, every argument that is not None has to match
+        :param score: score given to the trial in the app
+        :param predicted_score: score of the neural net (from the comparison of the participants)
+        :param case_status: case of the trial (0: left hand is the box hand, 1: right hand, ... see calculate_boxhand)
+        :param participant: the participant code
+        :param scored: only the trials with a score
+        :return: list with a dict for every trial (participant, folder, trial, file, samples, score, predicted_score,
+        case_status, events, positions, bimanual, unimanual), sorted by participant and trial
+        """
+        conditions, values = [], []
+        for column, value in (('trials.score', score), ('trials.predicted_score', predicted_score),
+                              ('trials.case_status', case_status), ('participants.code', participant)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                values.append(value)
+        if scored:
+            conditions.append("trials.score IS NOT NULL")
+
+        query = "SELECT trials.*, participants.code, participants.folder, files.name FROM trials " \
+                "JOIN participants ON participants.id = trials.participant_id " \
+                "JOIN files ON files.id = trials.file_id"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY participants.folder, trials.number"
+
+        trials = self.connection.execute(query, values).fetchall()
+        details = self._details([trial['id'] for trial in trials])
+        return [{
+            'participant': trial['code'],
+            'folder': trial['folder'],
+            'trial': trial['number'],
+            'file': os.path.join(self.folder, trial['folder'], trial['name']),
+            'samples': trial['samples'],
+            'score': trial['score'],
+            'predicted_score': trial['predicted_score'],
+            'case_status': trial['case_status'],
+            **details[trial['id']],
+        } for trial in trials]
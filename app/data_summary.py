@@ -0,0 +1,64 @@
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Font
+from openpyxl.utils import get_column_letter
+
+"""
+Writing of the summary workbooks (the participant Excel and Compare_patients.xlsx). The workbooks are written in
+write-only mode: every row goes straight to the file, so the memory stays the same for any number of trials or
+participants. All the tables have the same layout: a row with the group headers (merged over the columns of the group),
+a row with the column headers and the rows with the data, the first column has the label of every row.
+"""
+
+BOLD = Font(bold=True)
+CENTER = Alignment(horizontal='center')
+
+
+def new_workbook():
+    """
+    :return: an empty workbook in write-only mode, the sheets are in the order they are made
+    """
+    return openpyxl.Workbook(write_only=True)
+
+
+def _header_cell(ws, value, centered=False):
+    cell = WriteOnlyCell(ws, value=value)
+    cell.font = BOLD
+    if centered:
+        cell.alignment = CENTER
+    return cell
+
+
+def write_table(ws, label, row_labels, data):
+    """
+    Write a table to a sheet of a workbook from new_workbook
+    :param ws: the (empty) sheet
+    :param label: header of the first column
+    :param row_labels: label of every row (first column)
+    :param data: dict with a dict (column header: values of every row) for every group header
+    """
+    columns = [(heading, sub) for heading, subdict in data.items() for sub in subdict]
+
+    # the merged cells are only written to the file when the sheet is closed
+    group_row = [None]
+    col = 2
+    for heading, subdict in data.items():
+        width = len(subdict)
+        if width == 0:
+            continue
+        if width > 1:
+            ws.merged_cells.add(f"{get_column_letter(col)}1:{get_column_letter(col + width - 1)}1")
+        group_row.append(_header_cell(ws, heading, centered=True))
+        group_row.extend([None] * (width - 1))
+        col += width
+    ws.append(group_row)
+
+    ws.append([_header_cell(ws, label)] + [_header_cell(ws, sub) for _, sub in columns])
+
+    values = [data[heading][sub] for heading, sub in columns]
+    for i, row_label in enumerate(row_labels):
+        ws.append([row_label] + [column[i] for column in values])
+
+    # finish the sheet, so it does not keep a file open until the workbook is saved
+    ws.close()
+
@@ -0,0 +1,265 @@
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+"""
+Binary copy of a trial_N.xlsx (trial_N.g4t) that is much faster to write and read than the Excel. The file has a
+fixed header (magic, length of the metadata and the metadata as json) and all the long numeric columns (the samples)
+as float64 columns after it. The short columns (events, score, GoPro times, ...) are kept in the metadata. The columns
+are memory-mapped, so only the columns that are used get read from the disk.
+
+read_trial gives the same DataFrame as pd.read_excel of the Excel, so the code that reads the columns by position does
+not have to change. Code that only needs some columns or a single cell (score, events) uses open_trial instead: it gives
+the same values per column, without making the DataFrame and without reading the other samples.
+"""
+
+MAGIC = b'G4TRIAL1'
+HEADER_SIZE = 4096
+TRIAL_EXTENSION = '.g4t'
+# numeric columns with more values than this are stored as binary columns
+MAX_HEADER_VALUES = 64
+
+
+def binary_trial_file(trial_file):
+    """
+    Name of the binary copy of a trial
+    :param trial_file: path of the trial_N.xlsx
+    """
+    return os.path.splitext(os.fspath(trial_file))[0] + TRIAL_EXTENSION
+
+
+def _header_value(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, (np.integer, np.floating)):
+        return value.item()
+    return value
+
+
+def save_trial_file(trial_file, df):
+    """
+    Save the binary copy next to the Excel
+    :param trial_file: path of the trial_N.xlsx
+    :param df: the DataFrame that is saved in the Excel
+    :type df: pd.DataFrame
+    """
+    columns = []
+    binary = []
+    for name in df.columns:
+        series = df[name]
+        if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            values = series.to_numpy(dtype=np.float64)
+            valid = np.flatnonzero(~np.isnan(values))
+            length = int(valid[-1]) + 1 if len(valid) else 0
+            if length > MAX_HEADER_VALUES:
+                columns.append({'name': name, 'kind': 'binary', 'index': len(binary), 'length': length})
+                binary.append(values[:length])
+                continue
+            values = values[:length]
+        else:
+            values = series.to_list()
+            while values and _header_value(values[-1]) is None:
+                values.pop()
+        columns.append({'name': name, 'kind': 'values', 'values': [_header_value(value) for value in values]})
+
+    samples = max((len(values) for values in binary), default=0)
+    block = np.full((len(binary), samples), np.nan, dtype=np.float64)
+    for index, values in enumerate(binary):
+        block[index, :len(values)] = values
+
+    header = json.dumps({'rows': len(df), 'samples': samples, 'columns': columns}).encode('utf-8')
+    # the metadata does not always fit in one page, the columns start at the next page
+    header_size = HEADER_SIZE * math.ceil((len(MAGIC) + 4 + len(header)) / HEADER_SIZE)
+
+    file_name = binary_trial_file(trial_file)
+    with open(file_name + '.tmp', 'wb') as file:
+        file.write(MAGIC + np.uint32(len(header)).tobytes() + header)
+        file.write(bytes(header_size - file.tell()))
+        file.write(block.tobytes())
+    os.replace(file_name + '.tmp', file_name)
+
+
+class TrialFile:
+    """
+    Lazy access to the columns of a binary trial file
+    """
+    def __init__(self, file_name):
+        """
+        :param file_name: path of the trial_N.g4t
+        """
+        with open(file_name, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{file_name} is not a trial file")
+            length = int(np.frombuffer(file.read(4), dtype=np.uint32)[0])
+            metadata = json.loads(file.read(length).decode('utf-8'))
+
+        self.rows = metadata['rows']
+        self.columns = metadata['columns']
+        # an empty header in the Excel is read as 'Unnamed: N'
+        self.names = [column['name'] or f"Unnamed: {index}" for index, column in enumerate(self.columns)]
+
+        binary = sum(column['kind'] == 'binary' for column in self.columns)
+        header_size = HEADER_SIZE * math.ceil((len(MAGIC) + 4 + length) / HEADER_SIZE)
+        if binary and metadata['samples']:
+            self._block = np.memmap(file_name, dtype=np.float64, mode='r', offset=header_size,
+                                    shape=(binary, metadata['samples']))
+        else:
+            self._block = np.zeros((0, 0))
+
+    def column(self, index):
+        """
+        :param index: position of the column (same as in the Excel)
+        :return: the values of the column (a memory-mapped view for the samples), without the empty cells at the end
+        """
+        column = self.columns[index]
+        if column['kind'] == 'binary':
+            return self._block[column['index'], :column['length']]
+        return column['values']
+
+    def values(self, index):
+        """
+        :param index: position of the column (same as in the Excel)
+        :return: the same values as the column of the DataFrame of to_dataframe (a copy, it does not keep the file
+        mapped)
+        :rtype: np.ndarray
+        """
+        column = self.columns[index]
+        values = self.column(index)
+        if column['kind'] == 'binary' or all(value is None or isinstance(value, (int, float)) for value in values):
+            values = np.array([np.nan if value is None else value for value in values]
+                              if column['kind'] == 'values' else values, dtype=np.float64, copy=True)
+        else:
+            values = np.array([np.nan if value is None else value for value in values], dtype=object)
+        if len(values) == self.rows:
+            return values
+        padded = np.full(self.rows, np.nan, dtype=values.dtype)
+        padded[:len(values)] = values
+        return padded
+
+    def to_dataframe(self):
+        """
+        Same DataFrame as pd.read_excel of the Excel
+        """
+        return pd.DataFrame({name: pd.Series(self.values(index)) for index, name in enumerate(self.names)})
+
+    def close(self):
+        """
+        Let go of the mapping of the file, it is unmapped as soon as no view from column is left (needed before the
+        file can be replaced on Windows)
+        """
+        self._block = np.zeros((0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ExcelTrial:
+    """
+    The same access to the columns as TrialFile, for a trial that can only be read from the Excel
+    """
+    def __init__(self, trial_file):
+        """
+        :param trial_file: path of the trial_N.xlsx
+        """
+        self._data = pd.read_excel(trial_file)
+        self.rows = len(self._data)
+        self.names = [str(name) for name in self._data.columns]
+
+    def values(self, index):
+        """
+        :param index: position of the column
+        :rtype: np.ndarray
+        """
+        return self._data.iloc[:, index].to_numpy()
+
+    def close(self):
+        self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def binary_is_current(trial_file):
+    """
+    :param trial_file: path of the trial_N.xlsx
+    :return: True if the binary copy is there and not older than the Excel
+    """
+    file_name = binary_trial_file(trial_file)
+    return os.path.exists(file_name) and \
+        (not os.path.exists(trial_file) or os.path.getmtime(file_name) >= os.path.getmtime(trial_file))
+
+
+def _current_binary(trial_file):
+    """
+    :param trial_file: path of the trial_N.xlsx
+    :return: the binary copy if it is there and not older than the Excel, otherwise None
+    """
+    if binary_is_current(trial_file):
+        try:
+            return TrialFile(binary_trial_file(trial_file))
+        except (ValueError, OSError, KeyError):
+            pass
+    return None
+
+
+def open_trial(trial_file):
+    """
+    Open a trial to read some of its columns, from the binary copy if it is there and not older than the Excel. Use it
+    in a with-statement, so the binary copy is not kept mapped
+    :param trial_file: path of the trial_N.xlsx
+    :return: the trial, names has the header of every column and values(index) gives the values of a column
+    :rtype: TrialFile | ExcelTrial
+    """
+    trial = _current_binary(trial_file)
+    if trial is None:
+        return ExcelTrial(trial_file)
+    return trial
+
+
+def read_trial(trial_file):
+    """
+    Read a trial, from the binary copy if it is there and not older than the Excel
+    :param trial_file: path of the trial_N.xlsx
+    :rtype: pd.DataFrame
+    """
+    trial = _current_binary(trial_file)
+    if trial is not None:
+        try:
+            return trial.to_dataframe()
+        finally:
+            trial.close()
+    return pd.read_excel(trial_file)
+
+
+def read_samples(trial_file, columns=9):
+    """
+    Read only the first columns of a trial (the time and the samples of both hands), without making the DataFrame if
+    the binary copy can be used
+    :param trial_file: path of the trial_N.xlsx
+    :param columns: number of columns to read
+    :return: list with the values of every column
+    """
+    trial = _current_binary(trial_file)
+    if trial is None:
+        trial_data = pd.read_excel(trial_file)
+        return [trial_data.iloc[:, i].to_numpy(dtype=np.float64) for i in range(columns)]
+
+    samples = []
+    try:
+        for i in range(columns):
+            values = trial.column(i)
+            if trial.columns[i]['kind'] == 'values':
+                values = [np.nan if value is None else value for value in values]
+            samples.append(np.array(values, dtype=np.float64, copy=True))
+    finally:
+        trial.close()
+    return samples
@@ -1,4 +1,5 @@
 import asyncio
+import multiprocessing
 import os
 import sys
 
@@ -7,6 +8,9 @@ from PySide6.QtGui import QPixmap
 from PySide6.QtWidgets import QApplication, QSplashScreen
 
 if __name__ == "__main__":
+    # the participant folders are read in separate processes, also in the executable
+    multiprocessing.freeze_support()
+
     app = QApplication(sys.argv)
 
     # Usage of async for the gopro
@@ -2,15 +2,25 @@ import ctypes as ct
 import os
 from enum import Enum
 
+import numpy as np
+
 """
 Files for the libraries of Polhemus function from the .dll (converted from C)
 """
 
 file_directory = os.path.dirname(os.path.abspath(__file__))
-G4Track = ct.CDLL(os.path.join(file_directory, "NEEDED/FILES/G4Track.dll"))
+try:
+    G4Track = ct.CDLL(os.path.join(file_directory, "NEEDED/FILES/G4Track.dll"))
+except OSError:
+    # Only available on Windows with the Polhemus drivers, sensor_backend switches to the simulated sensor otherwise
+    G4Track = None
 G4_sensors_per_hub = 3
 
 HUBS = 1
+# Frames of all hubs are read with a single call, this is the most that can be read at once
+MAX_HUBS = 4
+# The G4Track.dll only gives the most recent frame, frames in between two calls are not kept
+BUFFERED_FRAMES = False
 
 
 class G4SensorFrameData(ct.Structure):
@@ -45,6 +55,29 @@ class G4FrameData(ct.Structure):
                 ("G4_sensor_per_hub", G4SensorFrameData * G4_sensors_per_hub)]
 
 
+# Same memory layout as G4SensorFrameData and G4FrameData, to look at a frame with NumPy without copying it
+G4_SENSOR_DTYPE = np.dtype([("id", np.uint32),
+                            ("pos", np.float32, (3,)),
+                            ("ori", np.float32, (4,))])
+G4_FRAME_DTYPE = np.dtype([("hub", np.uint32),
+                           ("frame", np.uint32),
+                           ("stationMap", np.uint32),
+                           ("dig_io", np.uint32),
+                           ("G4_sensor_per_hub", G4_SENSOR_DTYPE, (G4_sensors_per_hub,))])
+assert G4_FRAME_DTYPE.itemsize == ct.sizeof(G4FrameData)
+
+
+def frame_data_view(fd):
+    """
+    Map a structured NumPy array on the memory of a frame, the array changes together with the structure
+    :param fd: the frame (or an array of frames) to look at
+    :type fd: G4FrameData
+    :return: a structured array with dtype G4_FRAME_DTYPE
+    :rtype: np.ndarray
+    """
+    return np.frombuffer(fd, dtype=G4_FRAME_DTYPE)
+
+
 class G4SRCMap(ct.Structure):
     """
     Structure used to retrieve position & orientation of each source with fields:
@@ -213,26 +246,27 @@ class UNITS(Enum):
     G4_TYPE_METER = 6
 
 
-# uint32_t g4_init_sys(int* pDongleId,const char* src_cfg_file,void* reserved)
-g4_init_sys = G4Track.g4_init_sys
-g4_init_sys.argtypes = [ct.POINTER(ct.c_int), ct.c_char_p, ct.c_void_p]
-g4_init_sys.restype = ct.c_uint32
+if G4Track is not None:
+    # uint32_t g4_init_sys(int* pDongleId,const char* src_cfg_file,void* reserved)
+    g4_init_sys = G4Track.g4_init_sys
+    g4_init_sys.argtypes = [ct.POINTER(ct.c_int), ct.c_char_p, ct.c_void_p]
+    g4_init_sys.restype = ct.c_uint32
 
-# void g4_close_tracker(void)
-g4_close_tracker = G4Track.g4_close_tracker
-g4_close_tracker.argtypes = ()
-g4_close_tracker.restype = None
+    # void g4_close_tracker(void)
+    g4_close_tracker = G4Track.g4_close_tracker
+    g4_close_tracker.argtypes = ()
+    g4_close_tracker.restype = None
 
-# uint32_t g4_get_frame_data(G4_FRAMEDATA* fd_array, int sysId, const int* hub_id_list, int num_hubs)
-g4_get_frame_data = G4Track.g4_get_frame_data
-g4_get_frame_data.argtypes = [ct.POINTER(G4FrameData), ct.c_int,
-                                      ct.POINTER(ct.c_int), ct.c_int]
-g4_get_frame_data.restype = ct.c_uint32
+    # uint32_t g4_get_frame_data(G4_FRAMEDATA* fd_array, int sysId, const int* hub_id_list, int num_hubs)
+    g4_get_frame_data = G4Track.g4_get_frame_data
+    g4_get_frame_data.argtypes = [ct.POINTER(G4FrameData), ct.c_int,
+                                          ct.POINTER(ct.c_int), ct.c_int]
+    g4_get_frame_data.restype = ct.c_uint32
 
-# uint32_t g4_set_query(LPG4_CMD_STRUCT pcs)
-g4_set_query = G4Track.g4_set_query
-g4_set_query.argtypes = [ct.POINTER(G4CMDStruct)]
-g4_set_query.restype = ct.c_uint32
+    # uint32_t g4_set_query(LPG4_CMD_STRUCT pcs)
+    g4_set_query = G4Track.g4_set_query
+    g4_set_query.argtypes = [ct.POINTER(G4CMDStruct)]
+    g4_set_query.restype = ct.c_uint32
 
 
 def initialize_system(src_cfg_file):
@@ -271,8 +305,11 @@ def close_sensor():
 
 
 # Added so the reading happens faster -> not need to allocate data every cycle
-HUB_ID_ARRAY = (ct.c_int * HUBS)()
-FRAME_DATA = G4FrameData()
+HUB_ID_ARRAY = (ct.c_int * MAX_HUBS)()
+# One frame for every hub, filled in by a single call of g4_get_frame_data
+FRAME_DATA = (G4FrameData * MAX_HUBS)()
+FRAME_VIEW = frame_data_view(FRAME_DATA)
+FIRST_FRAME_DATA = FRAME_DATA[0]
 
 
 def get_frame_data(system_id, hub_id_list):
@@ -282,41 +319,60 @@ def get_frame_data(system_id, hub_id_list):
     :type system_id: int
     :param hub_id_list: array of hub ids the user is requesting data from
     :type hub_id_list: list[int]
-    :return: a struct with the position and orientation, a number of active hubs
-     and a number of hubs worth of data returned in the fd (default set to 1)
+    :return: a struct with the position and orientation (of the first hub, the others are in FRAME_DATA), a number
+     of active hubs and a number of hubs worth of data returned in the fd
     :rtype: (G4FrameData, int, int)
     """
-    fd = FRAME_DATA
     for i, hub_id in enumerate(hub_id_list):
         HUB_ID_ARRAY[i] = hub_id
-    res = g4_get_frame_data(ct.byref(fd), ct.c_int(system_id), HUB_ID_ARRAY, HUBS)
+    res = g4_get_frame_data(FRAME_DATA, ct.c_int(system_id), HUB_ID_ARRAY, len(hub_id_list))
 
     res = res & 0xFFFFFFFF
     active_hubs = (res >> 16) & 0xFFFF
     hub_count = res & 0xFFFF
 
-    return fd, active_hubs, hub_count
+    return FIRST_FRAME_DATA, active_hubs, hub_count
 
 
-def get_frame_data_with_c_list(system_id, hub_id_list):
+def get_frame_data_with_c_list(system_id, hub_id_list, num_hubs=HUBS):
     """
     Enables the program to retrieve position & orientation from the hub (single frame, watch out with 120 Hz)
     :param system_id: source configuration file (.g4c)
     :type system_id: int
     :param hub_id_list: array of hub ids the user is requesting data from
     :type hub_id_list: c_list[int]
-    :return: a struct with the position and orientation, a number of active hubs
-     and a number of hubs worth of data returned in the fd (default set to 1)
+    :param num_hubs: number of hubs in hub_id_list (at most MAX_HUBS)
+    :type num_hubs: int
+    :return: a struct with the position and orientation (of the first hub, the others are in FRAME_DATA), a number
+     of active hubs and a number of hubs worth of data returned in the fd
     :rtype: (G4FrameData, int, int)
     """
-    fd = FRAME_DATA
-    res = g4_get_frame_data(ct.byref(fd), ct.c_int(system_id), hub_id_list, HUBS)
+    res = g4_get_frame_data(FRAME_DATA, ct.c_int(system_id), hub_id_list, num_hubs)
 
     res = res & 0xFFFFFFFF
     active_hubs = (res >> 16) & 0xFFFF
     hub_count = res & 0xFFFF
 
-    return fd, active_hubs, hub_count
+    return FIRST_FRAME_DATA, active_hubs, hub_count
+
+
+def get_buffered_frames(system_id, hub_id_list, num_hubs=HUBS):
+    """
+    Get all the frames the sensor has available since the previous call. The G4 only gives its most recent frame,
+    so this is at most one frame and it can be the same frame as before: remove duplicates with the frame counter.
+    :param system_id: system id
+    :type system_id: int
+    :param hub_id_list: array of hub ids the user is requesting data from
+    :type hub_id_list: c_list[int]
+    :param num_hubs: number of hubs in hub_id_list (at most MAX_HUBS)
+    :type num_hubs: int
+    :return: structured array (G4_FRAME_DTYPE) with shape (frames, MAX_HUBS), empty if not every hub sent data
+    :rtype: np.ndarray
+    """
+    _, active_hubs, hub_count = get_frame_data_with_c_list(system_id, hub_id_list, num_hubs)
+    if active_hubs < num_hubs or hub_count != num_hubs:
+        return FRAME_VIEW[np.newaxis, :][:0]
+    return FRAME_VIEW[np.newaxis, :]
 
 
 def create_id(sys=-1, hub=0, sensor=0):
@@ -0,0 +1,38 @@
+import sensor_G4Track
+from constants import SIMULATE_SENSOR
+from logger import get_logbook
+
+"""
+Choose which sensor is used by the rest of the app: the G4 (through the G4Track.dll) or the simulated sensor that
+replays a recording. Both modules have the same functions, so import them from here and not from the modules itself.
+"""
+
+logger = get_logbook('sensor_backend')
+
+IS_SIMULATED = SIMULATE_SENSOR or sensor_G4Track.G4Track is None
+
+if IS_SIMULATED:
+    import sensor_simulated as backend
+
+    if not SIMULATE_SENSOR:
+        logger.warning("G4Track.dll could not be loaded, using the simulated sensor")
+else:
+    backend = sensor_G4Track
+
+initialize_system = backend.initialize_system
+close_sensor = backend.close_sensor
+set_units = backend.set_units
+get_frame_data = backend.get_frame_data
+get_frame_data_with_c_list = backend.get_frame_data_with_c_list
+# All new frames since the previous call, more than one if the sensor keeps the frames that were not read yet
+get_buffered_frames = backend.get_buffered_frames
+BUFFERED_FRAMES = backend.BUFFERED_FRAMES
+# NumPy view on the frames (one for every hub) that get_frame_data fills in
+FRAME_VIEW = backend.FRAME_VIEW
+MAX_HUBS = sensor_G4Track.MAX_HUBS
+get_active_hubs = backend.get_active_hubs
+get_station_map = backend.get_station_map
+frame_reference_orientation = backend.frame_reference_orientation
+frame_reference_orientation_reset = backend.frame_reference_orientation_reset
+frame_reference_translation = backend.frame_reference_translation
+frame_reference_translation_reset = backend.frame_reference_translation_reset
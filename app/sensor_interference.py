@@ -0,0 +1,73 @@
+from collections import deque
+
+
+class RollingMinMax:
+    """
+    Minimum and maximum of the last values in a window, with monotonic deques: every value is added and removed at
+    most once, so an update costs O(1) (amortized) whatever the size of the window
+    """
+    def __init__(self, window):
+        """
+        :param window: number of values in the window
+        """
+        self.window = max(1, window)
+        self.index = 0
+        self._min = deque()
+        self._max = deque()
+
+    def add(self, value):
+        """
+        :param value: the newest value, the oldest one leaves the window
+        """
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((self.index, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((self.index, value))
+
+        oldest = self.index - self.window
+        if self._min[0][0] <= oldest:
+            self._min.popleft()
+        if self._max[0][0] <= oldest:
+            self._max.popleft()
+        self.index += 1
+
+    @property
+    def minimum(self):
+        return self._min[0][1]
+
+    @property
+    def maximum(self):
+        return self._max[0][1]
+
+    @property
+    def range(self):
+        return self._max[0][1] - self._min[0][1] if self._min else 0.0
+
+
+class InterferenceDetector:
+    """
+    Interference of the magnetic field shows as large jumps in the speed of both hands at the same time: the speed of
+    every hand is watched over the last TIME_INTERFERENCE_SPEED seconds
+    """
+    def __init__(self, fs, window_time, max_speed, sensors=2):
+        """
+        :param fs: sample frequency
+        :param window_time: length (s) of the window
+        :param max_speed: largest difference in speed (m/s) within the window that is still normal
+        :param sensors: number of sensors to watch
+        """
+        self.max_speed = max_speed
+        self.windows = [RollingMinMax(round(fs * window_time)) for _ in range(sensors)]
+
+    def add(self, *speeds):
+        """
+        :param speeds: the newest speed of every sensor
+        :return: True if every sensor exceeds the maximal difference in speed
+        """
+        interference = True
+        for window, speed in zip(self.windows, speeds):
+            window.add(speed)
+            interference = interference and window.range > self.max_speed
+        return interference
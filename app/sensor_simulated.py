@@ -0,0 +1,303 @@
+import os
+import random
+import time
+
+import numpy as np
+
+from constants import SIMULATED_RECORDING, SIMULATED_RATE, SIMULATED_JITTER, SIMULATED_DROP_RATE
+from data_trial_file import read_trial
+from logger import get_logbook
+from sensor_G4Track import G4FrameData, G4_sensors_per_hub, G4_FRAME_DTYPE, MAX_HUBS, frame_data_view
+from widget_settings import manage_settings
+
+"""
+Simulated G4 sensor with the same functions as sensor_G4Track. It replays a recorded trial (or a synthetic movement)
+at a fixed frame rate, with jitter on the moment a frame becomes available and randomly dropped frames. Makes it
+possible to run the full acquisition on machines without the G4Track.dll (Linux).
+"""
+
+logger = get_logbook('sensor_simulated')
+
+SIMULATED_SYSTEM_ID = 1
+# The G4 does not start counting at 0 either
+FIRST_FRAME = 1000
+# The simulated sensor keeps the frames that were not read yet (like a tracker that streams its frames), older frames
+# than this get lost
+BUFFERED_FRAMES = True
+BUFFER_SECONDS = 2
+
+
+def load_recording(path):
+    """
+    Load the positions of a recording
+    :param path: a trial_N.xlsx saved by the app or a .npz with the array 'pos' (frames x sensors x 3) and optionally
+        'ori' (frames x sensors x 4)
+    :return: the positions and orientations of every frame as the sensor would give them
+    :rtype: (np.ndarray, np.ndarray)
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as recording:
+            positions = np.asarray(recording['pos'], dtype=np.float32)
+            if 'ori' in recording.files:
+                orientations = np.asarray(recording['ori'], dtype=np.float32)
+            else:
+                orientations = np.zeros(positions.shape[:2] + (4,), dtype=np.float32)
+        return positions, orientations
+
+    trial_data = read_trial(path).iloc[:, 0:9].dropna()
+    positions = np.stack((trial_data.iloc[:, 1:4].to_numpy(dtype=np.float32),
+                          trial_data.iloc[:, 5:8].to_numpy(dtype=np.float32)), axis=1)
+    # the z-axis gets flipped when reading the sensor, flip it back
+    positions[:, :, 2] *= -1
+    return positions, np.zeros(positions.shape[:2] + (4,), dtype=np.float32)
+
+
+def synthetic_recording(rate, duration=10):
+    """
+    Make a periodic movement of both hands (left opens the box, right goes to the button)
+    :param rate: frames per second
+    :param duration: length of one period in seconds
+    """
+    t = np.arange(int(rate * duration)) / rate
+    phase = (1 - np.cos(2 * np.pi * t / duration)) / 2
+
+    positions = np.zeros((len(t), 2, 3), dtype=np.float32)
+    positions[:, 0, 0] = -10 + 2 * phase
+    positions[:, 0, 1] = 5 + 10 * phase
+    positions[:, 0, 2] = -15 * np.sin(np.pi * phase) ** 2
+    positions[:, 1, 0] = 10 - 10 * phase
+    positions[:, 1, 1] = 5 + 10 * phase
+    positions[:, 1, 2] = -5 * np.sin(np.pi * phase)
+    return positions, np.zeros((len(t), 2, 4), dtype=np.float32)
+
+
+class SimulatedSensor:
+    """
+    Replays the frames of a recording in real time, one frame of the recording for every frame of the sensor (a
+    higher rate than the recording plays it faster). The recording is looped. Every hub gets 3 sensors of the
+    recording (sensor 0-2 on hub 0, 3-5 on hub 1, ...).
+    """
+    def __init__(self, recording='', rate=0, jitter=0.0, drop_rate=0.0, seed=None):
+        """
+        :param recording: path to the recording, a synthetic movement is used if empty
+        :param rate: frames per second, 0 to use the sample frequency of the settings
+        :param jitter: standard deviation (s) of the moment a new frame becomes available
+        :param drop_rate: chance that a frame gets lost
+        :param seed: seed for the jitter and the dropped frames
+        """
+        self.rate = rate if rate > 0 else manage_settings.get("Sensors", "fs")
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.rng = random.Random(seed)
+
+        if recording and os.path.exists(recording):
+            self.positions, self.orientations = load_recording(recording)
+        else:
+            if recording:
+                logger.warning(f"Recording {recording} not found, using a synthetic movement")
+            self.positions, self.orientations = synthetic_recording(self.rate)
+
+        self.sensors = min(self.positions.shape[1], G4_sensors_per_hub * MAX_HUBS)
+        self.hubs = -(-self.sensors // G4_sensors_per_hub)
+        self.start_time = time.perf_counter()
+        self.frame = 0
+        self.dropped_frame = -1
+        self.delivered_frame = 0
+
+        self.translation = [0.0, 0.0, 0.0]
+        self.orientation = [0.0, 0.0, 0.0]
+
+    def latest_frame(self):
+        """
+        The most recent frame that is available, keeps the previous frame if the new one got dropped
+        """
+        delay = abs(self.rng.gauss(0, self.jitter)) if self.jitter > 0 else 0
+        frame = int((time.perf_counter() - self.start_time - delay) * self.rate)
+
+        if frame > self.frame:
+            if frame == self.dropped_frame or (self.drop_rate > 0 and self.rng.random() < self.drop_rate):
+                self.dropped_frame = frame
+            else:
+                self.frame = frame
+        return self.frame
+
+    def hub_sensors(self, hub_id):
+        """
+        Number of sensors on a hub
+        """
+        return max(0, min(G4_sensors_per_hub, self.sensors - hub_id * G4_sensors_per_hub))
+
+    def fill(self, view, hub_ids):
+        """
+        Fill the frames of the hubs with the most recent frame
+        :param view: structured array (frame_data_view) of the frames to fill in, one for every hub
+        :param hub_ids: ids of the hubs that are read
+        :return: number of hubs that were filled in
+        """
+        return self.fill_frame(view, self.latest_frame(), hub_ids)
+
+    def buffered_frames(self, hub_ids):
+        """
+        All the frames that became available since the previous call (without the dropped ones)
+        :param hub_ids: ids of the hubs that are read
+        :return: structured array (G4_FRAME_DTYPE) with shape (frames, MAX_HUBS)
+        """
+        delay = abs(self.rng.gauss(0, self.jitter)) if self.jitter > 0 else 0
+        latest = int((time.perf_counter() - self.start_time - delay) * self.rate)
+        first = max(self.delivered_frame + 1, latest - int(BUFFER_SECONDS * self.rate) + 1)
+        if latest < first:
+            return np.zeros((0, MAX_HUBS), dtype=G4_FRAME_DTYPE)
+
+        self.delivered_frame = latest
+        numbers = [frame for frame in range(first, latest + 1)
+                   if not (self.drop_rate > 0 and self.rng.random() < self.drop_rate)]
+
+        frames = np.zeros((len(numbers), MAX_HUBS), dtype=G4_FRAME_DTYPE)
+        for row, frame in zip(frames, numbers):
+            self.fill_frame(row, frame, hub_ids)
+        return frames
+
+    def fill_frame(self, view, frame, hub_ids):
+        """
+        Fill the frames of the hubs with a frame of the recording
+        :param view: structured array (frame_data_view) of the frames to fill in, one for every hub
+        :param frame: number of the frame (counted from the start of the replay)
+        :param hub_ids: ids of the hubs that are read
+        :return: number of hubs that were filled in
+        """
+        index = frame % len(self.positions)
+
+        count = 0
+        for position, hub_id in enumerate(hub_ids):
+            sensors = self.hub_sensors(hub_id)
+            if sensors == 0:
+                continue
+            first = hub_id * G4_sensors_per_hub
+
+            hub = view[position]
+            hub['hub'] = hub_id
+            hub['frame'] = FIRST_FRAME + frame
+            hub['stationMap'] = (1 << sensors) - 1
+            hub['dig_io'] = 0
+            hub['G4_sensor_per_hub']['id'][:sensors] = np.arange(sensors)
+            hub['G4_sensor_per_hub']['pos'][:sensors] = self.positions[index, first:first + sensors]
+            hub['G4_sensor_per_hub']['ori'][:sensors] = self.orientations[index, first:first + sensors]
+            count += 1
+        return count
+
+
+SENSOR = None
+FRAME_DATA = (G4FrameData * MAX_HUBS)()
+FRAME_VIEW = frame_data_view(FRAME_DATA)
+FIRST_FRAME_DATA = FRAME_DATA[0]
+
+
+def initialize_system(src_cfg_file):
+    """
+    Start replaying the recording of constants.SIMULATED_RECORDING
+    :param src_cfg_file: source configuration file (.g4c), not used
+    :returns: True and the system id
+    :rtype: (bool, int)
+    """
+    global SENSOR
+    SENSOR = SimulatedSensor(SIMULATED_RECORDING, SIMULATED_RATE, SIMULATED_JITTER, SIMULATED_DROP_RATE)
+    return True, SIMULATED_SYSTEM_ID
+
+
+def close_sensor():
+    """
+    Stop replaying
+    """
+    global SENSOR
+    SENSOR = None
+
+
+def get_frame_data(system_id, hub_id_list):
+    """
+    Same as sensor_G4Track.get_frame_data
+    :return: a struct with the position and orientation, a number of active hubs
+     and a number of hubs worth of data returned in the fd
+    :rtype: (G4FrameData, int, int)
+    """
+    if SENSOR is None:
+        return FIRST_FRAME_DATA, 0, 0
+
+    hub_count = SENSOR.fill(FRAME_VIEW, hub_id_list)
+    return FIRST_FRAME_DATA, SENSOR.hubs, hub_count
+
+
+def get_frame_data_with_c_list(system_id, hub_id_list, num_hubs=1):
+    """
+    Same as sensor_G4Track.get_frame_data_with_c_list
+    """
+    return get_frame_data(system_id, hub_id_list[:num_hubs])
+
+
+def get_buffered_frames(system_id, hub_id_list, num_hubs=1):
+    """
+    Same as sensor_G4Track.get_buffered_frames, but gives every frame since the previous call
+    """
+    if SENSOR is None or SENSOR.hubs < num_hubs:
+        return np.zeros((0, MAX_HUBS), dtype=G4_FRAME_DTYPE)
+    return SENSOR.buffered_frames(hub_id_list[:num_hubs])
+
+
+def set_units(sys_id):
+    return True
+
+
+def get_active_hubs(sys_id, id_needed=False):
+    """
+    The hubs needed for the sensors of the recording
+    """
+    if SENSOR is None:
+        return None
+    return list(range(SENSOR.hubs)) if id_needed else SENSOR.hubs
+
+
+def get_station_map(sys_id, hub_id):
+    """
+    :return: a tuple with boolean to show which sensor is active
+    :rtype: tuple[bool, bool, bool]
+    """
+    if SENSOR is None:
+        return None
+    return tuple(sensor < SENSOR.hub_sensors(hub_id) for sensor in range(G4_sensors_per_hub))
+
+
+def frame_reference_orientation(sys_id, degree_init=None):
+    """
+    Stored but not applied, the replayed positions are already in the frame of reference of the trial
+    """
+    if SENSOR is None:
+        return False
+    if degree_init is None:
+        return list(SENSOR.orientation)
+    SENSOR.orientation = list(degree_init)
+    return True
+
+
+def frame_reference_orientation_reset(sys_id):
+    if SENSOR is None:
+        return False
+    SENSOR.orientation = [0.0, 0.0, 0.0]
+    return True
+
+
+def frame_reference_translation(sys_id, pos_init=None):
+    """
+    Stored but not applied, the replayed positions are already in the frame of reference of the trial
+    """
+    if SENSOR is None:
+        return False
+    if pos_init is None:
+        return list(SENSOR.translation)
+    SENSOR.translation = list(pos_init)
+    return True
+
+
+def frame_reference_translation_reset(sys_id):
+    if SENSOR is None:
+        return False
+    SENSOR.translation = [0.0, 0.0, 0.0]
+    return True
@@ -0,0 +1,161 @@
+import json
+from bisect import bisect_right
+
+# Upper edges (s) of the bins for the latency of reading a frame and the jitter of the reading loop, last bin is open
+TIME_BINS = (0.0001, 0.00025, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05)
+# Number of missed/duplicate frames in a row, last bin counts everything above
+MAX_FRAME_BIN = 10
+
+
+class TimingStatistic:
+    """
+    Running statistics and histogram of a duration, cheap enough to update every sample
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.histogram = [0] * (len(TIME_BINS) + 1)
+
+    def add(self, duration):
+        """
+        :param duration: duration in seconds
+        """
+        self.count += 1
+        self.total += duration
+        if duration > self.maximum:
+            self.maximum = duration
+        self.histogram[bisect_right(TIME_BINS, duration)] += 1
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean (ms)": round(self.mean * 1000, 4),
+            "max (ms)": round(self.maximum * 1000, 4),
+            "bins (ms)": [round(edge * 1000, 2) for edge in TIME_BINS],
+            "histogram": self.histogram,
+        }
+
+
+class FrameClock:
+    """
+    Maps moments of time.perf_counter on the time of the trial (the frame clock of the sensor). A frame can only be
+    read after it was made, so the smallest difference between the moment a frame was read and its time in the trial
+    is the best estimate of the offset between both clocks.
+    """
+    def __init__(self):
+        self.offset = None
+
+    def reset(self):
+        self.offset = None
+
+    def add(self, read_time, frame_time):
+        """
+        :param read_time: moment (time.perf_counter) the frame was read
+        :param frame_time: time (s) of the frame in the trial
+        """
+        offset = read_time - frame_time
+        if self.offset is None or offset < self.offset:
+            self.offset = offset
+
+    def trial_time(self, moment):
+        """
+        :param moment: a moment of time.perf_counter
+        :return: the time (s) in the trial or None if no frame was read yet
+        """
+        if self.offset is None:
+            return None
+        return moment - self.offset
+
+
+class AcquisitionTelemetry:
+    """
+    Timing of the acquisition of a single trial: how long reading a frame of the sensor takes, how late the reading
+    loop wakes up compared to the planned time and how many frames were missed or read twice.
+    """
+    def __init__(self, fs, pacing=''):
+        """
+        :param fs: sample frequency of the trial
+        :param pacing: strategy used to wait between two cycles of the reading loop
+        """
+        self.fs = fs
+        self.pacing = pacing
+        self.latency = TimingStatistic()
+        self.jitter = TimingStatistic()
+        self.overruns = 0
+        self.frames = 0
+        self.missed_frames = 0
+        self.duplicate_frames = 0
+        self.missed_histogram = [0] * (MAX_FRAME_BIN + 1)
+        self.duplicate_histogram = [0] * (MAX_FRAME_BIN + 1)
+        self.duplicate_run = 0
+
+    def add_latency(self, duration):
+        """
+        :param duration: time (s) needed to read a frame of the sensor
+        """
+        self.latency.add(duration)
+
+    def add_jitter(self, delay):
+        """
+        :param delay: time (s) between the planned and the actual start of a cycle of the reading loop
+        """
+        self.jitter.add(abs(delay))
+
+    def add_overrun(self):
+        """
+        A cycle of the reading loop took longer than the sample period (no time left to sleep)
+        """
+        self.overruns += 1
+
+    def add_frame(self, samples_missed):
+        """
+        :param samples_missed: number of frames between this frame and the previous one, negative if the sensor gave the
+            same frame again
+        """
+        if samples_missed < 0:
+            self.duplicate_frames += 1
+            self.duplicate_run += 1
+            return
+
+        if self.duplicate_run > 0:
+            self.duplicate_histogram[min(self.duplicate_run, MAX_FRAME_BIN)] += 1
+            self.duplicate_run = 0
+
+        self.frames += 1
+        self.missed_frames += samples_missed
+        self.missed_histogram[min(samples_missed, MAX_FRAME_BIN)] += 1
+
+    def status_text(self):
+        """
+        Short summary to show in the status bar
+        """
+        return (f"Read {self.latency.mean * 1000:.2f} ms (max {self.latency.maximum * 1000:.1f}) | "
+                f"jitter {self.jitter.mean * 1000:.2f} ms (max {self.jitter.maximum * 1000:.1f}) | "
+                f"missed {self.missed_frames} | duplicate {self.duplicate_frames} | overruns {self.overruns}")
+
+    def to_dict(self):
+        return {
+            "fs": self.fs,
+            "pacing": self.pacing,
+            "frames": self.frames,
+            "missed frames": self.missed_frames,
+            "duplicate frames": self.duplicate_frames,
+            "overruns": self.overruns,
+            "latency": self.latency.to_dict(),
+            "jitter": self.jitter.to_dict(),
+            "missed histogram": self.missed_histogram,
+            "duplicate histogram": self.duplicate_histogram,
+        }
+
+    def save(self, file_name):
+        """
+        Save the telemetry next to the trial
+        :param file_name: path of the .json
+        """
+        with open(file_name, 'w') as file:
+            json.dump(self.to_dict(), file, indent=4)
@@ -0,0 +1,48 @@
+class DigitalTrigger:
+    """
+    Watches one bit of the digital input (dig_io) that comes with every frame of the G4. A press is a rising edge of
+    the bit that stays set for a number of frames (debounce), its time is the time of the first frame with the bit set.
+    """
+    def __init__(self, bit, debounce=1):
+        """
+        :param bit: the bit of dig_io to watch (0 for the first input)
+        :param debounce: number of frames the bit has to stay set before it counts as a press
+        """
+        self.mask = 1 << bit
+        self.debounce = max(1, debounce)
+        self.released = False
+        self.count = 0
+        self.edge_time = None
+
+    def reset(self):
+        """
+        Start a new trial, a bit that is already set has to be released first
+        """
+        self.released = False
+        self.count = 0
+        self.edge_time = None
+
+    def update(self, dig_io, frame_time):
+        """
+        :param dig_io: the digital input of a frame
+        :param frame_time: time (s) of the frame in the trial
+        :return: time (s) of the press if this frame completes one, otherwise None
+        """
+        if not dig_io & self.mask:
+            self.released = True
+            self.count = 0
+            return None
+
+        if not self.released:
+            return None
+
+        if self.count == 0:
+            self.edge_time = frame_time
+        self.count += 1
+
+        if self.count == self.debounce:
+            # wait for the next release before another press can count
+            self.released = False
+            self.count = 0
+            return self.edge_time
+        return None
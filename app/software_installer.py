@@ -31,6 +31,7 @@ def build_executable(
         '--hidden-import=serial.tools.list_ports',
         '--collect-all=pyserial',
         '--hidden-import=sensor_G4Track',
+        '--hidden-import=sensor_simulated',
         '--hidden-import=constants',
         '--hidden-import=widget_settings'
         #'--collect-all=scipy'
@@ -0,0 +1,58 @@
+import time
+
+import serial
+from PySide6.QtCore import QThread, Signal
+
+from logger import get_logbook
+from widget_settings import manage_settings
+
+
+class ButtonThread(QThread):
+    pressed = Signal(float)
+
+    def __init__(self, parent):
+        """
+        Thread that reads the serial button, so the reading of the sensor never waits for the serial port. Every line
+        gets a timestamp (time.perf_counter) as soon as it arrives, the first press of a trial is sent with that time.
+        """
+        super().__init__(parent)
+
+        self.logger = get_logbook('thread_button')
+        self.active = False
+        self._flush = False
+
+    def start_trial(self):
+        """
+        Start looking for a press, the lines that arrived before are thrown away
+        """
+        self._flush = True
+        self.active = True
+
+    def stop_trial(self):
+        self.active = False
+
+    def run(self):
+        main_window = self.parent()
+
+        while not self.isInterruptionRequested():
+            port = main_window.button_trigger
+            if not self.active or port is None or not manage_settings.get("General", "SERIAL_BUTTON"):
+                QThread.msleep(20)
+                continue
+
+            try:
+                if self._flush:
+                    port.reset_input_buffer()
+                    self._flush = False
+
+                line = port.readline()
+                press_time = time.perf_counter()
+            except (serial.SerialException, AttributeError, TypeError) as e:
+                # the port got closed while waiting for a line
+                self.logger.warning(f"Failed to read the button: {e}")
+                QThread.msleep(100)
+                continue
+
+            if self.active and line.decode('utf-8', errors='ignore').strip() == '0':
+                self.active = False
+                self.pressed.emit(press_time)
@@ -1,14 +1,12 @@
 import os
 
-import openpyxl
-import pandas as pd
-from PySide6.QtCore import QThread, Signal, QMutex, QWaitCondition, Qt
-from PySide6.QtGui import QTextCursor, QColor
-from openpyxl.styles import Alignment, Font
+from PySide6.QtCore import QThread, Signal, QMutex, QWaitCondition
 
-from constants import UNIMAN_PARAMS, BIMAN_PARAMS, LETTER_SIZE, SUBTITLE_LETTER_SIZE, SUB_SUB_TITLE_LETTER_SIZE, \
+from constants import UNIMAN_PARAMS, BIMAN_PARAMS, WRIST_PARAMS, LETTER_SIZE, SUBTITLE_LETTER_SIZE, SUB_SUB_TITLE_LETTER_SIZE, \
     FONT_LETTER_SIZE
-from data_processing import calculate_extra_parameters
+from data_manifest import ParticipantManifest
+from data_summary import new_workbook, write_table
+from thread_save import snapshot_trial, write_trial
 from widget_settings import manage_settings
 
 
@@ -68,6 +66,7 @@ class DownloadThread(QThread):
         self.condition = QWaitCondition()
 
         self.index = index
+        self.manifest = ParticipantManifest(part_folder)
 
     def count_active_tabs(self):
         """
@@ -86,6 +85,9 @@ class DownloadThread(QThread):
 
     def run(self):
         try:
+            # the export writes the same files as the trials that are still saved in the background
+            self.main.save_service.flush()
+
             if self.pdf:
                 self.num_trials = self.count_active_tabs()
                 self.pdf.cell(0, 8, f"Total trials: {self.total_num_trials}", ln=True)
@@ -94,6 +96,7 @@ class DownloadThread(QThread):
             range_index = list(range(self.total_num_trials)) if self.index == -1 else [self.index]
             for i in range_index:
                 self.export_tab(i)
+            self.manifest.save()
 
             if self.pdf:
                 self.pdf.add_page()
@@ -121,47 +124,10 @@ class DownloadThread(QThread):
         if isinstance(tab, TrailTab):
             NUMBER_EVENTS = manage_settings.get("Events", "NUMBER_EVENTS")
 
-            events = [ei if ei is not None else 0 for ei in tab.event_log[0:NUMBER_EVENTS]]
-            self.gopro_time = [round(tab.xs[events[i]] + tab.trial_time_start, 3)
-                               if (tab.trial_time_start != 0 and events[i] != 0) else
-                               round(tab.trial_time_start, 3) for i in range(NUMBER_EVENTS)]
-            print(self.gopro_time)
-
-            print('done making time')
-
-            data = {
-                "Time (s)": tab.xs if tab.xs else [],
-                "Left Sensor x (cm)": [pos[0] for pos in tab.log_left] if tab.xs else [],
-                "Left Sensor y (cm)": [pos[1] for pos in tab.log_left] if tab.xs else [],
-                "Left Sensor z (cm)": [pos[2] for pos in tab.log_left] if tab.xs else [],
-                "Left Sensor v (m/s)": [pos[3] for pos in tab.log_left] if tab.xs else [],
-                "Right Sensor x (cm)": [pos[0] for pos in tab.log_right] if tab.xs else [],
-                "Right Sensor y (cm)": [pos[1] for pos in tab.log_right] if tab.xs else [],
-                "Right Sensor z (cm)": [pos[2] for pos in tab.log_right] if tab.xs else [],
-                "Right Sensor v (m/s)": [pos[3] for pos in tab.log_right] if tab.xs else [],
-                "Score:": [tab.get_score()] if tab.xs else [],
-                " ": [],
-                "Automatic events (/):": [tab.event_log[i] if tab.event_old_log[i] == 0 else tab.event_old_log[i] for i
-                                          in range(NUMBER_EVENTS)] if tab.xs else [],
-                "Manual events (/):": (
-                    [0] * NUMBER_EVENTS if all(e == 0 for e in tab.event_old_log) else tab.event_log) if tab.xs else [],
-                "Position events:": tab.event_position if tab.xs else [],
-                "": [],
-                "Events (s)": [tab.xs[tab.event_log[i]] if tab.event_old_log[i] == 0 else tab.event_old_log[i] for i in
-                               range(NUMBER_EVENTS)] if tab.xs else [],
-                "GoPro events (s):": self.gopro_time,
-                "GoPro start (s)": [tab.trial_time_start],
-            }
-            max_length = max(len(v) for v in data.values())
-            for key in data:
-                data[key].extend([None] * (max_length - len(data[key])))
-            df = pd.DataFrame(data)
-            trial_file = os.path.join(self.participant_folder, f"trial_{index + 1}.xlsx")
-            print('done making excel')
-            if os.path.exists(trial_file):
-                os.remove(trial_file)
-            with pd.ExcelWriter(trial_file) as writer:
-                df.to_excel(writer, index=False)
+            trial_file, data = write_trial(self.participant_folder, snapshot_trial(tab, index), self.manifest)
+            self.gopro_time = data["GoPro events (s):"][0:NUMBER_EVENTS]
+            has_data = len(tab.xs) > 0
+
             if self.pdf:
                 current_y = self.pdf.get_y()
                 page_height = self.pdf.h - 20  # margin
@@ -179,32 +145,11 @@ class DownloadThread(QThread):
                 else:
                     box_hand = 'Both'
                 self.pdf.cell(0, 10,
-                              f"Trial {index + 1}:{f' score {tab.get_score()} & Box Hand: {box_hand}' if tab.xs else ''}",
+                              f"Trial {index + 1}:{f' score {tab.get_score()} & Box Hand: {box_hand}' if has_data else ''}",
                               ln=True)
                 self.pdf.set_font("Arial", size=LETTER_SIZE)
 
-                doc = tab.notes_input.document()
-                block = doc.begin()
-
-                black_fragments = []
-                red_fragments = []
-
-                while block.isValid():
-                    cursor = QTextCursor(block)
-                    if cursor.currentTable() is None:
-                        fmt = cursor.charFormat()
-                        color = fmt.foreground().color()
-                        text = block.text()
-
-                        if color == QColor(Qt.red):
-                            red_fragments.append(text)
-                        else:
-                            black_fragments.append(text)
-
-                    block = block.next()
-
-                filtered_red_fragments = [fram for fram in red_fragments if fram.strip() != '']
-                filtered_black_fragments = [fram for fram in black_fragments if fram.strip() != '']
+                filtered_black_fragments, filtered_red_fragments = tab.get_notes()
 
                 if filtered_red_fragments:
                     red_text = "\n".join(filtered_red_fragments)
@@ -225,7 +170,7 @@ class DownloadThread(QThread):
 
                 self.pdf.ln(5)
 
-                if tab.xs:
+                if has_data:
                     self.pdf.set_font("Arial", style="B", size=SUB_SUB_TITLE_LETTER_SIZE)
                     self.pdf.cell(0, 8, 'Events', ln=True)
 
@@ -284,7 +229,7 @@ class DownloadThread(QThread):
                         events = [ei if ei is not None else 0 for ei in tab.event_log]
 
                         self.mutex.lock()
-                        self.pdf_ready_image.emit(pos_index, tab.xs, left_data, right_data, events,
+                        self.pdf_ready_image.emit(pos_index, data["Time (s)"], left_data, right_data, events,
                                                   tab.event_position, (count_imag, len(self.checkboxes)))
                         count_imag += 1
                         self.condition.wait(self.mutex)
@@ -299,9 +244,8 @@ class DownloadThread(QThread):
 
                 if tab.get_score() == 3:
                     events = [ei if ei is not None else 0 for ei in tab.event_log[0:NUMBER_EVENTS]]
-                    tab.extra_parameters_bim, tab.extra_parameters_uni = calculate_extra_parameters(events,
-                                                                                                    tab.log_left,
-                                                                                                    tab.log_right)
+                    tab.extra_parameters_bim, tab.extra_parameters_uni = tab.parameter_engine().parameters(events,
+                                                                                                           'right')
 
                     self.pdf.set_font("Arial", style="B", size=9)
                     self.pdf.cell(0, 10, 'Parameters', ln=True)
@@ -328,6 +272,11 @@ class DownloadThread(QThread):
                         ['', UNIMAN_PARAMS[9], str(round(tab.extra_parameters_uni[9], 2))],
                     ]
 
+                    wrist = tab.wrist_parameters()
+                    if wrist is not None:
+                        data += [['Wrist' if i == 0 else '', WRIST_PARAMS[i], str(round(param, 2))]
+                                 for i, param in enumerate(wrist)]
+
                     line_height = 8
                     self.pdf.set_fill_color(235, 235, 235)  # lichtgrijs
                     self.pdf.set_text_color(0, 0, 0)
@@ -345,6 +294,10 @@ class DownloadThread(QThread):
 
                         self.pdf.ln(line_height)
 
+            self.manifest.trial(trial_file)["parameters"] = {"bimanual": list(tab.extra_parameters_bim),
+                                                             "unimanual": list(tab.extra_parameters_uni),
+                                                             "wrist": tab.wrist_parameters()}
+
     def average_events_info(self):
         from widget_trials import TrailTab
 
@@ -461,8 +414,13 @@ class DownloadThread(QThread):
             sum_data["Unimanual"][param] = []
             aver_data["Unimanual"][param] = [0, 0]
 
-        valid_ranges = [index for index in range_index if self.main.tab_widget.widget(index).xs]
+        valid_ranges = [index for index in range_index if len(self.main.tab_widget.widget(index).xs) > 0]
         print(range_index, valid_ranges)
+
+        # the wrist rotation only exists for trials with the orientation recorded, the others stay empty
+        wrist_params = {index: self.main.tab_widget.widget(index).wrist_parameters() for index in valid_ranges}
+        if any(wrist is not None for wrist in wrist_params.values()):
+            sum_data["Wrist rotation"] = {param: [] for param in WRIST_PARAMS}
         for index in valid_ranges:
             print(index)
             tab = self.main.tab_widget.widget(index)
@@ -496,6 +454,11 @@ class DownloadThread(QThread):
                 elif tab.case_status == 1:
                     aver_data["Unimanual"][UNIMAN_PARAMS[i]][1] += param
 
+            if "Wrist rotation" in sum_data:
+                wrist = wrist_params[index] or [None] * len(WRIST_PARAMS)
+                for i, param in enumerate(wrist):
+                    sum_data["Wrist rotation"][WRIST_PARAMS[i]].append(param)
+
         for param in aver_data["Bimanual"]:
             aver_data["Bimanual"][param] = [param_lr / aver_data[""]["Number of Trials"][index]
                                             if aver_data[""]["Number of Trials"][index] != 0 else 0
@@ -506,109 +469,12 @@ class DownloadThread(QThread):
                                              if aver_data[""]["Number of Trials"][index] != 0 else 0
                                              for index, param_lr in enumerate(aver_data["Unimanual"][param])]
 
-        columns_sum = pd.MultiIndex.from_tuples([(heading, sub) for heading, subdict in sum_data.items()
-                                                 for sub in subdict])
-        first_heading = next(iter(sum_data))
-        first_sub = next(iter(sum_data[first_heading]))
-        n_rows = len(sum_data[first_heading][first_sub])
-        data_sum = [
-            [sum_data[heading][sub][i] for heading, subdict in sum_data.items() for sub in subdict]
-            for i in range(n_rows)
-        ]
-        df_sum = pd.DataFrame(data_sum, columns=columns_sum)
-
-        columns_aver = pd.MultiIndex.from_tuples(
-            [(heading, sub) for heading, subdict in aver_data.items() for sub in subdict]
-        )
-        data_aver = [
-            [aver_data[heading][sub][i] for heading, subdict in aver_data.items() for sub in subdict]
-            for i in [0, 1]
-        ]
-        df_aver = pd.DataFrame(data_aver, columns=columns_aver)
-
         trial_file = os.path.join(self.participant_folder, f"{self.part_id}.xlsx")
         if os.path.exists(trial_file):
             os.remove(trial_file)
 
-        df_aver.index = ['LEFT', 'RIGHT']
-
-        wb = openpyxl.Workbook()
-        bold_font = Font(bold=True)
-
-        # summary-sheet
-        ws_summary = wb.active
-        ws_summary.title = 'Summary'
-        trial_cell = ws_summary.cell(row=2, column=1, value='Trial')
-        trial_cell.font = bold_font
-        ws_summary.cell(row=2, column=1, value='Trial')
-        col = 2
-        for level0, level1 in df_sum.columns:
-            level0_cell = ws_summary.cell(row=1, column=col, value=level0)
-            level0_cell.font = bold_font
-            level1_cell = ws_summary.cell(row=2, column=col, value=level1)
-            level1_cell.font = bold_font
-            col += 1
-        for row_idx, (trial_num, row_data) in enumerate(df_sum.iterrows()):
-            excel_row = row_idx + 3
-            trial_num = valid_ranges[row_idx] + 1
-            ws_summary.cell(row=excel_row, column=1, value=trial_num)
-            for col_idx, value in enumerate(row_data, start=2):
-                ws_summary.cell(row=excel_row, column=col_idx, value=value)
-
-        # average-sheet
-        ws_average = wb.create_sheet('Average')
-        bh_cell = ws_average.cell(row=2, column=1, value='BH')
-        bh_cell.font = bold_font
-        col = 2
-        for level0, level1 in df_aver.columns:
-            level0_cell = ws_average.cell(row=1, column=col, value=level0)
-            level0_cell.font = bold_font
-            level1_cell = ws_average.cell(row=2, column=col, value=level1)
-            level1_cell.font = bold_font
-            col += 1
-        bh_values = ['LEFT', 'RIGHT']
-        for row_idx, (bh_value, row_data) in enumerate(df_aver.iterrows()):
-            excel_row = row_idx + 3
-            bh_label = bh_values[row_idx]
-            ws_average.cell(row=excel_row, column=1, value=bh_label)
-            for col_idx, value in enumerate(row_data, start=2):
-                ws_average.cell(row=excel_row, column=col_idx, value=value)
-
-        current_col = 2
-        current_header = None
-        start_col = 2
-
-        for level0, level1 in df_sum.columns:
-            if level0 != current_header:
-                if current_header is not None and current_col > start_col:
-                    ws_summary.merge_cells(start_row=1, start_column=start_col, end_row=1, end_column=current_col - 1)
-                    ws_summary.cell(row=1, column=start_col).alignment = Alignment(horizontal='center')
-
-                current_header = level0
-                start_col = current_col
-            current_col += 1
-
-        if current_col > start_col:
-            ws_summary.merge_cells(start_row=1, start_column=start_col, end_row=1, end_column=current_col - 1)
-            ws_summary.cell(row=1, column=start_col).alignment = Alignment(horizontal='center')
-
-        current_col = 2
-        current_header = None
-        start_col = 2
-
-        for level0, level1 in df_aver.columns:
-            if level0 != current_header:
-                if current_header is not None and current_col > start_col:
-                    ws_average.merge_cells(start_row=1, start_column=start_col, end_row=1, end_column=current_col - 1)
-                    ws_average.cell(row=1, column=start_col).alignment = Alignment(horizontal='center')
-
-                current_header = level0
-                start_col = current_col
-            current_col += 1
-
-        if current_col > start_col:
-            ws_average.merge_cells(start_row=1, start_column=start_col, end_row=1, end_column=current_col - 1)
-            ws_average.cell(row=1, column=start_col).alignment = Alignment(horizontal='center')
-
+        wb = new_workbook()
+        write_table(wb.create_sheet('Summary'), 'Trial', [index + 1 for index in valid_ranges], sum_data)
+        write_table(wb.create_sheet('Average'), 'BH', ['LEFT', 'RIGHT'], aver_data)
         wb.save(trial_file)
 
@@ -0,0 +1,77 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from PySide6.QtCore import QThread, Signal
+
+from constants import INGEST_PROCESSES
+from data_ingest import parse_trial, parse_notes, needs_excel
+from logger import get_logbook
+
+
+class IngestThread(QThread):
+    parsed_trial = Signal(object)
+    parsed_notes = Signal(object)
+    failed = Signal(str)
+    progress = Signal(int)
+
+    def __init__(self, parent, trial_files, pdf_files, number_events, manual_events):
+        """
+        Read all the files of a participant folder in a pool of workers, every file is sent to the main window as soon
+        as it is read (parsed_trial and parsed_notes)
+        :param parent: the main window
+        :param trial_files: paths of the trial_N.xlsx
+        :param pdf_files: paths of the PDFs
+        :param number_events: number of events of a trial
+        :param manual_events: use the manual events of the files
+        """
+        super().__init__(parent)
+
+        self.logger = get_logbook('thread_ingest')
+        self.trial_files = trial_files
+        self.pdf_files = pdf_files
+        self.number_events = number_events
+        self.manual_events = manual_events
+
+    def make_pool(self):
+        """
+        Reading an Excel is slow and holds the GIL, so these are read in separate processes. The binary copies and the
+        PDF are read fast enough in threads (starting the processes would take longer).
+        """
+        workers = max(1, min(os.cpu_count() or 1, len(self.trial_files) + len(self.pdf_files)))
+        if INGEST_PROCESSES and sum(needs_excel(file) for file in self.trial_files) > 1:
+            try:
+                return ProcessPoolExecutor(max_workers=workers)
+            except (OSError, NotImplementedError) as e:
+                self.logger.warning(f"Failed to start the processes, reading in threads: {e}")
+        return ThreadPoolExecutor(max_workers=workers)
+
+    def run(self):
+        total = len(self.trial_files) + len(self.pdf_files)
+        if total == 0:
+            self.progress.emit(100)
+            return
+
+        with self.make_pool() as pool:
+            jobs = {pool.submit(parse_trial, file, self.number_events, self.manual_events): file
+                    for file in self.trial_files}
+            jobs.update({pool.submit(parse_notes, file): file for file in self.pdf_files})
+
+            for count, job in enumerate(as_completed(jobs), 1):
+                if self.isInterruptionRequested():
+                    for other in jobs:
+                        other.cancel()
+                    break
+
+                file = jobs[job]
+                try:
+                    result = job.result()
+                except Exception as e:
+                    self.logger.error(f"Failed to read {file}: {e}", exc_info=True)
+                    self.failed.emit(file)
+                else:
+                    if file in self.pdf_files:
+                        self.parsed_notes.emit(result)
+                    else:
+                        self.parsed_trial.emit(result)
+
+                self.progress.emit(round(100 * count / total))
@@ -0,0 +1,118 @@
+import ctypes as ct
+import ctypes.util
+import errno
+import sys
+import time
+
+from constants import PACING_SPIN
+from logger import get_logbook
+from sensor_telemetry import TimingStatistic
+
+"""
+Wait until an exact moment in the reading loop. The strategy depends on the platform:
+- 'clock_nanosleep' (Linux): sleep until an absolute time of CLOCK_MONOTONIC (the clock of time.perf_counter), the
+  wake-up does not drift when the sleep gets interrupted
+- 'hybrid' (Windows and others): sleep until shortly before the moment (with a timer resolution of 1 ms on Windows)
+  and spin the last part
+"""
+
+logger = get_logbook('thread_pacer')
+
+CLOCK_MONOTONIC = 1
+TIMER_ABSTIME = 1
+
+
+class Timespec(ct.Structure):
+    _fields_ = [('tv_sec', ct.c_long), ('tv_nsec', ct.c_long)]
+
+
+def load_clock_nanosleep():
+    """
+    :return: clock_nanosleep of the C library or None if it is not available
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ct.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        clock_nanosleep = libc.clock_nanosleep
+    except (OSError, AttributeError):
+        return None
+    clock_nanosleep.argtypes = [ct.c_int, ct.c_int, ct.POINTER(Timespec), ct.POINTER(Timespec)]
+    clock_nanosleep.restype = ct.c_int
+    return clock_nanosleep
+
+
+class Pacer:
+    """
+    Sleeps until a deadline on the time.perf_counter clock and keeps the statistics of how late it woke up
+    """
+    def __init__(self, spin=PACING_SPIN):
+        """
+        :param spin: last part (s) of a wait that is spent spinning with the hybrid strategy
+        """
+        self.spin = spin
+        self.jitter = TimingStatistic()
+        self.started = False
+
+        self._clock_nanosleep = load_clock_nanosleep()
+        self._deadline = Timespec()
+        if self._clock_nanosleep is not None:
+            self.strategy = 'clock_nanosleep'
+            # perf_counter uses CLOCK_MONOTONIC on Linux, but keep the offset in case it does not
+            self._offset = time.clock_gettime(CLOCK_MONOTONIC) - time.perf_counter()
+        else:
+            self.strategy = 'hybrid'
+            self._offset = 0.0
+
+    def start(self):
+        """
+        Ask the OS for the highest timer resolution (only needed on Windows)
+        """
+        if not self.started and hasattr(ct, 'windll'):
+            ct.windll.winmm.timeBeginPeriod(1)
+        self.started = True
+        self.jitter = TimingStatistic()
+
+    def stop(self):
+        """
+        Give the timer resolution back and log the jitter that was reached
+        """
+        if self.started and hasattr(ct, 'windll'):
+            ct.windll.winmm.timeEndPeriod(1)
+        self.started = False
+        if self.jitter.count:
+            logger.info(f"Pacing with {self.strategy}: jitter {self.jitter.mean * 1000:.3f} ms "
+                        f"(max {self.jitter.maximum * 1000:.3f} ms) over {self.jitter.count} waits")
+
+    def sleep(self, duration):
+        """
+        :param duration: time (s) to wait
+        :return: how late (s) the wait ended
+        """
+        return self.sleep_until(time.perf_counter() + duration)
+
+    def sleep_until(self, deadline):
+        """
+        Wait until the deadline, returns immediately if it already passed
+        :param deadline: moment on the time.perf_counter clock
+        :return: how late (s) the wait ended
+        """
+        if deadline <= time.perf_counter():
+            return time.perf_counter() - deadline
+
+        if self._clock_nanosleep is not None:
+            monotonic = deadline + self._offset
+            self._deadline.tv_sec = int(monotonic)
+            self._deadline.tv_nsec = int((monotonic - int(monotonic)) * 1e9)
+            while self._clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, ct.byref(self._deadline), None) == errno.EINTR:
+                pass
+        else:
+            remaining = deadline - time.perf_counter()
+            if remaining > self.spin:
+                time.sleep(remaining - self.spin)
+            while time.perf_counter() < deadline:
+                pass
+
+        late = time.perf_counter() - deadline
+        self.jitter.add(max(0.0, late))
+        return late
@@ -2,30 +2,38 @@ import math
 import random
 import time
 
-import serial
+import numpy as np
+
 from PySide6.QtCore import QThread, Signal, QMutex, QWaitCondition
 
 from logger import get_logbook
-from sensor_G4Track import get_frame_data, get_frame_data_with_c_list
-from constants import READ_SAMPLE, BEAUTY_SPEED
+from sensor_backend import get_frame_data_with_c_list, get_buffered_frames, FRAME_VIEW, MAX_HUBS, BUFFERED_FRAMES
+from sensor_telemetry import AcquisitionTelemetry, FrameClock
+from sensor_trigger import DigitalTrigger
+from sensor_interference import InterferenceDetector
+from data_journal import TrialJournal
+from thread_pacer import Pacer
+from constants import READ_SAMPLE, BEAUTY_SPEED, STREAM_READING, STREAM_WAKE_RATE, LOST_CONNECTION_SAMPLES
 from widget_settings import manage_settings
 
 import ctypes as ct
 
 fs = manage_settings.get("Sensors", "fs")
-HUBS = 1
-SERIAL_BUTTON = manage_settings.get("General", "SERIAL_BUTTON")
 MAX_INTERFERENCE_SPEED = manage_settings.get("General", "MAX_INTERFERENCE_SPEED")
 TIME_INTERFERENCE_SPEED = manage_settings.get("General", "TIME_INTERFERENCE_SPEED")
 
 ADD_DATA = False
 SLEEP_NEEDED = True
+# the G4 only keeps the most recent frame, so streaming would poll faster than fs and mostly find the same frame again:
+# stream only when the sensor keeps its frames
+STREAM = STREAM_READING and BUFFERED_FRAMES
 
 
 class ReadThread(QThread):
     lost_connection = Signal()
     interference = Signal()
     done_reading = Signal()
+    timing = Signal(str)
 
     def __init__(self, parent):
         """
@@ -38,45 +46,117 @@ class ReadThread(QThread):
         self.dongle = None
         self.tab = None
         self.sensor_died = 10
+        # lost_connection is only sent once per trial
+        self.connection_lost = False
+        # what is needed to make the journal of the trial, None if no journal has to be made
+        self.journal_info = None
         self.send_interference = False
-        self.speed1 = []
-        self.speed2 = []
+        self.interference_detector = None
         self.logger = get_logbook('thread_reading')
-        self.HUB_ID_ARRAY = (ct.c_int * HUBS)()
+        self.HUB_ID_ARRAY = (ct.c_int * MAX_HUBS)()
+        self.hub_count = 1
+        self.pacer = Pacer()
+        # maps the moment of a button press on the time of the trial
+        self.frame_clock = FrameClock()
+        # button connected to the digital input of the G4 (None if not used)
+        self.trigger = None
+        self.telemetry = AcquisitionTelemetry(fs, self.pacer.strategy)
+        # views (hub, sensor) on the positions of the sensors in the frames that get filled in by
+        # get_frame_data_with_c_list
+        self.sensor_positions = FRAME_VIEW['G4_sensor_per_hub']['pos']
+        self.sensor_orientations = FRAME_VIEW['G4_sensor_per_hub']['ori']
+        # hub and sensor of every sensor that is stored (hands first)
+        self.layout_hubs = np.zeros(2, dtype=np.intp)
+        self.layout_sensors = np.array([0, 1], dtype=np.intp)
+        # all stored sensors, z-axis flipped
+        self.positions = np.zeros((2, 3), dtype=np.float64)
+        self.orientations = np.zeros((2, 4), dtype=np.float32)
 
         self._pause_mutex = QMutex()
         self._pause_condition = QWaitCondition()
         self._paused = False
         self._paused_flag = False
 
-        self.interval = 1 / fs
+        self.interval = self.read_interval()
 
     def start_tab_reading(self, tab):
         self.tab = tab
-        global fs, SERIAL_BUTTON, MAX_INTERFERENCE_SPEED, TIME_INTERFERENCE_SPEED
+        global fs, MAX_INTERFERENCE_SPEED, TIME_INTERFERENCE_SPEED
         fs = manage_settings.get("Sensors", "fs")
         MAX_INTERFERENCE_SPEED = manage_settings.get("General", "MAX_INTERFERENCE_SPEED")
         TIME_INTERFERENCE_SPEED = manage_settings.get("General", "TIME_INTERFERENCE_SPEED")
         self.sensor_died = 10
+        self.connection_lost = False
         self.send_interference = False
-        self.speed1 = []
-        self.speed2 = []
+        self.interference_detector = InterferenceDetector(fs, TIME_INTERFERENCE_SPEED, MAX_INTERFERENCE_SPEED)
 
-        self.interval = 1 / fs
+        self.interval = self.read_interval()
         self.timer_beauty = time.perf_counter()
 
+        self.telemetry = AcquisitionTelemetry(fs, self.pacer.strategy)
+        tab.telemetry = self.telemetry
+        self.frame_clock.reset()
+
+        self.trigger = None
+        if manage_settings.get("General", "DIG_IO_BUTTON"):
+            self.trigger = DigitalTrigger(manage_settings.get("General", "DIG_IO_INPUT") - 1,
+                                          manage_settings.get("General", "DIG_IO_DEBOUNCE"))
+
+        main_window = self.parent()
+        layout = getattr(main_window, 'sensor_layout', [])
+        if len(tab.trial_buffer) == 0:
+            roles = getattr(main_window, 'sensor_roles', None) if layout else None
+            tab.trial_buffer.clear(orientation=bool(manage_settings.get("Sensors", "RECORD_ORIENTATION")), roles=roles)
+        self.set_layout(layout[:tab.trial_buffer.sensors], tab.trial_buffer.sensors)
+
+        # the journal is made by the reading thread at the first frame (making the file takes a while)
+        self.journal_info = None
+        if tab.journal is None and not READ_SAMPLE:
+            self.journal_info = dict(trial=tab.trial_number, participant=getattr(main_window, 'id_part', ''),
+                                     folder=getattr(main_window, 'participant_folder', None),
+                                     save_dir=getattr(main_window, 'save_dir', ''))
+
+    def set_layout(self, layout, sensors):
+        """
+        Choose which sensors of the frames are copied to the trial
+        :param layout: (position of the hub, sensor) of every sensor, hands first
+        :param sensors: number of sensors stored in the trial (the ones missing in the layout stay 0)
+        """
+        self.layout_hubs = np.array([hub for hub, _ in layout], dtype=np.intp)
+        self.layout_sensors = np.array([sensor for _, sensor in layout], dtype=np.intp)
+        self.positions = np.zeros((sensors, 3), dtype=np.float64)
+        self.orientations = np.zeros((sensors, 4), dtype=np.float32)
+
+    def samples_lost(self):
+        """
+        :return: True if the positions of both hands were zero for the last LOST_CONNECTION_SAMPLES samples
+        """
+        buffer = self.tab.trial_buffer
+        if len(buffer) < LOST_CONNECTION_SAMPLES:
+            return False
+        last = slice(-LOST_CONNECTION_SAMPLES, None)
+        return not (buffer.left[last, :3].any() or buffer.right[last, :3].any())
+
     def stop_current_reading(self):
-        print(len(self.tab.xs))
+        self.timing.emit(self.telemetry.status_text())
         self.tab = None
         self.sensor_died = 10
         self.send_interference = False
-        self.speed1 = []
-        self.speed2 = []
+        self.interference_detector = None
         self.done_reading.emit()
 
-        self.interval = 1 / fs
+        self.interval = self.read_interval()
         self.timer_beauty = None
 
+    @staticmethod
+    def read_interval():
+        """
+        Time between two wake-ups of the reading loop
+        """
+        if READ_SAMPLE or not STREAM:
+            return 1 / fs
+        return 1 / STREAM_WAKE_RATE
+
     def pause(self):
         self._pause_mutex.lock()
         self._paused = True
@@ -93,15 +173,18 @@ class ReadThread(QThread):
             QThread.msleep(10)
 
     def run(self):
-        ct.windll.winmm.timeBeginPeriod(1)
+        self.pacer.start()
 
         main_window = self.parent()
         from window_main_plot import MainWindow
-        if isinstance(main_window, MainWindow) and main_window.dongle_id and main_window.hub_id:
-            self.HUB_ID_ARRAY[0] = main_window.hub_id
+        if isinstance(main_window, MainWindow) and main_window.dongle_id and main_window.hub_ids:
+            for position, hub_id in enumerate(main_window.hub_ids):
+                self.HUB_ID_ARRAY[position] = hub_id
+            self.hub_count = len(main_window.hub_ids)
             self.dongle = main_window.dongle_id
 
         next_time = -1
+        last_timing = time.perf_counter()
 
         while not self.isInterruptionRequested():
             self._pause_mutex.lock()
@@ -113,10 +196,15 @@ class ReadThread(QThread):
 
             try:
                 if self.tab is not None:
+                    if next_time != -1:
+                        self.telemetry.add_jitter(time.perf_counter() - next_time)
                     self.read_sensor_data()
                     if next_time == -1:
                         next_time = time.perf_counter()
                         timer_samples = time.perf_counter()
+                    elif next_time - last_timing > 1:
+                        last_timing = next_time
+                        self.timing.emit(self.telemetry.status_text())
                 else:
                     self.keep_sensor_alive()
                     next_time = -1
@@ -129,17 +217,22 @@ class ReadThread(QThread):
             if next_time != -1:
                 next_time += self.interval
                 sleep_time = next_time - time.perf_counter()
+                if sleep_time <= 0:
+                    self.telemetry.add_overrun()
             else:
                 sleep_time = self.interval
 
             if sleep_time > 0 and SLEEP_NEEDED:
-                time.sleep(sleep_time)
+                if next_time != -1:
+                    self.pacer.sleep_until(next_time)
+                else:
+                    self.pacer.sleep(sleep_time)
             elif ADD_DATA and (BEAUTY_SPEED or READ_SAMPLE) and self.tab is not None and len(self.tab.xs) > 1:
                 extra_time = abs(sleep_time)
                 samples_missed = math.ceil(extra_time / self.interval)
                 if extra_time > self.interval:
-                    last_data = [self.tab.log_left[-1], self.tab.log_right[-1]]
-                    snd_last_data = [self.tab.log_left[-2], self.tab.log_right[-2]]
+                    last_data = [tuple(self.tab.log_left[-1]), tuple(self.tab.log_right[-1])]
+                    snd_last_data = [tuple(self.tab.log_left[-2]), tuple(self.tab.log_right[-2])]
 
                     diff_left = [(last - prev) / (samples_missed + 1)
                                  for last, prev in zip(last_data[0][:3], snd_last_data[0][:3])]
@@ -147,32 +240,120 @@ class ReadThread(QThread):
                                   for last, prev in zip(last_data[1][:3], snd_last_data[1][:3])]
 
                     base_time = self.tab.xs[-2]
+                    # take the last sample out, so the interpolated ones can be appended in front of it
+                    self.tab.trial_buffer.pop()
                     for i in range(0, samples_missed):
                         interpolated_time = base_time + (i + 1) / fs
 
                         left_data = tuple([pos_i + (i + 1) * diff_i
                                            for pos_i, diff_i in zip(snd_last_data[0][0:3], diff_left)])
                         left_data += (
-                        self.tab.speed_calculation(left_data, interpolated_time, len(self.tab.xs) - 2, True),)
+                        self.tab.speed_calculation(left_data, interpolated_time, len(self.tab.xs) - 1, True),)
                         right_data = tuple([pos_i + (i + 1) * diff_i
                                             for pos_i, diff_i in zip(snd_last_data[1][0:3], diff_right)])
                         right_data += (
-                        self.tab.speed_calculation(right_data, interpolated_time, len(self.tab.xs) - 2, False),)
+                        self.tab.speed_calculation(right_data, interpolated_time, len(self.tab.xs) - 1, False),)
 
-                        self.tab.log_left.insert(-1, left_data)
-                        self.tab.log_right.insert(-1, right_data)
-                        self.tab.xs.insert(-1, interpolated_time)
+                        self.tab.trial_buffer.append(interpolated_time, left_data, right_data)
                         next_time += self.interval
 
-                    time_now = (len(self.tab.xs) - 1) / fs
-                    left_data = self.tab.log_left[-1][:3]
-                    left_data += (self.tab.speed_calculation(left_data, time_now, len(self.tab.xs) - 2, True),)
-                    right_data = self.tab.log_right[-1][:3]
-                    right_data += (self.tab.speed_calculation(right_data, time_now, len(self.tab.xs) - 2, False),)
+                    time_now = len(self.tab.xs) / fs
+                    left_data = last_data[0][:3]
+                    left_data += (self.tab.speed_calculation(left_data, time_now, len(self.tab.xs) - 1, True),)
+                    right_data = last_data[1][:3]
+                    right_data += (self.tab.speed_calculation(right_data, time_now, len(self.tab.xs) - 1, False),)
+
+                    self.tab.trial_buffer.append(time_now, left_data, right_data)
+
+        self.pacer.stop()
+
+    def read_buffered_frames(self, main_window):
+        """
+        Add every frame the sensor has given since the previous call to the trial, the frame counter places every frame
+        at its exact time and drops the frames that were already added
+        :param main_window: the main window with the connection to the sensor
+        """
+        start_read = time.perf_counter()
+        frames = get_buffered_frames(main_window.dongle_id, self.HUB_ID_ARRAY, self.hub_count)
+        read_time = time.perf_counter()
+        self.telemetry.add_latency(read_time - start_read)
+
+        buffer = self.tab.trial_buffer
+        for frame in frames:
+            number = int(frame[0]['frame'])
+            if len(buffer) == 0:
+                self.first_frame = number
+                self.telemetry.add_frame(0)
+            else:
+                samples_missed = number - (self.first_frame + round(buffer.xs[-1] * fs)) - 1
+                # the duplicates are counted by the telemetry before they are dropped
+                self.telemetry.add_frame(samples_missed)
+                if samples_missed < 0:
+                    continue
+
+            used = len(self.layout_hubs)
+            sensors = frame['G4_sensor_per_hub']
+            self.positions[:used] = sensors['pos'][self.layout_hubs, self.layout_sensors]
+            self.positions[:, 2] *= -1
+
+            time_now = (number - self.first_frame) / fs
+            self.frame_clock.add(read_time, time_now)
+            self.check_trigger(int(frame[0]['dig_io']), time_now)
+            if buffer.has_orientation:
+                self.orientations[:used] = sensors['ori'][self.layout_hubs, self.layout_sensors]
+                buffer.append_positions(time_now, self.positions, self.orientations)
+            else:
+                buffer.append_positions(time_now, self.positions)
+            self.journal_frame(number, time_now, int(frame[0]['dig_io']))
+            self.check_interference()
+
+    def journal_frame(self, frame, time_now, dig_io):
+        """
+        Write the frame that was just added to the journal of the trial
+        :param frame: frame number of the sensor
+        :param time_now: time (s) of the frame in the trial
+        :param dig_io: digital input of the frame
+        """
+        if self.tab.journal is None and self.journal_info is not None:
+            buffer = self.tab.trial_buffer
+            try:
+                self.tab.journal = TrialJournal.create(fs, buffer.roles, orientation=buffer.has_orientation,
+                                                       **self.journal_info)
+            except (OSError, ValueError) as e:
+                self.logger.warning(f"Failed to make a journal for the trial: {e}")
+            self.journal_info = None
+
+        if self.tab.journal is not None:
+            self.tab.journal.append(frame, time_now, self.positions,
+                                    self.orientations if self.tab.trial_buffer.has_orientation else None, dig_io)
 
-                    self.tab.xs[-1] = time_now
-                    self.tab.log_left[-1] = left_data
-                    self.tab.log_right[-1] = right_data
+    def check_interference(self):
+        """
+        Add the speed of both hands of the newest sample to the interference detector, warns once per trial
+        """
+        if self.interference_detector is None:
+            return
+
+        buffer = self.tab.trial_buffer
+        index = len(buffer) - 1
+        if self.interference_detector.add(buffer.column(0, 3)[index], buffer.column(1, 3)[index]) and \
+                not self.send_interference:
+            self.send_interference = True
+            self.interference.emit()
+
+    def check_trigger(self, dig_io, time_now):
+        """
+        Look for a press of the button on the digital input of the G4, the press gets the time of its frame
+        :param dig_io: the digital input of the frame
+        :param time_now: time (s) of the frame in the trial
+        """
+        if self.trigger is None or self.tab.button_pressed:
+            return
+
+        press_time = self.trigger.update(dig_io, time_now)
+        if press_time is not None:
+            self.tab.button_time = press_time
+            self.tab.button_pressed = True
 
     def keep_sensor_alive(self):
         """
@@ -180,7 +361,7 @@ class ReadThread(QThread):
         """
 
         if not READ_SAMPLE and self.dongle:
-            get_frame_data_with_c_list(self.dongle, self.HUB_ID_ARRAY)
+            get_frame_data_with_c_list(self.dongle, self.HUB_ID_ARRAY, self.hub_count)
 
     def read_sensor_data(self):
         """
@@ -198,44 +379,52 @@ class ReadThread(QThread):
             return
 
         try:
-            if not READ_SAMPLE:
+            if not READ_SAMPLE and STREAM:
+                if not main_window.is_connected:
+                    self.tab.trial_buffer.append(len(self.tab.xs) / fs, (0, 0, 0, 0), (0, 0, 0, 0))
+
+                self.read_buffered_frames(main_window)
+
+            elif not READ_SAMPLE:
                 if isinstance(main_window, MainWindow):
                     if not main_window.is_connected:
-                        self.tab.xs.append(len(self.tab.xs) / fs)
-                        self.tab.log_left.append((0, 0, 0, 0))
-                        self.tab.log_right.append((0, 0, 0, 0))
+                        self.tab.trial_buffer.append(len(self.tab.xs) / fs, (0, 0, 0, 0), (0, 0, 0, 0))
 
+                start_read = time.perf_counter()
                 frame_data, active_count, data_hubs = get_frame_data_with_c_list(main_window.dongle_id,
-                                                                                 self.HUB_ID_ARRAY)
+                                                                                 self.HUB_ID_ARRAY, self.hub_count)
+                read_time = time.perf_counter()
+                self.telemetry.add_latency(read_time - start_read)
 
-                if (active_count, data_hubs) != (1, 1):
+                if active_count < self.hub_count or data_hubs != self.hub_count:
                     return
 
                 if len(self.tab.xs) == 0:
                     self.first_frame = frame_data.frame
 
                 time_now = (frame_data.frame - self.first_frame) / fs
+                self.frame_clock.add(read_time, time_now)
 
                 if len(self.tab.xs) > 1:
                     last_frame = round(self.tab.xs[-1] * fs)
                     samples_missed = round(time_now * fs) - (last_frame + 1)
-                    if samples_missed > 0: print(samples_missed)
+                    self.telemetry.add_frame(samples_missed)
                 else:
                     samples_missed = 1
+                    self.telemetry.add_frame(0)
 
                 if samples_missed < 0:
                     return
+                self.check_trigger(frame_data.dig_io, time_now)
 
-                pos1 = tuple(frame_data.G4_sensor_per_hub[main_window.lindex].pos)
-                pos1 = tuple([pos1[i] if i != 2 else -pos1[i] for i in range(3)])
-
-                pos2 = tuple(frame_data.G4_sensor_per_hub[main_window.rindex].pos)
-                pos2 = tuple([pos2[i] if i != 2 else -pos2[i] for i in range(3)])
+                used = len(self.layout_hubs)
+                self.positions[:used] = self.sensor_positions[self.layout_hubs, self.layout_sensors]
+                self.positions[:, 2] *= -1
 
                 if ADD_DATA and len(self.tab.xs) > 1 and samples_missed > 0:
                     print(samples_missed)
-                    last_data = [self.tab.log_left[-1], self.tab.log_right[-1]]
-                    snd_last_data = [self.tab.log_left[-2], self.tab.log_right[-2]]
+                    last_data = [tuple(self.tab.log_left[-1]), tuple(self.tab.log_right[-1])]
+                    snd_last_data = [tuple(self.tab.log_left[-2]), tuple(self.tab.log_right[-2])]
 
                     diff_left = [(last - prev) / (samples_missed + 1)
                                  for last, prev in zip(last_data[0][:3], snd_last_data[0][:3])]
@@ -255,31 +444,15 @@ class ReadThread(QThread):
                         right_data += (
                             self.tab.speed_calculation(right_data, interpolated_time, len(self.tab.xs) - 2, False),)
 
-                        self.tab.log_left.append(left_data)
-                        self.tab.log_right.append(right_data)
-                        self.tab.xs.append(interpolated_time)
-
-                v1 = self.tab.speed_calculation(pos1, time_now, len(self.tab.xs) - 1, True)
-                v2 = self.tab.speed_calculation(pos2, time_now, len(self.tab.xs) - 1, False)
-
-                pos1 += (v1,)
-                pos2 += (v2,)
+                        self.tab.trial_buffer.append(interpolated_time, left_data, right_data)
 
-                self.tab.xs.append(time_now)
-                self.tab.log_left.append(pos1)
-                self.tab.log_right.append(pos2)
-                """
-                self.speed1.append(v1)
-                self.speed1 = self.speed1[-fs*TIME_INTERFERENCE_SPEED:]
-                self.speed2.append(v2)
-                self.speed2 = self.speed2[-fs * TIME_INTERFERENCE_SPEED:]
-
-                if not self.send_interference and max(self.speed1) - min(self.speed1) > MAX_INTERFERENCE_SPEED and \
-                        max(self.speed2) - min(self.speed2) > MAX_INTERFERENCE_SPEED:
-                    print('here')
-                    self.send_interference = True
-                    self.interference.emit()
-                """
+                if self.tab.trial_buffer.has_orientation:
+                    self.orientations[:used] = self.sensor_orientations[self.layout_hubs, self.layout_sensors]
+                    self.tab.trial_buffer.append_positions(time_now, self.positions, self.orientations)
+                else:
+                    self.tab.trial_buffer.append_positions(time_now, self.positions)
+                self.journal_frame(frame_data.frame, time_now, frame_data.dig_io)
+                self.check_interference()
             elif BEAUTY_SPEED:
                 if len(self.tab.xs) == 0:
                     self.timer_beauty = time.perf_counter()
@@ -291,6 +464,7 @@ class ReadThread(QThread):
                 exp_time = round((time.perf_counter() - self.timer_beauty) * fs) / fs
                 if exp_time < time_now:
                     return
+                self.frame_clock.add(time.perf_counter(), time_now)
                 if exp_time < 5:
                     pos1 = (0, 0, -5 * exp_time,)
                     pos2 = (0, 5 * exp_time, 0,)
@@ -319,9 +493,7 @@ class ReadThread(QThread):
                 v2 = self.tab.speed_calculation(pos2, time_now, len(self.tab.xs) - 1, False)
                 pos2 += (v2,)
 
-                self.tab.xs.append(len(self.tab.xs) / fs)
-                self.tab.log_left.append(pos1)
-                self.tab.log_right.append(pos2)
+                self.tab.trial_buffer.append(len(self.tab.xs) / fs, pos1, pos2)
 
             else:
                 # QThread.msleep(int(1/fs * 1000))
@@ -338,27 +510,15 @@ class ReadThread(QThread):
                 v2 = self.tab.speed_calculation(pos2, time_now, len(self.tab.xs) - 1, False)
                 pos2 += (v2,)
 
-                self.tab.xs.append(len(self.tab.xs) / fs)
-                self.tab.log_left.append(pos1)
-                self.tab.log_right.append(pos2)
-
-            if SERIAL_BUTTON and main_window.button_trigger is not None:
-                try:
-                    line = '1'
-                    while main_window.button_trigger.in_waiting > 0:
-                        line = main_window.button_trigger.readline().decode('utf-8').rstrip()
-
-                    if line == '0':
-                        self.tab.button_pressed = True
-                        print(len(self.tab.xs))
-                except serial.SerialException as e:
-                    self.logger.warning(f"Failed to connect to button: {e}", exc_info=True)
-                    print(f"Failed to connect to button: {e}")
+                self.tab.trial_buffer.append(len(self.tab.xs) / fs, pos1, pos2)
 
+            # the serial button is read by ButtonThread, it sets button_pressed
             if self.tab and self.tab.button_pressed:
                 self.stop_current_reading()
 
-            if self.tab and self.tab.log_left[3] == 0:
+            # the sensor only gives zeros if the connection is lost
+            if self.tab and not self.connection_lost and self.samples_lost():
+                self.connection_lost = True
                 self.lost_connection.emit()
         except:
             return
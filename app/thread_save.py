@@ -0,0 +1,268 @@
+import os
+from collections import OrderedDict
+
+import pandas as pd
+from PySide6.QtCore import QThread, Signal, QMutex, QWaitCondition, QDeadlineTimer
+
+from constants import SAVE_QUEUE_SIZE
+from data_buffer import save_orientation, save_extra_sensors
+from data_manifest import ParticipantManifest
+from data_trial_file import save_trial_file
+from logger import get_logbook
+from widget_settings import manage_settings
+
+
+def snapshot_trial(tab, index):
+    """
+    Copy everything of a trial that is saved, so the trial can be written in another thread while the tab goes on
+    :param tab: the tab of the trial
+    :type tab: TrailTab
+    :param index: index of the trial
+    """
+    from widget_trials import TrialState
+
+    # the trial is safe once the Excel is written, the journal is removed then
+    journal = None
+    if tab.journal is not None and tab.trial_state == TrialState.completed:
+        journal = tab.journal
+        tab.journal = None
+
+    notes, automatic_notes = tab.get_notes()
+    return {
+        "index": index,
+        "buffer": tab.trial_buffer.copy(),
+        "score": tab.get_score(),
+        "case_status": tab.case_status,
+        "event_log": list(tab.event_log),
+        "event_old_log": list(tab.event_old_log),
+        "event_position": list(tab.event_position),
+        "trial_time_start": tab.trial_time_start,
+        "button_time": tab.button_time,
+        "notes": notes,
+        "automatic_notes": automatic_notes,
+        "parameters": {"bimanual": list(tab.extra_parameters_bim), "unimanual": list(tab.extra_parameters_uni)},
+        "telemetry": tab.telemetry,
+        "journal": journal,
+    }
+
+
+def trial_table(snapshot):
+    """
+    The columns of the Excel of a trial
+    :param snapshot: the trial from snapshot_trial
+    :return: dict with the values of every column (all of the same length)
+    """
+    NUMBER_EVENTS = manage_settings.get("Events", "NUMBER_EVENTS")
+
+    buffer = snapshot["buffer"]
+    xs, log_left, log_right = buffer.xs, buffer.left, buffer.right
+    event_log, event_old_log = snapshot["event_log"], snapshot["event_old_log"]
+    trial_time_start = snapshot["trial_time_start"]
+
+    events = [ei if ei is not None else 0 for ei in event_log[0:NUMBER_EVENTS]]
+    gopro_time = [round(xs[events[i]] + trial_time_start, 3)
+                  if (trial_time_start != 0 and events[i] != 0) else
+                  round(trial_time_start, 3) for i in range(NUMBER_EVENTS)]
+
+    has_data = len(xs) > 0
+    data = {
+        "Time (s)": xs.tolist() if has_data else [],
+        "Left Sensor x (cm)": log_left[:, 0].tolist() if has_data else [],
+        "Left Sensor y (cm)": log_left[:, 1].tolist() if has_data else [],
+        "Left Sensor z (cm)": log_left[:, 2].tolist() if has_data else [],
+        "Left Sensor v (m/s)": log_left[:, 3].tolist() if has_data else [],
+        "Right Sensor x (cm)": log_right[:, 0].tolist() if has_data else [],
+        "Right Sensor y (cm)": log_right[:, 1].tolist() if has_data else [],
+        "Right Sensor z (cm)": log_right[:, 2].tolist() if has_data else [],
+        "Right Sensor v (m/s)": log_right[:, 3].tolist() if has_data else [],
+        "Score:": [snapshot["score"]] if has_data else [],
+        " ": [],
+        "Automatic events (/):": [event_log[i] if event_old_log[i] == 0 else event_old_log[i] for i
+                                  in range(NUMBER_EVENTS)] if has_data else [],
+        "Manual events (/):": (
+            [0] * NUMBER_EVENTS if all(e == 0 for e in event_old_log) else list(event_log)) if has_data else [],
+        "Position events:": list(snapshot["event_position"]) if has_data else [],
+        "": [],
+        "Events (s)": [xs[event_log[i]] if event_old_log[i] == 0 else event_old_log[i] for i in
+                       range(NUMBER_EVENTS)] if has_data else [],
+        "GoPro events (s):": gopro_time,
+        "GoPro start (s)": [trial_time_start],
+        "Button press (s)": [snapshot["button_time"]],
+    }
+    max_length = max(len(v) for v in data.values())
+    for key in data:
+        data[key].extend([None] * (max_length - len(data[key])))
+    return data
+
+
+def write_trial(folder, snapshot, manifest):
+    """
+    Write all the files of a trial (Excel, binary copy, orientation, extra sensors, timing) and add it to the manifest
+    :param folder: the participant folder
+    :param snapshot: the trial from snapshot_trial
+    :param manifest: the changes to the manifest of the folder (not saved here)
+    :type manifest: ParticipantManifest
+    :return: path of the Excel and the columns of the Excel
+    """
+    NUMBER_EVENTS = manage_settings.get("Events", "NUMBER_EVENTS")
+
+    index = snapshot["index"]
+    buffer = snapshot["buffer"]
+    data = trial_table(snapshot)
+    df = pd.DataFrame(data)
+
+    trial_file = os.path.join(folder, f"trial_{index + 1}.xlsx")
+    try:
+        if os.path.exists(trial_file):
+            os.remove(trial_file)
+        with pd.ExcelWriter(trial_file) as writer:
+            df.to_excel(writer, index=False)
+        save_trial_file(trial_file, df)
+        if buffer.has_orientation:
+            save_orientation(trial_file, buffer)
+        if buffer.extra_roles:
+            save_extra_sensors(trial_file, buffer)
+        if snapshot["telemetry"] is not None:
+            snapshot["telemetry"].save(os.path.join(folder, f"trial_{index + 1}_timing.json"))
+    except Exception:
+        # the journal stays on the disk, so the trial can still be recovered
+        if snapshot["journal"] is not None:
+            snapshot["journal"].close()
+        raise
+
+    if snapshot["journal"] is not None:
+        snapshot["journal"].discard()
+
+    manifest.set_trial(index, trial_file, {
+        "samples": len(buffer),
+        "score": snapshot["score"],
+        "case_status": snapshot["case_status"],
+        "automatic_events": data["Automatic events (/):"][0:NUMBER_EVENTS],
+        "manual_events": data["Manual events (/):"][0:NUMBER_EVENTS],
+        "position_events": data["Position events:"][0:NUMBER_EVENTS],
+        "trial_time_start": snapshot["trial_time_start"],
+        "button_time": snapshot["button_time"],
+        "notes": snapshot["notes"],
+        "automatic_notes": snapshot["automatic_notes"],
+        "parameters": snapshot["parameters"],
+    })
+    return trial_file, data
+
+
+class SaveService(QThread):
+    status = Signal(int, str, str)
+
+    def __init__(self, parent, max_jobs=SAVE_QUEUE_SIZE):
+        """
+        Writes the trials in the background, one after the other, so saving a trial never holds up the reading or the
+        plot of the next trial. A trial that is saved again before it was written is only written once (the newest
+        state). The state of every trial ('queued', 'saving', 'saved' or 'failed') is sent with status.
+        :param parent: the main window
+        :param max_jobs: number of trials that can wait before the number of waiting trials is shown (none are dropped)
+        """
+        super().__init__(parent)
+
+        self.logger = get_logbook('thread_save')
+        self.max_jobs = max(1, max_jobs)
+        self.jobs = OrderedDict()
+        self.states = {}
+        self.busy = False
+        self.stopping = False
+
+        self.mutex = QMutex()
+        self.condition = QWaitCondition()
+
+    def submit(self, folder, snapshot):
+        """
+        Add a trial to the queue
+        :param folder: the participant folder
+        :param snapshot: the trial from snapshot_trial
+        """
+        index = snapshot["index"]
+
+        self.mutex.lock()
+        if index in self.jobs:
+            previous = self.jobs[index][1]
+            # the newest state replaces the one that is still waiting, keep the journal until one of them is written
+            if snapshot["journal"] is None:
+                snapshot["journal"] = previous["journal"]
+            self.jobs[index] = (folder, snapshot)
+        else:
+            # never wait here (this is the GUI thread) and never drop a trial: the queue just gets longer
+            self.jobs[index] = (folder, snapshot)
+        waiting = len(self.jobs)
+        self.states[index] = 'queued'
+        self.condition.wakeAll()
+        self.mutex.unlock()
+
+        message = ''
+        if waiting > self.max_jobs:
+            message = f"{waiting} trials are waiting to be saved"
+            self.logger.warning(message)
+        self.status.emit(index, 'queued', message)
+
+    def state(self, index):
+        """
+        :param index: index of the trial
+        :return: the state of the last save of the trial, None if it was never saved
+        """
+        return self.states.get(index)
+
+    def flush(self, timeout=None):
+        """
+        Wait until all the trials in the queue are written
+        :param timeout: longest time (s) to wait, None to wait until all are written
+        :return: True if all the trials are written
+        """
+        deadline = QDeadlineTimer(QDeadlineTimer.Forever) if timeout is None else QDeadlineTimer(int(timeout * 1000))
+
+        self.mutex.lock()
+        while (self.jobs or self.busy) and self.isRunning():
+            if not self.condition.wait(self.mutex, deadline):
+                break
+        done = not self.jobs and not self.busy
+        self.mutex.unlock()
+        return done
+
+    def stop(self):
+        """
+        Write all the trials that are still waiting and stop the thread
+        """
+        self.mutex.lock()
+        self.stopping = True
+        self.condition.wakeAll()
+        self.mutex.unlock()
+        self.wait()
+
+    def run(self):
+        while True:
+            self.mutex.lock()
+            while not self.jobs and not self.stopping:
+                self.condition.wait(self.mutex)
+            if not self.jobs:
+                self.mutex.unlock()
+                break
+
+            index, (folder, snapshot) = self.jobs.popitem(last=False)
+            self.states[index] = 'saving'
+            self.busy = True
+            self.condition.wakeAll()
+            self.mutex.unlock()
+
+            self.status.emit(index, 'saving', '')
+            try:
+                manifest = ParticipantManifest(folder)
+                write_trial(folder, snapshot, manifest)
+                manifest.save()
+                state, message = 'saved', ''
+            except Exception as e:
+                self.logger.error(f"Failed to save trial {index + 1}: {e}", exc_info=True)
+                state, message = 'failed', str(e)
+
+            self.mutex.lock()
+            self.states[index] = state
+            self.busy = False
+            self.condition.wakeAll()
+            self.mutex.unlock()
+
+            self.status.emit(index, state, message)
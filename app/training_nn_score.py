@@ -1,7 +1,6 @@
 import os
 
 import numpy as np
-import pandas as pd
 
 import openpyxl
 from tensorflow import keras
@@ -9,18 +8,20 @@ from keras.models import Sequential
 from keras.layers import Masking, LSTM, Dense, Dropout
 from keras.callbacks import EarlyStopping
 
+from data_study import StudyDatabase
+from data_trial_file import open_trial, read_samples
+
 
 def extract_excel_for_nn(file):
     """
     Extract all the data (coordinates and score) for training the neural network
     """
-    trial_data = pd.read_excel(file)
-
-    if trial_data.shape[0] < 1 or trial_data.shape[1] < 10:
-        return None, -1
+    with open_trial(file) as trial:
+        if trial.rows < 1 or len(trial.names) < 10:
+            return None, -1
 
-    coor = trial_data.iloc[:, 1:9].values
-    score = trial_data.iloc[0, 9]
+        coor = np.column_stack([trial.values(i) for i in range(1, 9)])
+        score = trial.values(9)[0]
 
     return coor, score
 
@@ -54,6 +55,16 @@ def main():
     length_x = []
     y = []
 
+    # the participant folders (a study folder) are read with the study database, only the new files are read
+    study = StudyDatabase.open(folder)
+    study.ingest()
+    for trial in study.query_trials(scored=True):
+        coor_i = np.column_stack(read_samples(trial['file'])[1:9])
+        x.append(coor_i)
+        length_x.append(len(coor_i))
+        y.append(trial['score'])
+    study.close()
+
     for filename in os.listdir(folder):
         file_path = os.path.join(folder, filename)
 
@@ -8,9 +8,10 @@ from PySide6.QtCore import Qt, QTimer
 
 
 class ProgressionBar(QDialog):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, text="Please wait. Download in progress"):
         """
         Show a progress bar when downloading a file or another task
+        :param text: the text above the bar
         """
         super().__init__(parent)
         file_directory = (os.path.dirname(os.path.abspath(__file__)))
@@ -24,7 +25,7 @@ class ProgressionBar(QDialog):
         layout = QVBoxLayout()
 
         text_label = QLabel()
-        text_label.setText("Please wait. Download in progress")
+        text_label.setText(text)
         text_label.setAlignment(Qt.AlignLeft | Qt.AlignTop)
         layout.addWidget(text_label)
 
@@ -89,6 +89,9 @@ class SettingsManager:
             "General": {
                 "MAX_TRIALS": 20,
                 "SERIAL_BUTTON": True,
+                "DIG_IO_BUTTON": False,
+                "DIG_IO_INPUT": 1,
+                "DIG_IO_DEBOUNCE": 3,
                 "USE_NEURAL_NET": True,
                 "MAX_INTERFERENCE_SPEED": 20,
                 "TIME_INTERFERENCE_SPEED": 0.3
@@ -105,6 +108,8 @@ class SettingsManager:
                 "fc": 10,
                 "SENSORS_USED": 2,
                 "MAX_ATTEMPTS_CONNECT": 10,
+                "RECORD_ORIENTATION": False,
+                "RECORD_EXTRA_SENSORS": False,
             },
             "Data-processing": {
                 "ORDER_FILTER": 2,
@@ -273,8 +278,8 @@ class Settings(QDialog):
                     var_layout.addWidget(value_box)
                     page_layout.addLayout(var_layout)
                     self.var_widget[(tab, variabel)] = value_box
-                    if variabel in ['MAX_TRIALS', "SENSORS_USED", "MAX_ATTEMPTS_CONNECT",
-                                    "MAX_ATTEMPTS_CALIBRATION", "ORDER_FILTER", "ORDER_EXTREMA"]:
+                    if variabel in ['MAX_TRIALS', "SENSORS_USED", "MAX_ATTEMPTS_CONNECT", "MAX_ATTEMPTS_CALIBRATION",
+                                    "ORDER_FILTER", "ORDER_EXTREMA", "DIG_IO_INPUT", "DIG_IO_DEBOUNCE"]:
                         validator = IntPointlessValidator(r'^[0-9]*$', 1, 1000)
                         value_box.setValidator(validator)
                     else:
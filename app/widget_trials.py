@@ -1,7 +1,9 @@
 import random
+import time
 from math import sqrt
 
 import matplotlib.collections
+import numpy as np
 import pygame
 from enum import Enum
 import threading
@@ -17,13 +19,13 @@ from matplotlib.figure import Figure
 from matplotlib.lines import Line2D
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 
-from data_processing import calculate_boxhand, calculate_e6, calculate_events, calculate_extra_parameters, \
-    calculate_position_events, predict_score, interpolate
+from data_buffer import TrialBuffer
+from data_processing import calculate_boxhand, calculate_e6, calculate_events, ParameterEngine, \
+    calculate_position_events, predict_score, interpolate, interpolate_orientation, interpolate_sensors, \
+    filter_hands, calculate_wrist_parameters
 
-from scipy import signal
 
 from logger import get_logbook
-from thread_reading import ReadThread
 from window_main_plot import MainWindow
 from widget_settings import manage_settings
 from constants import READ_SAMPLE, COLORS, BIMAN_PARAMS, UNIMAN_PARAMS
@@ -51,18 +53,6 @@ def colors_to_hex(colors):
     return hex_colors
 
 
-def diff_speed_calculation(last, prev):
-    """
-    Calculate the speed using the fs as timestamp and the two coordinates
-    :return: the speed
-    """
-    fs = manage_settings.get("Sensors", "fs")
-
-    return (sqrt(((last[0] - prev[0]) * fs) ** 2 +
-                 ((last[1] - prev[1]) * fs) ** 2 +
-                 ((last[2] - prev[2]) * fs) ** 2) / 100)
-
-
 class TrailTab(QWidget):
     """
     Needed to show the plot and all the information related to a trial
@@ -94,10 +84,20 @@ class TrailTab(QWidget):
 
         self.pos_left = [0, 0, 0]
         self.pos_right = [0, 0, 0]
-        self.xs = []
-        self.log_left = []
-        self.log_right = []
+        self._trial_buffer = TrialBuffer()
+        # samples of a trial that is saved in a file can be freed and loaded again when they are needed
+        self.samples_source = None
+        self.samples_digest = None
+        self.samples_released = False
+        # the samples are also read by the threads that save and export the trial
+        self.samples_lock = threading.RLock()
+        self.last_shown = 0.0
+        self.telemetry = None
+        # raw frames of the trial on the disk until the trial is saved
+        self.journal = None
         self.button_pressed = False
+        # time (s) of the button press in the trial (between two samples), None if not known
+        self.button_time = None
 
         self.first_event_guess = True
         self.first_process = True
@@ -107,21 +107,53 @@ class TrailTab(QWidget):
         self.event_position = [None] * NUMBER_EVENTS
         self.extra_parameters_bim = [0]*len(BIMAN_PARAMS)
         self.extra_parameters_uni = [0]*len(UNIMAN_PARAMS)
+        # the ParameterEngine of the samples and the version of the samples it belongs to
+        self._parameter_engine = None
+        self._parameter_version = None
 
         self.plot_left_data = []
         self.plot_right_data = []
 
         self.sound = None
 
-        self.data_thread = ReadThread(self)
-
         self.setup()
 
+    @property
+    def trial_buffer(self):
+        """
+        The samples of the trial, loaded again from the file if they were freed
+        :rtype: TrialBuffer
+        """
+        with self.samples_lock:
+            if self.samples_released:
+                # only marked as loaded once the samples are all there
+                buffer = self.samples_source()
+                self.samples_digest = buffer.digest()
+                self._trial_buffer = buffer
+                self.samples_released = False
+            return self._trial_buffer
+
+    @property
+    def xs(self):
+        return self.trial_buffer.xs
+
+    @property
+    def log_left(self):
+        return self.trial_buffer.left
+
+    @property
+    def log_right(self):
+        return self.trial_buffer.right
+
     def setup(self):
         self.layout_tab = QHBoxLayout()
         self.setLayout(self.layout_tab)
 
-        self.setup_plot()
+        # the plot is only made when the tab is shown (see ensure_plot)
+        self.figure = None
+        self.canvas = None
+        self.ax = None
+        self.plot_outdated = False
 
         self.notes_score_widget = QWidget()
         self.notes_score_layout = QVBoxLayout(self.notes_score_widget)
@@ -154,9 +186,6 @@ class TrailTab(QWidget):
         self.notes_score_layout.addWidget(self.notes_widget)
 
         self.layout_tab.addWidget(self.notes_score_widget, 1)
-        self.layout_tab.setStretch(1, 1)
-
-        self.canvas.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
 
         self.timer_plot = QTimer(self)
         self.timer_plot.timeout.connect(self.update_plot)
@@ -219,9 +248,76 @@ class TrailTab(QWidget):
         self.ax.legend(handles=legend_elements, loc='upper center',
                   bbox_to_anchor=(0.5, -0.12), ncol=6)
 
-        self.layout_tab.addWidget(self.canvas, 2)
+        self.layout_tab.insertWidget(0, self.canvas, 2)
         self.figure.tight_layout()
 
+    def ensure_plot(self, force=False):
+        """
+        Make the plot if the tab is shown, a tab that is not shown only remembers that its plot has to be updated
+        :param force: make the plot even if the tab is not shown
+        :return: True if the plot is there
+        """
+        if self.canvas is not None:
+            return True
+        if not (force or self.isVisible()):
+            self.plot_outdated = True
+            return False
+
+        self.setup_plot()
+        return True
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.last_shown = time.monotonic()
+        if self.canvas is None or self.plot_outdated:
+            self.ensure_plot(True)
+            self.plot_outdated = False
+            self.update_plot(True)
+
+    def release_plot(self):
+        """
+        Free the figure and the canvas of a tab that is not shown, they are made again when the tab is shown
+        """
+        if self.canvas is None or self.isVisible() or self.reading_active:
+            return
+
+        self.layout_tab.removeWidget(self.canvas)
+        self.canvas.deleteLater()
+        self.figure.clear()
+        self.figure = None
+        self.canvas = None
+        self.ax = None
+        self.scatter = []
+        self.move_event = None
+        self.plot_left_data = []
+        self.plot_right_data = []
+
+    def release_samples(self):
+        """
+        Free the samples if they did not change since they were loaded from the file
+        :return: True if the samples are freed
+        """
+        with self.samples_lock:
+            if self.samples_released or self.samples_source is None or self.trial_state != TrialState.completed or \
+                    self.canvas is not None or self._trial_buffer.digest() != self.samples_digest:
+                return False
+
+            self._trial_buffer = TrialBuffer(1)
+            self._parameter_engine = None
+            self.samples_released = True
+            return True
+
+    def memory_usage(self):
+        """
+        Estimate of the memory (bytes) of the samples and the plot of the tab
+        """
+        usage = 0 if self.samples_released else self._trial_buffer.nbytes
+        if self.canvas is not None:
+            # the image of the figure (Agg) and its copy in Qt
+            ratio = self.canvas.devicePixelRatioF()
+            usage += 2 * 4 * int(self.canvas.width() * ratio) * int(self.canvas.height() * ratio)
+        return usage
+
     def pick_a_point(self, event):
         """
         Take the coordinates of the selected point or move the scatter-events if selected
@@ -351,20 +447,56 @@ class TrailTab(QWidget):
             self.move_event = None
             self.moving_event_index = None
 
+            self.update_parameters()
+
+    def parameter_engine(self):
+        """
+        The ParameterEngine of the samples, only made again when the samples changed
+        :rtype: ParameterEngine
+        """
+        buffer = self.trial_buffer
+        if self._parameter_engine is None or self._parameter_version != (id(buffer), buffer.version):
+            self._parameter_engine = ParameterEngine(buffer.left, buffer.right)
+            self._parameter_version = (id(buffer), buffer.version)
+        return self._parameter_engine
+
+    def update_parameters(self):
+        """
+        Calculate the parameters again with the current events (only for a trial with score 3 and all the events set,
+        the total time has to be positive)
+        """
+        events = self.event_log[0:6]
+        complete = len(events) == 6 and all(ei is not None for ei in events) and \
+            events[5] - min(events[0], events[3]) > 0
+        if self.get_score() == 3 and complete and len(self.xs) > 0:
+            box_hand = 'left' if self.case_status == 0 else 'right'
+            self.extra_parameters_bim, self.extra_parameters_uni = \
+                self.parameter_engine().parameters(events, box_hand)
+        else:
+            self.extra_parameters_bim = [0] * len(BIMAN_PARAMS)
+            self.extra_parameters_uni = [0] * len(UNIMAN_PARAMS)
+
+    def wrist_parameters(self):
+        """
+        Rotation of the wrists between the events (see WRIST_PARAMS)
+        :return: the parameters, or None when the orientation is not recorded or the events are not all set
+        """
+        buffer = self.trial_buffer
+        events = self.event_log[0:6]
+        if not buffer.has_orientation or self.get_score() != 3 or len(events) != 6 or None in events:
+            return None
+        box_hand = 'left' if self.case_status == 0 else 'right'
+        return calculate_wrist_parameters(buffer.orientation, events, buffer.roles.index(box_hand))
+
     def new_starting_point(self, ind, x):
         if self.xs[ind] != x:
             return
 
         self.window().setEnabled(False)
 
-        temp = self.xs
-        self.xs = [time-temp[ind] for time in self.xs[ind:]]
-
-        temp = self.log_left
-        self.log_left = [temp[i] for i in range(ind, len(self.log_left))]
-
-        temp = self.log_right
-        self.log_right = [temp[i] for i in range(ind, len(self.log_right))]
+        self.trial_buffer.crop(ind, len(self.trial_buffer), rebase_time=True)
+        if self.button_time is not None:
+            self.button_time -= x
 
         if self.event_log[-1] != 0:
             try:
@@ -392,13 +524,7 @@ class TrailTab(QWidget):
 
         self.window().setEnabled(False)
 
-        self.xs = [time for time in self.xs[:ind]]
-
-        temp = self.log_left
-        self.log_left = [temp[i] for i in range(0, ind)]
-
-        temp = self.log_right
-        self.log_right = [temp[i] for i in range(0, ind)]
+        self.trial_buffer.crop(0, ind)
 
         if self.event_log[-1] != 0:
             try:
@@ -445,6 +571,7 @@ class TrailTab(QWidget):
         if self.trial_state == TrialState.completed:
             NUMBER_EVENTS = manage_settings.get("Events", "NUMBER_EVENTS")
 
+            self.ensure_plot(True)
             if self.vt:
                 self.ax.set_ylim(0, 3)
             else:
@@ -453,9 +580,14 @@ class TrailTab(QWidget):
 
             self.pos_left = (0, 0, 0)
             self.pos_right = (0, 0, 0)
-            self.xs = []
-            self.log_left = []
-            self.log_right = []
+            # the new samples are not in a file
+            self.samples_source = None
+            self.samples_released = False
+            self.trial_buffer.clear()
+            self.telemetry = None
+            if self.journal is not None:
+                self.journal.discard()
+                self.journal = None
 
             self.plot_left_data = []
             self.plot_right_data = []
@@ -468,6 +600,7 @@ class TrailTab(QWidget):
             self.event_position = [None] * NUMBER_EVENTS
 
             self.button_pressed = False
+            self.button_time = None
             self.first_event_guess = True
             self.original_data_file = False
 
@@ -533,6 +666,34 @@ class TrailTab(QWidget):
         cursor.setPosition(end_text)
         self.notes_input.setTextCursor(cursor)
 
+    def get_notes(self):
+        """
+        Get the notes outside the tables, split in the notes of the user (black) and the notes added by the program (red)
+        :return: the lines of the user and the lines of the program, without the empty lines
+        """
+        doc = self.notes_input.document()
+        block = doc.begin()
+
+        black_fragments = []
+        red_fragments = []
+
+        while block.isValid():
+            cursor = QTextCursor(block)
+            if cursor.currentTable() is None:
+                fmt = cursor.charFormat()
+                color = fmt.foreground().color()
+                text = block.text()
+
+                if color == QColor(Qt.red):
+                    red_fragments.append(text)
+                else:
+                    black_fragments.append(text)
+
+            block = block.next()
+
+        return [fram for fram in black_fragments if fram.strip() != ''], \
+            [fram for fram in red_fragments if fram.strip() != '']
+
     def xt_plot(self):
         self.xt = True
         self.yt = False
@@ -565,38 +726,14 @@ class TrailTab(QWidget):
 
         self.update_plot(True)
 
-    def process(self, b, a):
+    def process(self):
         """
         Implement the Butterworth filter on the speed (and the coordinates if needed)
         """
-        SPEED_FILTER = manage_settings.get("Data-processing", "SPEED_FILTER")
-        if not SPEED_FILTER:
-            output_left_x = signal.filtfilt(b, a, [pos[0] for pos in self.log_left])
-            output_left_y = signal.filtfilt(b, a, [pos[1] for pos in self.log_left])
-            output_left_z = signal.filtfilt(b, a, [pos[2] for pos in self.log_left])
-            output_right_x = signal.filtfilt(b, a, [pos[0] for pos in self.log_right])
-            output_right_y = signal.filtfilt(b, a, [pos[1] for pos in self.log_right])
-            output_right_z = signal.filtfilt(b, a, [pos[2] for pos in self.log_right])
-
-            for index in range(len(self.log_left)):
-                lpos = (output_left_x[index], output_left_y[index], output_left_z[index])
-                rpos = (output_right_x[index], output_right_y[index], output_right_z[index])
-
-                if index > 0:
-                    lpos += (self.speed_calculation(lpos, self.xs[index], index-1, True),)
-                    rpos += (self.speed_calculation(rpos, self.xs[index], index-1, False),)
-                else:
-                    lpos += (0, )
-                    rpos += (0, )
-
-                self.log_left[index] = lpos
-                self.log_right[index] = rpos
-
-        output_left_speed = signal.filtfilt(b, a, [pos[3] for pos in self.log_left])
-        output_right_speed = signal.filtfilt(b, a, [pos[3] for pos in self.log_right])
-        for index in range(len(self.log_left)):
-            self.log_left[index] = tuple(self.log_left[index][0:3]) + (output_left_speed[index],)
-            self.log_right[index] = tuple(self.log_right[index][0:3]) + (output_right_speed[index],)
+        new_left, new_right = filter_hands(self.xs, self.log_left, self.log_right)
+        self.log_left[:] = new_left
+        self.log_right[:] = new_right
+        self.trial_buffer.changed()
 
         self.update_plot(True)
 
@@ -608,27 +745,16 @@ class TrailTab(QWidget):
         if len(new_left) == 0:
             return
 
-        new_coor_left = []
-        new_coor_right = []
-        for index in range(len(new_left)):
-            lpos = tuple(new_left[index])
-            rpos = tuple(new_right[index])
-
-            if index > 0:
-                lpos += (diff_speed_calculation(lpos, tuple(new_left[index-1])),)
-                rpos += (diff_speed_calculation(rpos, tuple(new_right[index-1])),)
-            else:
-                lpos += (0,)
-                rpos += (0,)
-
-            new_coor_left.append(lpos)
-            new_coor_right.append(rpos)
+        new_orientation = None
+        if self.trial_buffer.has_orientation:
+            new_orientation = interpolate_orientation(self.xs, self.trial_buffer.orientation, new_time)
 
-        print(len(new_time), len(new_coor_left), len(new_coor_right))
+        new_extra = None
+        extra_roles = self.trial_buffer.extra_roles
+        if extra_roles:
+            new_extra = interpolate_sensors(self.xs, self.trial_buffer.extra_sensors(), new_time)
 
-        self.xs = new_time.tolist()
-        self.log_left = new_coor_left
-        self.log_right = new_coor_right
+        self.trial_buffer.set_data(new_time, new_left, new_right, new_orientation, new_extra, extra_roles)
 
     def update_plot(self, redraw=False, parent=None):
         """
@@ -642,40 +768,48 @@ class TrailTab(QWidget):
                 main_window = self.window()
 
             if isinstance(main_window, MainWindow):
+                if not self.ensure_plot():
+                    return
+
                 COLORS_EVENT = manage_settings.get("Events", "COLORS_EVENT")
                 colors_hex = colors_to_hex(COLORS_EVENT)
                 LABEL_EVENT = manage_settings.get("Events", "LABEL_EVENT")
                 NUMBER_EVENTS = manage_settings.get("Events", "NUMBER_EVENTS")
 
+                # the reading thread keeps appending, so take views of the same length for all the columns
+                xs = self.xs
+                log_left = self.log_left[:len(xs)]
+                log_right = self.log_right[:len(xs)]
+
                 if self.xt:
                     self.ax.set_title(f'Trial {self.trial_number + 1} - x-coordinates')
                     self.ax.set_ylabel('X-coordinates (cm)')
 
-                    self.plot_left_data = [abs(pos[0]) if main_window.set_abs_value else pos[0] for pos in
-                                           self.log_left]
-                    self.plot_right_data = [pos[0] for pos in self.log_right]
+                    self.plot_left_data = np.abs(log_left[:, 0]) if main_window.set_abs_value else \
+                        log_left[:, 0]
+                    self.plot_right_data = log_right[:, 0]
                 elif self.yt:
                     self.ax.set_title(f'Trial {self.trial_number + 1} - y-coordinates')
                     self.ax.set_ylabel('Y-coordinates (cm)')
 
-                    self.plot_left_data = [pos[1] for pos in self.log_left]
-                    self.plot_right_data = [pos[1] for pos in self.log_right]
+                    self.plot_left_data = log_left[:, 1]
+                    self.plot_right_data = log_right[:, 1]
                 elif self.zt:
                     self.ax.set_title(f'Trial {self.trial_number + 1} - z-coordinates')
                     self.ax.set_ylabel('Z-coordinates (cm)')
 
-                    self.plot_left_data = [pos[2] for pos in self.log_left]
-                    self.plot_right_data = [pos[2] for pos in self.log_right]
+                    self.plot_left_data = log_left[:, 2]
+                    self.plot_right_data = log_right[:, 2]
                 else:
                     self.ax.set_title(f'Trial {self.trial_number + 1} - velocity plot')
                     self.ax.set_ylabel('Speed (m/s)')
 
-                    self.plot_left_data = [pos[3] for pos in self.log_left]
-                    self.plot_right_data = [pos[3] for pos in self.log_right]
+                    self.plot_left_data = log_left[:, 3]
+                    self.plot_right_data = log_right[:, 3]
 
-                self.line1.set_xdata(self.xs)
+                self.line1.set_xdata(xs)
                 self.line1.set_ydata(self.plot_left_data)
-                self.line2.set_xdata(self.xs)
+                self.line2.set_xdata(xs)
                 self.line2.set_ydata(self.plot_right_data)
 
                 self.ax.set_xlim(0, 10)
@@ -684,13 +818,11 @@ class TrailTab(QWidget):
                 else:
                     self.ax.set_ylim(0, 10)
 
-                if self.xs:
-                    self.ax.set_xlim(0, self.xs[-1] + 1)
+                if len(xs) > 0:
+                    self.ax.set_xlim(0, xs[-1] + 1)
 
-                    max_y = max(max(self.plot_left_data, default=1),
-                                max(self.plot_right_data, default=1)) * 1.1
-                    min_y = min(min(self.plot_left_data, default=1),
-                                min(self.plot_right_data, default=1)) * 1.1
+                    max_y = max(self.plot_left_data.max(), self.plot_right_data.max()) * 1.1
+                    min_y = min(self.plot_left_data.min(), self.plot_right_data.min()) * 1.1
                     if max_y < 10:
                         if self.vt:
                             max_y = 3
@@ -732,7 +864,9 @@ class TrailTab(QWidget):
         if go or (self.event_log[-1] == 0 and (self.button_pressed or READ_SAMPLE or got_folder)):
             NUMBER_EVENTS = manage_settings.get("Events", "NUMBER_EVENTS")
             USE_NEURAL_NET = manage_settings.get("General", "USE_NEURAL_NET")
-            SERIAL_BUTTON = manage_settings.get("General", "SERIAL_BUTTON")
+            # the button can also be connected to the digital input of the G4
+            SERIAL_BUTTON = manage_settings.get("General", "SERIAL_BUTTON") or \
+                manage_settings.get("General", "DIG_IO_BUTTON")
 
             if go: self.remove_added_text()
 
@@ -741,7 +875,7 @@ class TrailTab(QWidget):
             else:
                 score = -1
 
-            self.event_log[-1] = calculate_e6(self.xs)
+            self.event_log[-1] = calculate_e6(self.xs, self.button_time)
 
             self.case_status = calculate_boxhand(self.log_left, self.log_right, score)
             if self.first_event_guess:
@@ -778,18 +912,7 @@ class TrailTab(QWidget):
 
             self.event_position = calculate_position_events(self.case_status)
 
-            if self.get_score() == 3:
-                if self.case_status == 0:
-                    self.extra_parameters_bim, self.extra_parameters_uni = calculate_extra_parameters(self.event_log,
-                                                                                                      self.log_right,
-                                                                                                      self.log_left)
-                else:
-                    self.extra_parameters_bim, self.extra_parameters_uni = calculate_extra_parameters(self.event_log,
-                                                                                                      self.log_left,
-                                                                                                      self.log_right)
-            else:
-                self.extra_parameters_bim = [0] * len(BIMAN_PARAMS)
-                self.extra_parameters_uni = [0] * len(UNIMAN_PARAMS)
+            self.update_parameters()
 
             if self.get_score() != 0:
                 e1, e2, e3, e4, e5, e6 = self.event_log
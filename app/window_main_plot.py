@@ -1,8 +1,7 @@
 import io
 import os
 
-import pandas as pd
-import pikepdf
+import numpy as np
 import pygame
 import threading
 
@@ -21,16 +20,22 @@ from matplotlib.lines import Line2D
 
 from logger import get_logbook
 from recording_gopro import GoPro
-from sensor_G4Track import initialize_system, set_units, get_active_hubs, close_sensor
+from sensor_backend import initialize_system, set_units, get_active_hubs, get_station_map, close_sensor, \
+    IS_SIMULATED, MAX_HUBS
 from data_processing import calculate_boxhand, calculate_position_events, \
     predict_score, Calibration
 
-from scipy import signal
 
+from data_buffer import TrialBuffer, load_orientation, load_extra_sensors, extra_role, HAND_ROLES
+from data_manifest import ParticipantManifest
+from data_trial_file import read_samples
 from thread_download import DownloadThread
+from thread_ingest import IngestThread
+from thread_save import SaveService, snapshot_trial
+from thread_button import ButtonThread
 from thread_reading import ReadThread
 from widget_settings import manage_settings
-from constants import READ_SAMPLE, TITLE_LETTER_SIZE, LETTER_SIZE
+from constants import READ_SAMPLE, TITLE_LETTER_SIZE, LETTER_SIZE, TAB_MEMORY_BUDGET_MB
 
 
 class MainWindow(QMainWindow):
@@ -69,6 +74,10 @@ class MainWindow(QMainWindow):
         self.hub_id = None
         self.lindex = None
         self.rindex = None
+        # hubs that are read and the (position in hub_ids, sensor) of every sensor that is stored, hands first
+        self.hub_ids = []
+        self.sensor_layout = []
+        self.sensor_roles = list(HAND_ROLES)
         self.reading_active = False
         self.set_abs_value = False
         self.set_automatic = False
@@ -83,6 +92,11 @@ class MainWindow(QMainWindow):
         self.neg_z = neg_z
         self.manual_events = manual
 
+        self.thread_download = None
+        self.worker_download = None
+        self.ingest_thread = None
+        self.progression = None
+
         self.setup(num_trials)
         self.id_part = id
         self.assessor = asses
@@ -90,13 +104,21 @@ class MainWindow(QMainWindow):
         self.num_trials = num_trials
         self.notes = notes
 
-        self.thread_download = None
-        self.worker_download = None
         self.data_thread = ReadThread(self)
         self.data_thread.lost_connection.connect(self.data_loss)
         self.interference = False
-        self.data_thread.interference.connect(self.data_loss)
+        self.data_thread.interference.connect(self.interference_detected)
         self.data_thread.done_reading.connect(self.interference_message)
+        self.data_thread.timing.connect(self.show_timing)
+
+        self.button_thread = ButtonThread(self)
+        self.button_thread.pressed.connect(self.button_pressed)
+        self.data_thread.done_reading.connect(self.button_thread.stop_trial)
+        self.button_thread.start()
+
+        self.save_service = SaveService(self)
+        self.save_service.status.connect(self.save_status)
+        self.save_service.start()
 
         self.gopro = None
         self.connecting_gopro = False
@@ -104,16 +126,6 @@ class MainWindow(QMainWindow):
         self.sound = sound
         self.participant_folder = None
 
-        self.progression = None
-
-        fs = manage_settings.get("Sensors", "fs")
-        fc = manage_settings.get("Sensors", "fc")
-        ORDER_FILTER = manage_settings.get("Data-processing", "ORDER_FILTER")
-
-        nyq = 0.5 * fs
-        w = fc / nyq
-        self.b, self.a = signal.butter(N=ORDER_FILTER, Wn=w, btype='low', output='ba', analog=False)
-
         self.pdf = None
         thread_pdf = threading.Thread(target=self.make_pdf())
         thread_pdf.daemon = True
@@ -130,6 +142,23 @@ class MainWindow(QMainWindow):
     def interference_detected(self):
         self.interference = True
 
+    def show_timing(self, text):
+        """
+        Show the timing of the acquisition (latency, jitter, missed frames) of the running trial
+        """
+        self.statusBar().showMessage(text)
+
+    def button_pressed(self, press_time):
+        """
+        The serial button was pressed during a trial, the reading thread stops the trial
+        :param press_time: moment of the press (time.perf_counter)
+        """
+        tab = self.data_thread.tab
+        if tab is None:
+            return
+        tab.button_time = self.data_thread.frame_clock.trial_time(press_time)
+        tab.button_pressed = True
+
     def interference_message(self):
         if self.interference:
             QMessageBox.information(self, "Warning", "There was a small interference, please check the result")
@@ -164,9 +193,37 @@ class MainWindow(QMainWindow):
 
     def tab_change_handler(self, index):
         """
-        Not sure what this does anymore (only 1 rule)
+        Update the toolbar for the new tab and free the tabs that were not used for a long time
         """
         self.update_toolbar()
+        self.release_idle_tabs()
+
+    def release_idle_tabs(self):
+        """
+        Free the plot and the samples of the tabs that were not shown for the longest time, until all the tabs fit in
+        TAB_MEMORY_BUDGET_MB (the tab that is shown and a running trial are kept)
+        """
+        from widget_trials import TrailTab, TrialState
+
+        # the export reads the samples of all the tabs
+        if self.thread_download is not None and self.thread_download.isRunning():
+            return
+
+        tabs = [self.tab_widget.widget(i) for i in range(self.tab_widget.count())]
+        tabs = [tab for tab in tabs if isinstance(tab, TrailTab)]
+        used = sum(tab.memory_usage() for tab in tabs)
+        budget = TAB_MEMORY_BUDGET_MB * 1024 ** 2
+
+        for tab in sorted(tabs, key=lambda tab: tab.last_shown):
+            if used <= budget:
+                break
+            if tab is self.tab_widget.currentWidget() or tab.trial_state == TrialState.running:
+                continue
+
+            before = tab.memory_usage()
+            tab.release_plot()
+            tab.release_samples()
+            used -= before - tab.memory_usage()
 
     def setup_menubar(self):
         menu_bar = self.menuBar()
@@ -403,210 +460,240 @@ class MainWindow(QMainWindow):
 
     def collect_data(self, number_trials):
         """
-        Extract all the data from the corresponding folder from the start-up
-        """
-        all_zeros = True
-
-        for filename in os.listdir(self.folder):
-            file_path = os.path.join(self.folder, filename)
-
-            if os.path.isdir(file_path):
-                continue
-
-            elif filename.endswith(('.xlsx', '.xls', '.xlsm')):
+        Extract all the data from the corresponding folder from the start-up. The files are read in the background
+        (IngestThread) and put in the tabs as soon as they are read, with a progress bar in the meantime
+        """
+        filenames = [filename for filename in os.listdir(self.folder)
+                     if not os.path.isdir(os.path.join(self.folder, filename))]
+        trial_files = [os.path.join(self.folder, filename) for filename in filenames
+                       if filename.endswith(('.xlsx', '.xls', '.xlsm')) and
+                       os.path.splitext(filename)[0] not in os.path.basename(self.folder)]
+        pdf_files = [os.path.join(self.folder, filename) for filename in filenames if filename.endswith('.pdf')]
+
+        # nothing changed since the last export: no need to read the PDF and the Excels again
+        manifest = ParticipantManifest.load(self.folder)
+        if manifest.is_current(trial_files, pdf_files):
+            self.logger.info(f"Using the manifest of {self.folder}")
+            all_zeros = True
+            for file_path in trial_files:
                 try:
-                    if os.path.splitext(filename)[0] not in os.path.basename(self.folder):
-                        self.extract_excel(file_path)
+                    if self.restore_trial(file_path, manifest.trial(file_path)):
+                        all_zeros = False
                 except:
                     QMessageBox.critical(self, "Error", f"Failed to get info from: {file_path}!")
-                    continue
+            self.finish_collect(all_zeros)
+            return
 
-            elif filename.endswith('.pdf'):
-                try:
-                    all_zeros = self.add_notes(file_path)
-                except:
-                    QMessageBox.critical(self, "Error", f"Failed to get info from: {file_path}!")
-                    continue
+        self.all_zeros = True
+        self.ingest_thread = IngestThread(self, trial_files, pdf_files,
+                                          manage_settings.get("Events", "NUMBER_EVENTS"), self.manual_events)
+        self.ingest_thread.parsed_trial.connect(self.bind_trial)
+        self.ingest_thread.parsed_notes.connect(self.bind_notes)
+        self.ingest_thread.failed.connect(
+            lambda file_path: QMessageBox.critical(self, "Error", f"Failed to get info from: {file_path}!"))
+        self.ingest_thread.finished.connect(lambda: self.finish_collect(self.all_zeros))
+
+        self.make_progress("Please wait. Reading the trials")
+        self.ingest_thread.progress.connect(self.set_progress)
+        self.ingest_thread.start()
+
+    def finish_collect(self, all_zeros):
+        """
+        All the files of the folder are read
+        :param all_zeros: True if no trial has a score (the trials are from a file without a PDF)
+        """
+        from widget_trials import TrailTab
+
+        if self.progression:
+            self.progression.close()
+            self.progression = None
 
         if all_zeros:
             print("all scores are zero")
-            for i in range(number_trials):
+            for i in range(self.tab_widget.count()):
                 tab = self.tab_widget.widget(i)
-                tab.button_pressed = True
-                tab.original_data_file = False
+                if isinstance(tab, TrailTab):
+                    tab.button_pressed = True
+                    tab.original_data_file = False
+
+        self.update_toolbar()
 
-    def extract_excel(self, file):
+    def bind_trial(self, result):
         """
-        Extract all the data from the corresponding excel from collect_data
+        Put a trial that is read by the IngestThread (see data_ingest.parse_trial) in its tab
         """
         NUMBER_EVENTS = manage_settings.get("Events", "NUMBER_EVENTS")
 
         from widget_trials import TrailTab, TrialState
 
-        trial_data = pd.read_excel(file)
-        trial_number = file.split('.')[-2].split('_')[-1]
-
-        tab = self.tab_widget.widget(int(trial_number) - 1)
-
-        if trial_data.shape[1] < 1:
-            tab.event_log = [0] * NUMBER_EVENTS
+        file = result['file']
+        tab = self.tab_widget.widget(result['index'])
+        if not isinstance(tab, TrailTab) or result['kind'] == 'blank':
             return
 
-        first_col = trial_data.iloc[:, 0]
-
-        if first_col.isnull().all() or first_col.astype(str).str.strip().eq("").all():
-            return
-
-        xs = trial_data.iloc[:, 0].values
-        if not (isinstance(tab, TrailTab) and len(xs) > 2):
+        if result['kind'] != 'data':
             tab.event_log = [0] * NUMBER_EVENTS
             return
-        tab.trial_state = TrialState.completed
-
-        self.update_toolbar()
-
-        tab.xs.clear()
-        tab.log_left.clear()
-        tab.log_right.clear()
-
-        tab.xs = list(xs)
-        x1 = trial_data.iloc[:, 1].values
-        y1 = trial_data.iloc[:, 2].values
-        if not self.neg_z:
-            z1 = trial_data.iloc[:, 3].values
-        else:
-            z1 = -trial_data.iloc[:, 3].values
-        v1 = trial_data.iloc[:, 4].values
-
-        x2 = trial_data.iloc[:, 5].values
-        y2 = trial_data.iloc[:, 6].values
-        if not self.neg_z:
-            z2 = trial_data.iloc[:, 7].values
-        else:
-            z2 = -trial_data.iloc[:, 7].values
-        v2 = trial_data.iloc[:, 8].values
-
-        for i in range(len(x1)):
-            tab.log_left.append((x1[i], y1[i], z1[i], v1[i],))
-            tab.log_right.append((x2[i], y2[i], z2[i], v2[i],))
 
         try:
-            if trial_data.shape[1] <= 8:
-                tab.original_data_file = False
-            else:
-                tab.original_data_file = True
-
-            # add manual sign
-            if trial_data.shape[1] < 11:
-                tab.event_log = [0] * NUMBER_EVENTS
-            elif self.manual_events:
-                tab.event_log = trial_data.iloc[:, 12].values[0:NUMBER_EVENTS].tolist()
-                if all(x == 0 for x in tab.event_log):
-                    tab.event_log = trial_data.iloc[:, 11].values[0:NUMBER_EVENTS].tolist()
-            else:
-                tab.event_log = trial_data.iloc[:, 11].values[0:NUMBER_EVENTS].tolist()
+            tab.trial_state = TrialState.completed
+            self.update_toolbar()
+            # the samples are loaded again from the file when they are needed (see restore_trial)
+            tab.samples_source = lambda: self.load_samples(file)
+            tab.samples_released = True
+
+            tab.original_data_file = result['original_data_file']
+            tab.event_log = result['event_log']
 
             self.events_present = not all(x == 0 for x in tab.event_log)
             if self.events_present:
                 tab.first_process = False
 
-            if trial_data.shape[1] < 13 or \
-                    (self.manual_events and
-                     (trial_data.shape[1] <= 14 and not (trial_data['Position events:'].fillna(0) == 0).all())):
+            if result['estimate_positions']:
                 USE_NEURAL_NET = manage_settings.get("General", "USE_NEURAL_NET")
 
+                _, left, right = self.hand_samples(result['columns'])
                 if USE_NEURAL_NET:
-                    score = predict_score(tab.log_left, tab.log_right)
+                    score = predict_score(left, right)
                 else:
                     score = -1
-                tab.case_status = calculate_boxhand(tab.log_left, tab.log_right, score)
+                tab.case_status = calculate_boxhand(left, right, score)
                 tab.event_position = calculate_position_events(tab.case_status)
             else:
-                tab.event_position = trial_data.iloc[:, 13].values[0:NUMBER_EVENTS].tolist()
+                tab.event_position = result['event_position']
 
-            if trial_data.shape[1] >= 18 and tab.trial_time_start == 0:
-                tab.trial_time_start = trial_data.iloc[0, 17]
-        finally:
-            if tab.event_log is None or len(tab.event_log) == 0:
-                tab.event_log = [0] * NUMBER_EVENTS
-            else:
-                tab.event_log = [int(x) if x != 0 else 0 for x in tab.event_log]
+            if result['trial_time_start'] is not None and tab.trial_time_start == 0:
+                tab.trial_time_start = result['trial_time_start']
+
+            if result['button_time'] is not None:
+                tab.button_time = result['button_time']
+
+            tab.update_plot(True, self)
+        except Exception as e:
+            self.logger.error(e, exc_info=True)
+            QMessageBox.critical(self, "Error", f"Failed to get info from: {file}!")
+
+    def hand_samples(self, columns):
+        """
+        :param columns: the time and x, y, z, v of the left and the right sensor (the first 9 columns of the file)
+        :return: the timestamps and the samples of the left and the right hand with shape (N, 4)
+        """
+        sign = -1 if self.neg_z else 1
+        left = np.column_stack((columns[1], columns[2], sign * columns[3], columns[4]))
+        right = np.column_stack((columns[5], columns[6], sign * columns[7], columns[8]))
+        return columns[0], left, right
+
+    def set_samples(self, buffer, file, columns):
+        """
+        Put the samples of a trial file in a trial buffer
+        :param buffer: the trial buffer
+        :type buffer: TrialBuffer
+        :param file: the trial file (for the orientation and the extra sensors next to it)
+        :param columns: the time and x, y, z, v of the left and the right sensor (the first 9 columns of the file)
+        """
+        xs, left, right = self.hand_samples(columns)
+
+        extra_roles, extra = load_extra_sensors(file, len(xs))
+        if extra is not None and self.neg_z:
+            extra[:, :, 2] *= -1
+        buffer.set_data(xs, left, right, load_orientation(file, len(xs)), extra, extra_roles)
+
+    def load_samples(self, file):
+        """
+        Load (again) the samples of a trial from its file, used for the tabs that are not shown yet
+        :return: the samples of the trial
+        :rtype: TrialBuffer
+        """
+        buffer = TrialBuffer()
+        self.set_samples(buffer, file, read_samples(file))
+        return buffer
+
+    def restore_trial(self, file, entry):
+        """
+        Rebuild a trial from the manifest of the folder (instead of extract_excel and add_notes)
+        :param file: the trial file
+        :param entry: the state of the trial in the manifest
+        :return: True if the trial has a score that is not 0
+        """
+        NUMBER_EVENTS = manage_settings.get("Events", "NUMBER_EVENTS")
+
+        from widget_trials import TrailTab, TrialState
+
+        trial_number = file.split('.')[-2].split('_')[-1]
+        tab = self.tab_widget.widget(int(trial_number) - 1)
+        if not isinstance(tab, TrailTab):
+            return False
+
+        tab.score.setCurrentIndex(entry["score"])
+        cursor = tab.notes_input.textCursor()
+        fmt = QTextCharFormat()
+        fmt.setForeground(QColor(Qt.black))
+        cursor.setCharFormat(fmt)
+        for line in entry["notes"] + entry["automatic_notes"]:
+            cursor.insertText(line)
+            cursor.insertText('\n')
+
+        if entry["samples"] <= 2:
+            tab.event_log = [0] * NUMBER_EVENTS
+            return entry["score"] != 0
+
+        tab.trial_state = TrialState.completed
+        self.update_toolbar()
+        # only the metadata is read now, the samples are loaded when they are needed
+        tab.samples_source = lambda: self.load_samples(file)
+        tab.samples_released = True
+        tab.original_data_file = True
+
+        if self.manual_events and not all(x == 0 for x in entry["manual_events"]):
+            event_log = entry["manual_events"]
+        else:
+            event_log = entry["automatic_events"]
+        tab.event_log = [int(x) if x else 0 for x in event_log[0:NUMBER_EVENTS]]
+        tab.event_log += [0] * (NUMBER_EVENTS - len(tab.event_log))
+
+        self.events_present = not all(x == 0 for x in tab.event_log)
+        if self.events_present:
+            tab.first_process = False
+
+        tab.case_status = entry["case_status"]
+        tab.event_position = entry["position_events"][0:NUMBER_EVENTS]
+        if tab.trial_time_start == 0:
+            tab.trial_time_start = entry["trial_time_start"]
+        tab.button_time = entry["button_time"]
+        tab.extra_parameters_bim = entry["parameters"]["bimanual"]
+        tab.extra_parameters_uni = entry["parameters"]["unimanual"]
 
         tab.update_plot(True, self)
+        return entry["score"] != 0
 
-    def add_notes(self, file):
+    def bind_notes(self, result):
         """
-        Extract all the notes from the corresponding PDF from collect_data
+        Put the scores and notes that are read from a PDF by the IngestThread (see data_ingest.parse_notes) in the tabs
         """
         from widget_trials import TrailTab
 
-        pdf = pikepdf.Pdf.open(file)
-
-        trial_number = 0
-        in_table = False
         all_zeros = True
-        events_table = False
-        for page in pdf.pages:
-            pdf_content = page.get('/Contents').read_bytes().decode('utf-8')
-            text = pdf_content.split('\n')
-
-            for line in text:
-                if '(' in line:
-                    rule_text = line.split('(', 1)[1]
-                    rule_text = rule_text[::-1].split(')', 1)[1][::-1]
-
-                    if 'Trial 1' in rule_text and trial_number == 0:
-                        trial_number = 1
-                        tab = self.tab_widget.widget(int(trial_number) - 1)
-                        if isinstance(tab, TrailTab) and 'score' in rule_text:
-                            score = int(rule_text.split()[3])
-
-                            tab.score.setCurrentIndex(score)
-                            if score != 0: all_zeros = False
-
-                    elif 'Trial' in rule_text and int(rule_text.split()[1][:-1]) == trial_number + 1:
-                        in_table = False
-                        events_table = False
-                        trial_number += 1
-
-                        tab = self.tab_widget.widget(int(trial_number) - 1)
-                        if isinstance(tab, TrailTab) and 'score' in rule_text:
-                            score = int(rule_text.split()[3])
-
-                            tab.score.setCurrentIndex(score)
-                            if score != 0: all_zeros = False
-
-                    elif trial_number == 0:
-                        continue
-
-                    elif rule_text == 'Table' or rule_text == 'Parameters':
-                        in_table = True
-
-                    elif rule_text == 'Events':
-                        events_table = True
-                        in_table = True
-
-                    elif events_table and tab.trial_time_start == 0 and 'Starting the trial at:' in rule_text:
-                        time = rule_text.split(':')[1:]
-                        sec = float(time[1])
-                        min = int(time[0])
-                        print('time found')
-                        tab.trial_time_start = min*60+sec
-                        print(tab.trial_time_start)
-
-                    elif rule_text == 'Average over all trials with score 3':
-                        break
+        for index, trial in result['trials'].items():
+            tab = self.tab_widget.widget(index)
+            if not isinstance(tab, TrailTab):
+                continue
 
-                    else:
-                        cursor = tab.notes_input.textCursor()
-                        fmt = QTextCharFormat()
-                        fmt.setForeground(QColor(Qt.black))
-                        cursor.setCharFormat(fmt)
-                        if not in_table and rule_text != 'No Notes':
-                            cursor.insertText(rule_text)
-                            cursor.insertText('\n')
+            if trial['score'] is not None:
+                tab.score.setCurrentIndex(trial['score'])
+                if trial['score'] != 0: all_zeros = False
+
+            if trial['trial_time_start'] is not None and tab.trial_time_start == 0:
+                tab.trial_time_start = trial['trial_time_start']
+
+            cursor = tab.notes_input.textCursor()
+            fmt = QTextCharFormat()
+            fmt.setForeground(QColor(Qt.black))
+            cursor.setCharFormat(fmt)
+            for line in trial['notes']:
+                cursor.insertText(line)
+                cursor.insertText('\n')
 
-        return all_zeros
+        self.all_zeros = self.all_zeros and all_zeros
 
     def get_tab(self):
         """
@@ -700,6 +787,7 @@ class MainWindow(QMainWindow):
 
         if tab is not None:
             self.data_thread.start_tab_reading(tab)
+            self.button_thread.start_trial()
             if self.gopro:
                 self.gopro.request_trial_start.emit()
             tab.start_reading()
@@ -791,6 +879,18 @@ class MainWindow(QMainWindow):
 
         set_units(self.dongle_id)
 
+        if IS_SIMULATED:
+            # the replayed recording is already in the frame of reference of the trial, no calibration needed
+            self.hub_id, self.lindex, self.rindex = get_active_hubs(self.dongle_id, True)[0], 0, 1
+            self.first_calibration = False
+            self.update_sensor_layout()
+
+            if self.data_thread.isRunning():
+                self.data_thread.requestInterruption()
+                self.data_thread.quit()
+                self.data_thread.wait()
+            self.data_thread.start()
+
         self.is_connected = True
         self.connection_action.setEnabled(False)  # Disable connect button after successful connection
         self.calibrate_action.setEnabled(True)
@@ -982,8 +1082,30 @@ class MainWindow(QMainWindow):
                 self.validate_action.setEnabled(True)
                 self.update_toolbar()
 
+                self.update_sensor_layout()
                 self.data_thread.start()
 
+    def update_sensor_layout(self):
+        """
+        Decide which sensors are read: the hands found by the calibration and, with RECORD_EXTRA_SENSORS, every other
+        active sensor on the active hubs (all hubs are read with a single call)
+        """
+        self.hub_ids = [self.hub_id]
+        self.sensor_layout = [(0, self.lindex), (0, self.rindex)]
+        self.sensor_roles = list(HAND_ROLES)
+
+        if not manage_settings.get("Sensors", "RECORD_EXTRA_SENSORS") or self.dongle_id is None:
+            return
+
+        active_hubs = get_active_hubs(self.dongle_id, True) or []
+        self.hub_ids += [hub for hub in active_hubs if hub != self.hub_id][:MAX_HUBS - 1]
+        for position, hub in enumerate(self.hub_ids):
+            for sensor, active in enumerate(get_station_map(self.dongle_id, hub) or ()):
+                if active and (position, sensor) not in self.sensor_layout:
+                    self.sensor_layout.append((position, sensor))
+                    self.sensor_roles.append(extra_role(len(self.sensor_roles) - len(HAND_ROLES)))
+        self.logger.info(f"Reading hubs {self.hub_ids}, sensors {dict(zip(self.sensor_roles, self.sensor_layout))}")
+
     def validate_cali(self):
         QMessageBox.information(self, "Info", "Put one of the sensors on the button. "
                                               "Keep the other one still")
@@ -1009,7 +1131,7 @@ class MainWindow(QMainWindow):
         """
         Filter the data of the tab
         """
-        self.get_tab().process(self.b, self.a)
+        self.get_tab().process()
         self.saved_data = False
 
     def process_events(self):
@@ -1034,7 +1156,7 @@ class MainWindow(QMainWindow):
                 if isinstance(tab, TrailTab) and len(tab.xs) > 0:
                     if tab.first_process:
                         tab.interpolate()
-                        tab.process(self.b, self.a)
+                        tab.process()
                         tab.first_process = False
                     tab.calculate_events((self.folder is not None), go)
 
@@ -1059,14 +1181,9 @@ class MainWindow(QMainWindow):
             tab = self.tab_widget.widget(i)
 
             if isinstance(tab, TrailTab):
-                for index in range(len(tab.log_left)):
-                    temp = list(tab.log_left[index])
-                    temp[2] = -temp[2]
-                    tab.log_left[index] = tuple(temp)
-
-                    temp = list(tab.log_right[index])
-                    temp[2] = -temp[2]
-                    tab.log_right[index] = tuple(temp)
+                tab.log_left[:, 2] *= -1
+                tab.log_right[:, 2] *= -1
+                tab.trial_buffer.changed()
 
             tab.update_plot(True)
 
@@ -1078,6 +1195,9 @@ class MainWindow(QMainWindow):
         from widget_trials import TrailTab
 
         self.lindex, self.rindex = self.rindex, self.lindex
+        # the hands are always the first two sensors that are read
+        if len(self.sensor_layout) >= 2:
+            self.sensor_layout[0], self.sensor_layout[1] = self.sensor_layout[1], self.sensor_layout[0]
 
         change_tabs = []
         active_tabs = 0
@@ -1088,7 +1208,7 @@ class MainWindow(QMainWindow):
                 if len(tab.xs) > 0:
                     active_tabs += 1
                     if tab.log_left[0][0] > tab.log_right[0][0]:
-                        tab.log_left, tab.log_right = tab.log_right, tab.log_left
+                        tab.trial_buffer.swap_hands()
                         change_tabs.append(i)
 
             tab.update_plot(True)
@@ -1141,6 +1261,13 @@ class MainWindow(QMainWindow):
             self.thread_download.quit()
             self.thread_download.wait()
 
+        # the trials that are still waiting are written before closing
+        self.save_service.stop()
+
+        if self.ingest_thread and self.ingest_thread.isRunning():
+            self.ingest_thread.requestInterruption()
+            self.ingest_thread.wait()
+
         if self.gopro:
             self.gopro.cleanup()
 
@@ -1149,6 +1276,10 @@ class MainWindow(QMainWindow):
             self.data_thread.quit()
             self.data_thread.wait()
 
+        if self.button_thread.isRunning():
+            self.button_thread.requestInterruption()
+            self.button_thread.wait()
+
         close_sensor()
 
         if not pygame.mixer.get_init():
@@ -1177,29 +1308,34 @@ class MainWindow(QMainWindow):
 
     def save_excel(self, index):
         """
-        Make an Excel of the given index trial using a thread (used to auto-save the trials)
+        Save the trial at the given index in the background (used to auto-save the trials), see SaveService
         :param index: trial index
         :return:
         """
-        if self.thread_download and self.thread_download.isRunning():
-            self.thread_download.quit()
-            self.thread_download.wait()
+        from widget_trials import TrailTab
+
+        tab = self.tab_widget.widget(index)
+        if not isinstance(tab, TrailTab):
+            return
 
-        self.save_all = False
         if self.participant_folder is None:
             self.make_dir()
 
-        self.thread_download = QThread()
-        self.worker_download = DownloadThread(self, self.participant_folder, index)
-        self.worker_download.moveToThread(self.thread_download)
-
-        self.worker_download.pdf_ready_image.connect(self.add_plots_data)
-        self.worker_download.progress.connect(self.set_progress)
-        self.worker_download.finished_file.connect(self.finish_export)
-        self.worker_download.error_occurred.connect(self.show_error)
+        self.save_service.submit(self.participant_folder, snapshot_trial(tab, index))
 
-        self.thread_download.started.connect(self.worker_download.run)
-        self.thread_download.start()
+    def save_status(self, index, state, message):
+        """
+        Show the state of a trial that is saved in the background
+        :param index: trial index
+        :param state: 'queued', 'saving', 'saved' or 'failed'
+        :param message: the error if the saving failed, or the number of waiting trials if many are queued
+        """
+        if state == 'saved':
+            self.statusBar().showMessage(f"Trial {index + 1} saved", 3000)
+        elif state == 'queued' and message:
+            self.statusBar().showMessage(message)
+        elif state == 'failed':
+            self.show_error(f"Failed to save trial {index + 1}: {message}")
 
     def make_dir(self):
         """
@@ -1369,13 +1505,14 @@ class MainWindow(QMainWindow):
             buf.close()
             self.worker_download.condition.wakeAll()
 
-    def make_progress(self):
+    def make_progress(self, text="Please wait. Download in progress"):
         """
         Make the progress bar pop-up
+        :param text: the text above the bar
         """
         from widget_progression_bar import ProgressionBar
 
-        self.progression = ProgressionBar()
+        self.progression = ProgressionBar(text=text)
         self.progression.show()
 
     def show_error(self, e):
@@ -1402,6 +1539,10 @@ class MainWindow(QMainWindow):
 
                 self.pdf.output(pdf_file)
 
+            manifest = ParticipantManifest(self.participant_folder)
+            manifest.set_pdf(pdf_file)
+            manifest.save()
+
             self.pdf = None
             thread_pdf = threading.Thread(target=self.make_pdf())
             thread_pdf.daemon = True
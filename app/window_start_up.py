@@ -3,19 +3,23 @@ from copy import copy
 from pathlib import Path
 import re
 
-import openpyxl
-import pandas as pd
-from PySide6.QtCore import QObject, Signal, QThread
+import numpy as np
+from PySide6.QtCore import QObject, Signal, QThread, QTimer
 from PySide6.QtGui import QIcon
 from PySide6.QtWidgets import (
     QVBoxLayout, QWidget, QPushButton, QFileDialog, QApplication, QDialog, QMessageBox
 )
-from openpyxl.styles import Font, Alignment
 
 from constants import BIMAN_PARAMS, UNIMAN_PARAMS
+from data_dataset import CohortDataset, DATASET_FOLDER
+from data_ingest import blank_column
+from data_journal import find_journals, recover_journal
+from data_study import StudyDatabase
+from data_trial_file import open_trial, read_samples
 from logger import get_logbook
 from widget_settings import manage_settings
 from data_processing import calculate_extra_parameters, predict_score, calculate_boxhand
+from data_summary import new_workbook, write_table
 
 from window_set_up import SetUp
 
@@ -50,6 +54,37 @@ class StartUp(QDialog):
 
         self.setLayout(layout)
 
+        QTimer.singleShot(0, self.recover_journals)
+
+    def recover_journals(self):
+        """
+        Offer to rebuild the trials that were still in a journal when the app stopped (crashed) the last time
+        """
+        journals = find_journals()
+        if not journals:
+            return
+
+        ret = QMessageBox.question(self, "Recover trials",
+                                   f"{len(journals)} trial(s) were not saved the last time the app was used. "
+                                   f"Do you want to recover them?\n(Discard removes them for good)",
+                                   QMessageBox.Yes | QMessageBox.No | QMessageBox.Discard)
+        if ret == QMessageBox.No:
+            return
+
+        recovered = []
+        for journal in journals:
+            try:
+                if ret == QMessageBox.Yes:
+                    recovered.append(recover_journal(journal))
+                else:
+                    os.remove(journal)
+            except Exception as e:
+                self.logger.error(f"Failed to recover {journal}: {e}", exc_info=True)
+                QMessageBox.critical(self, "Error", f"Failed to recover {journal}!")
+
+        if recovered:
+            QMessageBox.information(self, "Success", "Recovered the trials to:\n" + "\n".join(recovered))
+
     # go to setup window
     def open_setup(self):
         self.setup = SetUp()
@@ -66,10 +101,11 @@ class StartUp(QDialog):
     def select_patients(self):
         folder = QFileDialog.getExistingDirectory(self, "Select Patient Directory", os.path.expanduser("~/Documents"))
         if folder:
+            dataset, samples = self.ask_dataset()
             try:
                 self.make_progress()
                 self.thread = QThread()
-                self.worker = CompareWorker(folder)
+                self.worker = CompareWorker(folder, dataset, samples)
                 self.worker.moveToThread(self.thread)
 
                 self.worker.progression.connect(self.set_progress)
@@ -80,6 +116,25 @@ class StartUp(QDialog):
             except Exception as e:
                 QMessageBox.critical(self, 'Error', str(e))
                 
+    def ask_dataset(self):
+        """
+        Ask if the dataset of the whole folder (one file for the statistics) has to be written next to the Excel
+        :return: write the dataset, add the samples to the dataset
+        """
+        question = QMessageBox(self)
+        question.setWindowTitle("Compare participants")
+        question.setText("Also export the dataset of all the participants (for the statistics)?")
+        question.setInformativeText("The trials of the participants that did not change since the last export are not "
+                                    "read again.")
+        excel = question.addButton("Only Excel", QMessageBox.RejectRole)
+        dataset = question.addButton("Dataset", QMessageBox.AcceptRole)
+        samples = question.addButton("Dataset with samples", QMessageBox.AcceptRole)
+        question.setDefaultButton(excel)
+        question.exec()
+
+        clicked = question.clickedButton()
+        return clicked in (dataset, samples), clicked == samples
+
     def make_progress(self):
         """
         Make the progress bar pop-up
@@ -122,9 +177,16 @@ class CompareWorker(QThread):
     done = Signal()
     error = Signal(str)
 
-    def __init__(self, folder):
+    def __init__(self, folder, dataset=False, samples=False):
+        """
+        :param folder: the folder with a folder for every participant
+        :param dataset: also write the dataset of the whole folder (see data_dataset)
+        :param samples: add the samples of every trial to the dataset
+        """
         super().__init__()
         self.folder = folder
+        self.dataset = dataset
+        self.samples = samples
         self.interval = 100 / (sum(1 for p in Path(folder).iterdir() if p.is_dir())+1)
         self.counter = 0
 
@@ -135,56 +197,52 @@ class CompareWorker(QThread):
         except Exception as e:
             self.error.emit(str(e))
 
-    def add_patient_data(self, file, data_dict, aver_data, trials):
+    def read_patient_data(self, file):
         """
-        Add all necessary data of the patients trial to the dict
+        Read a trial of a patient and calculate all the necessary data of it
         :param file: the file containing the data of the patient
-        :param data_dict: dict containing data of the patient
-        :param aver_data: dict containing average of all the patient
-        :param trials: list of the trials of a patient
-        :return:
+        :return: dict with the trial number, score, case, events and the parameters, and the samples of the trial (None
+        for both if the trial is empty)
+        """
+        with open_trial(file) as trial:
+            return self.read_trial_columns(trial, file)
+
+    def read_trial_columns(self, trial, file):
+        """
+        read_patient_data for an open trial (see data_trial_file.open_trial), only the columns that are needed are read
         """
-        trial_data = pd.read_excel(file)
         trial_number = file.name.split('.')[-2].split('_')[-1]
         NUMBER_EVENTS = manage_settings.get("Events", "NUMBER_EVENTS")
+        number_columns = len(trial.names)
 
-        first_col = trial_data.iloc[:, 0]
-
-        if trial_data.shape[1] < 1 or first_col.isnull().all() or first_col.astype(str).str.strip().eq("").all():
-            return
+        if number_columns < 1:
+            return None, None
+        xs = trial.values(0)
+        if blank_column(xs):
+            return None, None
 
-        xs = trial_data.iloc[:, 0].values
         if len(xs) < 2:
-            return
+            return None, None
 
         print('starting appending data')
 
-        trials.append(int(trial_number)-1)
-
         log_left, log_right = [], []
 
-        x1 = trial_data.iloc[:, 1].values
-        y1 = trial_data.iloc[:, 2].values
-        z1 = trial_data.iloc[:, 3].values
-        v1 = trial_data.iloc[:, 4].values
-
-        x2 = trial_data.iloc[:, 5].values
-        y2 = trial_data.iloc[:, 6].values
-        z2 = trial_data.iloc[:, 7].values
-        v2 = trial_data.iloc[:, 8].values
+        x1, y1, z1, v1 = (trial.values(i) for i in range(1, 5))
+        x2, y2, z2, v2 = (trial.values(i) for i in range(5, 9))
 
         for i in range(len(x1)):
             log_left.append((x1[i], y1[i], z1[i], v1[i],))
             log_right.append((x2[i], y2[i], z2[i], v2[i],))
 
-        if trial_data.shape[1] < 11:
+        if number_columns < 11:
             event_log = [0] * NUMBER_EVENTS
         elif True:  # eventueel toevoegen in instellingen of extra pop-up (manual events)
-            event_log = trial_data.iloc[:, 12].values[0:NUMBER_EVENTS].tolist()
+            event_log = trial.values(12)[0:NUMBER_EVENTS].tolist()
             if all(x == 0 for x in event_log):
-                event_log = trial_data.iloc[:, 11].values[0:NUMBER_EVENTS].tolist()
+                event_log = trial.values(11)[0:NUMBER_EVENTS].tolist()
         else:
-            event_log = trial_data.iloc[:, 11].values[0:NUMBER_EVENTS].tolist()
+            event_log = trial.values(11)[0:NUMBER_EVENTS].tolist()
         event_log = [int(ei) for ei in event_log[:]]
 
         print(log_left, log_right)
@@ -196,18 +254,36 @@ class CompareWorker(QThread):
         elif case == 1:
             bim_par, uni_par = calculate_extra_parameters(event_log, log_left, log_right)
         else:
-            bim_par, uni_par = [0] * len(data_dict["Bimanual"].keys()), [0] * len(data_dict["Unimanual"].keys())
+            bim_par, uni_par = [0] * len(BIMAN_PARAMS), [0] * len(UNIMAN_PARAMS)
 
         print(event_log, bim_par, uni_par)
 
-        data_dict[" "]["Score"].append(score)
+        file_score = trial.values(9)[0] if number_columns > 9 else None
+        row = {"trial": int(trial_number), "score": score, "case": case, "events": event_log,
+               "bimanual": list(bim_par), "unimanual": list(uni_par), "samples": len(xs), "file_score": file_score}
+        samples = np.column_stack([xs.astype(np.float64), x1, y1, z1, v1, x2, y2, z2, v2]).astype(np.float64)
+        return row, samples
+
+    def add_patient_data(self, row, data_dict, aver_data, trials):
+        """
+        Add all necessary data of the patients trial to the dict
+        :param row: the data of the trial from read_patient_data
+        :param data_dict: dict containing data of the patient
+        :param aver_data: dict containing average of all the patient
+        :param trials: list of the trials of a patient
+        :return:
+        """
+        trials.append(row["trial"] - 1)
+        case = row["case"]
+
+        data_dict[" "]["Score"].append(row["score"])
         data_dict[" "][""].append('')
         data_dict[" "][" "].append('')
 
-        for key, value in zip(data_dict["Events"].keys(), event_log):
+        for key, value in zip(data_dict["Events"].keys(), row["events"]):
             data_dict["Events"][key].append(value)
 
-        for key, value in zip(data_dict["Bimanual"].keys(), bim_par):
+        for key, value in zip(data_dict["Bimanual"].keys(), row["bimanual"]):
             data_dict["Bimanual"][key].append(value)
             if case == 0:
                 aver_data["Bimanual"][key][0] += value
@@ -219,7 +295,7 @@ class CompareWorker(QThread):
         elif case == 1:
             aver_data[""]["Number of Trials"][1] += 1
 
-        for key, value in zip(data_dict["Unimanual"].keys(), uni_par):
+        for key, value in zip(data_dict["Unimanual"].keys(), row["unimanual"]):
             data_dict["Unimanual"][key].append(value)
 
             if case == 0:
@@ -229,7 +305,12 @@ class CompareWorker(QThread):
 
         print(data_dict)
 
-    def add_data_aver(self, aver_data, wb):
+    def add_data_aver(self, aver_data, ws):
+        """
+        Add the averages of all the participants to the Excel
+        :param aver_data: sum of the parameters of all the participants and the number of trials
+        :param ws: the comparison sheet (first sheet of the Excel)
+        """
         print(aver_data)
         for param in aver_data["Bimanual"]:
             aver_data["Bimanual"][param] = [param_lr / aver_data[""]["Number of Trials"][index]
@@ -241,62 +322,7 @@ class CompareWorker(QThread):
                                              if aver_data[""]["Number of Trials"][index] != 0 else 0
                                              for index, param_lr in enumerate(aver_data["Unimanual"][param])]
 
-        columns_aver = pd.MultiIndex.from_tuples(
-            [(heading, sub) for heading, subdict in aver_data.items() for sub in subdict]
-        )
-        data_aver = [
-            [aver_data[heading][sub][i] for heading, subdict in aver_data.items() for sub in subdict]
-            for i in [0, 1]
-        ]
-        df_aver = pd.DataFrame(data_aver, columns=columns_aver)
-        df_aver.index = ['LEFT', 'RIGHT']
-
-        bold_font = Font(bold=True)
-
-        # average info
-        print('hope')
-        ws_average = wb[wb.sheetnames[0]]
-        ws_average.title = "Comparison"
-        for merged_range in list(ws_average.merged_cells.ranges):
-            ws_average.unmerge_cells(str(merged_range))
-        bh_cell = ws_average.cell(row=2, column=1, value='BH')
-        bh_cell.font = bold_font
-        col = 2
-        print('fully')
-        for level0, level1 in df_aver.columns:
-            level0_cell = ws_average.cell(row=1, column=col, value=level0)
-            level0_cell.font = bold_font
-            level1_cell = ws_average.cell(row=2, column=col, value=level1)
-            level1_cell.font = bold_font
-            col += 1
-        bh_values = ['LEFT', 'RIGHT']
-        print('almost')
-        for row_idx, (bh_value, row_data) in enumerate(df_aver.iterrows()):
-            excel_row = row_idx + 3
-            bh_label = bh_values[row_idx]
-            ws_average.cell(row=excel_row, column=1, value=bh_label)
-            for col_idx, value in enumerate(row_data, start=2):
-                ws_average.cell(row=excel_row, column=col_idx, value=value)
-
-        print('maybe')
-
-        current_col = 2
-        current_header = None
-        start_col = 2
-
-        for level0, level1 in df_aver.columns:
-            if level0 != current_header:
-                if current_header is not None and current_col > start_col:
-                    ws_average.merge_cells(start_row=1, start_column=start_col, end_row=1, end_column=current_col - 1)
-                    ws_average.cell(row=1, column=start_col).alignment = Alignment(horizontal='center')
-
-                current_header = level0
-                start_col = current_col
-            current_col += 1
-
-        if current_col > start_col:
-            ws_average.merge_cells(start_row=1, start_column=start_col, end_row=1, end_column=current_col - 1)
-            ws_average.cell(row=1, column=start_col).alignment = Alignment(horizontal='center')
+        write_table(ws, 'BH', ['LEFT', 'RIGHT'], aver_data)
 
     def add_data_sum(self, part_code, valid_ranges, sum_data, wb):
         """
@@ -306,54 +332,7 @@ class CompareWorker(QThread):
         :param sum_data: all the data of the participant
         :param wb: needed to add data to the Excel
         """
-        columns_sum = pd.MultiIndex.from_tuples([(heading, sub) for heading, subdict in sum_data.items()
-                                                 for sub in subdict])
-        first_heading = next(iter(sum_data))
-        first_sub = next(iter(sum_data[first_heading]))
-        n_rows = len(sum_data[first_heading][first_sub])
-        data_sum = [
-            [sum_data[heading][sub][i] for heading, subdict in sum_data.items() for sub in subdict]
-            for i in range(n_rows)
-        ]
-        df_sum = pd.DataFrame(data_sum, columns=columns_sum)
-
-        bold_font = Font(bold=True)
-
-        ws_summary = wb.create_sheet(part_code)
-        trial_cell = ws_summary.cell(row=2, column=1, value='Trial')
-        trial_cell.font = bold_font
-        ws_summary.cell(row=2, column=1, value='Trial')
-        col = 2
-        for level0, level1 in df_sum.columns:
-            level0_cell = ws_summary.cell(row=1, column=col, value=level0)
-            level0_cell.font = bold_font
-            level1_cell = ws_summary.cell(row=2, column=col, value=level1)
-            level1_cell.font = bold_font
-            col += 1
-        for row_idx, (trial_num, row_data) in enumerate(df_sum.iterrows()):
-            excel_row = row_idx + 3
-            trial_num = valid_ranges[row_idx] + 1
-            ws_summary.cell(row=excel_row, column=1, value=trial_num)
-            for col_idx, value in enumerate(row_data, start=2):
-                ws_summary.cell(row=excel_row, column=col_idx, value=value)
-
-        current_col = 2
-        current_header = None
-        start_col = 2
-
-        for level0, level1 in df_sum.columns:
-            if level0 != current_header:
-                if current_header is not None and current_col > start_col:
-                    ws_summary.merge_cells(start_row=1, start_column=start_col, end_row=1, end_column=current_col - 1)
-                    ws_summary.cell(row=1, column=start_col).alignment = Alignment(horizontal='center')
-
-                current_header = level0
-                start_col = current_col
-            current_col += 1
-
-        if current_col > start_col:
-            ws_summary.merge_cells(start_row=1, start_column=start_col, end_row=1, end_column=current_col - 1)
-            ws_summary.cell(row=1, column=start_col).alignment = Alignment(horizontal='center')
+        write_table(wb.create_sheet(part_code), 'Trial', [index + 1 for index in valid_ranges], sum_data)
 
     def search_dir(self, folder):
         """
@@ -363,7 +342,9 @@ class CompareWorker(QThread):
         if os.path.exists(compare_file):
             os.remove(compare_file)
 
-        wb_dest = openpyxl.Workbook()
+        # the workbook is written in write-only mode, the comparison sheet is made first so it stays the first sheet
+        wb_dest = new_workbook()
+        ws_comparison = wb_dest.create_sheet("Comparison")
 
         aver_data = {"": {"Number of Trials": [0, 0]}, "Bimanual": {}, "Unimanual": {}}
         for param in BIMAN_PARAMS:
@@ -371,10 +352,17 @@ class CompareWorker(QThread):
         for param in UNIMAN_PARAMS:
             aver_data["Unimanual"][param] = [0, 0]
 
+        study = StudyDatabase.open(folder)
+        participants = set()
+
+        dataset = None
+        if self.dataset:
+            dataset = CohortDataset.load(folder, manage_settings.get("Events", "NUMBER_EVENTS"))
+
         for filename in os.listdir(folder):
             file_path = os.path.join(folder, filename)
 
-            if os.path.isdir(file_path):
+            if os.path.isdir(file_path) and filename != DATASET_FOLDER:
                 part_code = filename
                 if '(' in filename and ')' in filename:
                     part_code = filename.split('(')[0]
@@ -443,12 +431,38 @@ class CompareWorker(QThread):
 
                 print(files)
 
+                write_dataset = dataset is not None and not dataset.is_current(filename, files, self.samples)
+
                 trial_number = []
+                rows, samples = [], {}
                 for file in files:
                     # print(f'starting file: {file}')
-                    self.add_patient_data(file, sum_data, aver_data, trial_number)
+                    # the trials that did not change since the last comparison are taken out of the study database
+                    found, row = study.analysis(file)
+                    trial_samples = None
+                    if not found:
+                        row, trial_samples = self.read_patient_data(file)
+                        study.set_analysis(file, row)
+                    if row is None:
+                        continue
+
+                    self.add_patient_data(row, sum_data, aver_data, trial_number)
+                    rows.append(row)
+                    if write_dataset and self.samples:
+                        if trial_samples is None:
+                            trial_samples = np.column_stack(read_samples(file))
+                        samples[row["trial"]] = trial_samples
                     # print(f'done file: {file}')
 
+                study.remove_missing(filename, files)
+                study.commit()
+                participants.add(filename)
+
+                if write_dataset:
+                    dataset.set_participant(filename, part_code, files, rows, samples if self.samples else None)
+                elif dataset is not None:
+                    dataset.keep(filename)
+
                 print('done')
                 print(sum_data)
 
@@ -457,6 +471,10 @@ class CompareWorker(QThread):
                 self.counter += 1
                 self.progression.emit(self.counter*self.interval)
 
-        self.add_data_aver(aver_data, wb_dest)
+        self.add_data_aver(aver_data, ws_comparison)
         wb_dest.save(compare_file)
+        if dataset is not None:
+            dataset.save()
+        study.remove_participants(participants)
+        study.close()
         self.done.emit()